@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+比较旧的数据清理方式和 retention.py 的分块删除 + 增量回收
+
+在临时目录中用 ping_monitor 写入 --days 天、每 --interval 秒一轮、每轮 --targets 个目标的
+模拟结果，复制出两份数据库：
+  legacy - auto_vacuum=NONE，按文本时间戳一次 DELETE 后整库 VACUUM（旧的 traceroute 清理方式）
+  chunked - auto_vacuum=INCREMENTAL，retention.purge_expired（epoch 索引、分块删除、增量回收）
+
+清理期间另一个线程像写入线程一样每隔 WRITER_INTERVAL 秒提交一行，记录单次提交的最长
+等待时间，即清理让探测结果的写入停顿了多久。最后再写入一轮并清理一次，测量日常维护的耗时。
+
+用法:
+  python benchmarks/bench_retention.py --days 14 --targets 100
+"""
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [REPO_DIR, BENCH_DIR]
+
+import db_writer
+import retention
+import run_benchmarks
+
+# 默认的数据天数、每轮目标数和探测间隔（秒）
+DEFAULT_DAYS = 14
+DEFAULT_TARGETS = 100
+DEFAULT_INTERVAL = 600
+# 模拟写入线程的提交间隔（秒）
+WRITER_INTERVAL = 0.005
+
+
+class WriterProbe(threading.Thread):
+    """模拟写入线程：不断提交单行写入，记录单次提交的最长耗时"""
+
+    def __init__(self, db_file):
+        super().__init__(daemon=True)
+        self.db_file = db_file
+        self.stop = threading.Event()
+        self.max_stall = 0.0
+        self.commits = 0
+
+    def run(self):
+        conn = db_writer.configure_connection(
+            sqlite3.connect(self.db_file, timeout=db_writer.BUSY_TIMEOUT, isolation_level=None)
+        )
+        while not self.stop.is_set():
+            started = time.perf_counter()
+            conn.execute("INSERT INTO ping_results (ip, region, timestamp, success) VALUES ('192.0.2.1', 'bench', ?, 0)",
+                         (datetime.datetime.now().strftime(retention.TIMESTAMP_FORMAT),))
+            self.max_stall = max(self.max_stall, time.perf_counter() - started)
+            self.commits += 1
+            time.sleep(WRITER_INTERVAL)
+        conn.close()
+
+
+def seed(db_file, days, targets, interval, now):
+    """写入 days 天的模拟结果（通过 ping_monitor，包括预聚合表）"""
+    import ping_monitor
+
+    ping_monitor.logger.setLevel("WARNING")
+    ping_monitor.DB_FILE = db_file
+    ping_monitor.init_database()
+    ips = run_benchmarks.synthetic_ips(targets)
+    start = now - datetime.timedelta(days=days)
+    rounds = int(days * 86400 / interval)
+    for i in range(rounds):
+        timestamp = (start + datetime.timedelta(seconds=i * interval)).strftime(retention.TIMESTAMP_FORMAT)
+        ping_monitor.save_results_to_db(run_benchmarks.synthetic_ping_results(ips, timestamp))
+    db_writer.close_writer(db_file)
+    return rounds * targets
+
+
+def legacy_cleanup(db_file, days, now):
+    """旧方式：按文本时间戳一次删除，然后整库 VACUUM"""
+    conn = sqlite3.connect(db_file, timeout=db_writer.BUSY_TIMEOUT)
+    cutoff = (now - datetime.timedelta(days=days)).strftime(retention.TIMESTAMP_FORMAT)
+    deleted = conn.execute("DELETE FROM ping_results WHERE timestamp < ?", (cutoff,)).rowcount
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+    return deleted
+
+
+def chunked_cleanup(db_file, days, now):
+    deleted, _pages = retention.purge_expired(db_file, ("ping_results",), days, retention.ROLLUP_RETENTION_DAYS, now)
+    return deleted.get("ping_results", 0)
+
+
+def measure(name, cleanup, db_file, days, now):
+    """在模拟写入的同时执行一次清理，返回耗时、删除行数、写入最长停顿和文件大小"""
+    writer = WriterProbe(db_file)
+    writer.start()
+    time.sleep(0.1)
+    started = time.perf_counter()
+    deleted = cleanup(db_file, days, now)
+    elapsed = time.perf_counter() - started
+    writer.stop.set()
+    writer.join()
+    conn = sqlite3.connect(db_file)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    result = {
+        "method": name,
+        "deleted": deleted,
+        "seconds": round(elapsed, 4),
+        "max_writer_stall_ms": round(writer.max_stall * 1000, 2),
+        "writer_commits": writer.commits,
+        "db_bytes": os.path.getsize(db_file),
+    }
+    print(f"  {name:8} 删除 {deleted:>8} 行  {elapsed * 1000:10.1f} ms  "
+          f"写入最长停顿 {writer.max_stall * 1000:8.1f} ms  文件 {result['db_bytes']:,} 字节")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='比较旧的数据清理方式和分块删除 + 增量回收')
+    parser.add_argument('--days', type=int, default=DEFAULT_DAYS, help=f'模拟数据的天数 (默认: {DEFAULT_DAYS})')
+    parser.add_argument('--targets', type=int, default=DEFAULT_TARGETS, help=f'每轮的目标数 (默认: {DEFAULT_TARGETS})')
+    parser.add_argument('--interval', type=int, default=DEFAULT_INTERVAL, help=f'探测间隔（秒） (默认: {DEFAULT_INTERVAL})')
+    parser.add_argument('--keep-days', type=int, default=retention.RAW_RETENTION_DAYS,
+                        help=f'保留天数 (默认: {retention.RAW_RETENTION_DAYS})')
+    parser.add_argument('--output', type=str, help='把结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    now = datetime.datetime.now().replace(microsecond=0)
+    report = {"days": args.days, "targets": args.targets, "interval": args.interval,
+              "keep_days": args.keep_days, "results": []}
+    with tempfile.TemporaryDirectory(prefix="retention-") as root:
+        # ping_monitor 在导入时创建日志文件，在临时目录中导入
+        os.chdir(root)
+        chunked_db = os.path.join(root, "chunked.db")
+        legacy_db = os.path.join(root, "legacy.db")
+        rows = seed(chunked_db, args.days, args.targets, args.interval, now)
+        shutil.copy(chunked_db, legacy_db)
+        conn = sqlite3.connect(legacy_db)
+        conn.execute("PRAGMA auto_vacuum=NONE")
+        conn.execute("VACUUM")
+        conn.close()
+        print(f"{rows} 行，数据库 {os.path.getsize(chunked_db):,} 字节，保留 {args.keep_days} 天")
+
+        print("首次清理（删除约一半的数据）:")
+        report["results"].append(measure("legacy", legacy_cleanup, legacy_db, args.keep_days, now))
+        report["results"].append(measure("chunked", chunked_cleanup, chunked_db, args.keep_days, now))
+
+        print(f"日常维护（时间前进 {args.interval} 秒，过期一轮）:")
+        later = now + datetime.timedelta(seconds=args.interval)
+        report["results"].append(measure("legacy", legacy_cleanup, legacy_db, args.keep_days, later))
+        report["results"].append(measure("chunked", chunked_cleanup, chunked_db, args.keep_days, later))
+        os.chdir(REPO_DIR)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+用一批 traceroute / tracert 输出比较新旧解析器的速度和准确性
+
+语料是一个目录，每个输出一个文件 <平台>-<名称>.txt（平台为 linux / darwin / windows），
+同名的 .json 为期望的解析结果 [{"hop", "ip", "rtts"}]；没有 .json 的文件只参与速度比较。
+不指定 --corpus 时在内存中生成语料，也可以用 --generate 把生成的语料写入目录，
+之后补充从真实设备保存的输出。
+
+生成的语料包含 -q 3 的多次探测、同一跳多个回复地址（等价路径）、macOS 的续行、
+IPv6 目标，以及一部分末尾带有采集时间行（如 "captured at 12:34:56"）的输出。
+
+准确性指标:
+  hop_accuracy  跳数和代表地址都正确的跳所占比例
+  rtt_recall    期望的往返时间中被解析出来的比例
+
+用法:
+  python benchmarks/bench_traceroute_parser.py --size 2000
+  python benchmarks/bench_traceroute_parser.py --generate corpus/ --size 500
+  python benchmarks/bench_traceroute_parser.py --corpus corpus/
+"""
+
+import argparse
+import collections
+import glob
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(BENCH_DIR), BENCH_DIR]
+
+import fake_outputs
+import legacy_traceroute_parser
+import traceroute_parser
+
+# 生成语料的默认大小、跳数、每跳探测次数、丢包率和等价路径比例
+DEFAULT_SIZE = 2000
+CORPUS_HOPS = 16
+CORPUS_QUERIES = 3
+CORPUS_LOSS = 0.15
+CORPUS_ECMP = 0.1
+# 带采集时间行的输出所占比例（每 N 个中 1 个）
+ANNOTATED_EVERY = 5
+# 每个解析器测量的最短时间（秒）
+MIN_TIME = 0.5
+
+
+def corpus_targets(size):
+    for i in range(size):
+        if i % 4 == 3:
+            yield f"2001:db8:ffff::{i:x}"
+        else:
+            yield f"198.18.{i // 250}.{i % 250 + 1}"
+
+
+def generate_corpus(size):
+    """生成 [(平台, 名称, 输出, 期望结果)]"""
+    corpus = []
+    for i, target in enumerate(corpus_targets(size)):
+        os_type = fake_outputs.TRACEROUTE_PLATFORMS[i % len(fake_outputs.TRACEROUTE_PLATFORMS)]
+        path = fake_outputs.trace_hops(target, CORPUS_HOPS, CORPUS_LOSS, seed=i,
+                                       queries=CORPUS_QUERIES, ecmp=CORPUS_ECMP)
+        if i % 3 == 0:
+            # 没有到达目标：最后几跳都不回复
+            path = path[:-3] + [[(None, None)] * CORPUS_QUERIES] * 3
+        output = fake_outputs.traceroute_output(target, path, os_type)
+        if i % ANNOTATED_EVERY == 0:
+            output += f"captured at {i % 24:02d}:{i % 60:02d}:{(i * 7) % 60:02d}\n"
+        corpus.append((os_type, f"{i:05d}", output, fake_outputs.expected_hops(path, os_type)))
+    return corpus
+
+
+def write_corpus(corpus, directory):
+    os.makedirs(directory, exist_ok=True)
+    for os_type, name, output, expected in corpus:
+        base = os.path.join(directory, f"{os_type}-{name}")
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(output)
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump(expected, f, ensure_ascii=False)
+
+
+def read_corpus(directory):
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.txt"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        os_type = name.split("-", 1)[0]
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            output = f.read()
+        expected = None
+        if os.path.exists(os.path.splitext(path)[0] + ".json"):
+            with open(os.path.splitext(path)[0] + ".json", "r", encoding="utf-8") as f:
+                expected = json.load(f)
+        corpus.append((os_type, name, output, expected))
+    return corpus
+
+
+def legacy_parse(output, os_type):
+    # 旧解析器只区分 windows 和其他平台
+    return legacy_traceroute_parser.parse_traceroute_output(output, "windows" if os_type == "windows" else "linux")
+
+
+PARSERS = {
+    "legacy": legacy_parse,
+    "traceroute_parser": traceroute_parser.parse,
+}
+
+
+def measure(parse, corpus):
+    """连续解析整个语料至少 MIN_TIME 秒，返回每秒解析的输出数"""
+    rounds = 0
+    started = time.perf_counter()
+    while True:
+        for os_type, _name, output, _expected in corpus:
+            parse(output, os_type)
+        rounds += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= MIN_TIME:
+            return rounds * len(corpus) / elapsed
+
+
+def score(parse, corpus):
+    """与期望结果比较，返回 (hop_accuracy, rtt_recall, 出错的输出名称列表)"""
+    hops_total = hops_correct = rtts_total = rtts_found = 0
+    failures = []
+    for os_type, name, output, expected in corpus:
+        if expected is None:
+            continue
+        parsed = {hop["hop"]: hop for hop in parse(output, os_type)}
+        ok = len(parsed) == len(expected)
+        for want in expected:
+            got = parsed.get(want["hop"])
+            hops_total += 1
+            if got is not None and got["ip"] == want["ip"]:
+                hops_correct += 1
+            else:
+                ok = False
+            wanted = collections.Counter(want["rtts"])
+            found = collections.Counter(rtt for _address, rtt in (got or {}).get("probes", []) if rtt is not None)
+            rtts_total += sum(wanted.values())
+            rtts_found += sum((wanted & found).values())
+        if not ok:
+            failures.append(name)
+    return (hops_correct / hops_total if hops_total else None,
+            rtts_found / rtts_total if rtts_total else None,
+            failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='比较新旧 traceroute 输出解析器的速度和准确性')
+    parser.add_argument('--corpus', type=str, help='语料目录（*.txt 输出和可选的 *.json 期望结果）')
+    parser.add_argument('--generate', type=str, metavar='DIR', help='生成语料并写入目录后退出')
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE, help=f'生成的输出个数 (默认: {DEFAULT_SIZE})')
+    parser.add_argument('--output', type=str, help='把结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    if args.generate:
+        write_corpus(generate_corpus(args.size), args.generate)
+        print(f"已生成 {args.size} 个输出到 {args.generate}")
+        return 0
+
+    corpus = read_corpus(args.corpus) if args.corpus else generate_corpus(args.size)
+    if not corpus:
+        print("语料为空")
+        return 1
+    lines = sum(output.count("\n") for _os, _name, output, _expected in corpus)
+    print(f"语料: {len(corpus)} 个输出，共 {lines} 行")
+
+    report = {"corpus": args.corpus or f"generated:{args.size}", "outputs": len(corpus), "parsers": {}}
+    print(f"{'解析器':<20} {'outputs/s':>12} {'hop_accuracy':>14} {'rtt_recall':>12} {'出错输出':>10}")
+    for name, parse in PARSERS.items():
+        speed = measure(parse, corpus)
+        hop_accuracy, rtt_recall, failures = score(parse, corpus)
+        report["parsers"][name] = {
+            "outputs_per_sec": round(speed, 1),
+            "hop_accuracy": hop_accuracy,
+            "rtt_recall": rtt_recall,
+            "failed_outputs": len(failures),
+        }
+        fmt = lambda value: "-" if value is None else f"{value:.2%}"
+        print(f"{name:<20} {speed:>12,.0f} {fmt(hop_accuracy):>14} {fmt(rtt_recall):>12} {len(failures):>10}")
+
+    legacy, current = report["parsers"]["legacy"], report["parsers"]["traceroute_parser"]
+    print(f"速度比: {current['outputs_per_sec'] / legacy['outputs_per_sec']:.2f}x")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+用本机的多个进程模拟多个采集点，验证并测量增量同步
+
+每个代理（agent）和收集端（collector）各有一个临时目录和自己的 ping_data.db，全部通过
+ping_monitor.py 的命令行运行（与远程主机上的用法相同），只是地址都是 127.0.0.1。
+
+步骤:
+  1. 各代理写入 --rounds 轮、每轮 --targets 个目标的模拟结果
+  2. push: 收集端运行同步服务，各代理同时 --sync-push，检查各采集点的行数
+  3. 再次推送（没有新数据）和重复发送同一批次，检查没有重复行
+  4. 代理写入新的一轮后再推送，检查只传输新行
+  5. pull: 各代理运行同步服务，另一个收集端 --sync-pull 全部代理，检查行数
+
+输出每个阶段的耗时、行数/秒，以及增量批次（gzip 压缩后）与整个数据库文件的大小对比。
+
+用法:
+  python benchmarks/bench_vantage_sync.py --agents 3 --rounds 20 --targets 500
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+PING_MONITOR = os.path.join(REPO_DIR, "ping_monitor.py")
+sys.path[:0] = [REPO_DIR, BENCH_DIR]
+
+# 默认的代理数、每个代理的轮数和每轮目标数
+DEFAULT_AGENTS = 3
+DEFAULT_ROUNDS = 20
+DEFAULT_TARGETS = 500
+# 等待同步服务启动的最长时间（秒）
+SERVER_START_TIMEOUT = 30
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def seed(directory, vantage_id, rounds, targets, start_round=0):
+    """子进程入口：在 directory 的数据库中以 vantage_id 写入模拟结果"""
+    os.chdir(directory)
+    import run_benchmarks
+    import db_writer
+    import ping_monitor
+
+    ping_monitor.VANTAGE_ID = vantage_id
+    ping_monitor.init_database()
+    ips = run_benchmarks.synthetic_ips(targets)
+    base = datetime.datetime(2024, 1, 1)
+    for i in range(start_round, start_round + rounds):
+        timestamp = (base + datetime.timedelta(minutes=5 * i)).strftime("%Y-%m-%d %H:%M:%S")
+        ping_monitor.save_results_to_db(run_benchmarks.synthetic_ping_results(ips, timestamp))
+    db_writer.close_writer(ping_monitor.DB_FILE)
+
+
+def run_seed(directory, vantage_id, rounds, targets, start_round=0):
+    subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--seed", directory, "--vantage", vantage_id,
+         "--rounds", str(rounds), "--targets", str(targets), "--start-round", str(start_round)],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def ping_monitor_cmd(directory, *args, wait=True):
+    """在 directory 中运行 ping_monitor.py，wait 为假时返回进程对象"""
+    process = subprocess.Popen(
+        [sys.executable, PING_MONITOR] + list(args), cwd=directory,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    if not wait:
+        return process
+    _out, err = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"ping_monitor.py {' '.join(args)} 失败:\n{err.decode('utf-8', 'replace')[-2000:]}")
+    return process
+
+
+def start_server(directory, port, vantage_id=None):
+    """在 directory 中启动同步服务，等到端口可以访问后返回进程对象"""
+    args = ["--sync-port", str(port)]
+    if vantage_id:
+        args += ["--vantage", vantage_id]
+    process = ping_monitor_cmd(directory, *args, wait=False)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/sync/high-water", timeout=1).read()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError(f"同步服务启动失败:\n{process.stderr.read().decode('utf-8', 'replace')[-2000:]}")
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("同步服务启动超时")
+
+
+def stop_server(process):
+    process.terminate()
+    process.wait()
+
+
+def counts_by_vantage(directory):
+    conn = sqlite3.connect(os.path.join(directory, "ping_data.db"))
+    try:
+        return dict(conn.execute("SELECT vantage_id, COUNT(*) FROM ping_results GROUP BY vantage_id"))
+    finally:
+        conn.close()
+
+
+def delta_bytes(directory, after=0):
+    """本机 id 大于 after 的全部行按批次编码、gzip 压缩后的字节数"""
+    import vantage_sync
+
+    conn = sqlite3.connect(os.path.join(directory, "ping_data.db"))
+    try:
+        total = 0
+        while True:
+            batch = vantage_sync.read_batch(conn, "ping_results", after)
+            if not batch["rows"]:
+                return total
+            total += len(gzip.compress(json.dumps(batch, ensure_ascii=False, separators=(',', ':')).encode('utf-8')))
+            after = batch["high_water"]
+    finally:
+        conn.close()
+
+
+def check(condition, message, failures):
+    print(f"  {'通过' if condition else '失败'}: {message}")
+    if not condition:
+        failures.append(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='用本机的多个进程模拟多个采集点，验证并测量增量同步')
+    parser.add_argument('--agents', type=int, default=DEFAULT_AGENTS, help=f'代理数 (默认: {DEFAULT_AGENTS})')
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS, help=f'每个代理写入的轮数 (默认: {DEFAULT_ROUNDS})')
+    parser.add_argument('--targets', type=int, default=DEFAULT_TARGETS, help=f'每轮的目标数 (默认: {DEFAULT_TARGETS})')
+    parser.add_argument('--output', type=str, help='把结果写入 JSON 文件')
+    parser.add_argument('--seed', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--vantage', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--start-round', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed:
+        seed(args.seed, args.vantage, args.rounds, args.targets, args.start_round)
+        return 0
+
+    import vantage_sync
+
+    failures = []
+    report = {"agents": args.agents, "rounds": args.rounds, "targets": args.targets, "phases": {}}
+    rows_per_agent = args.rounds * args.targets
+    with tempfile.TemporaryDirectory(prefix="vantage-sync-") as root:
+        agents = []
+        for i in range(args.agents):
+            directory = os.path.join(root, f"agent-{i}")
+            os.makedirs(directory)
+            agents.append((f"agent-{i}", directory))
+        collector = os.path.join(root, "collector")
+        os.makedirs(collector)
+
+        print(f"写入模拟数据: {args.agents} 个代理，每个 {rows_per_agent} 行")
+        for vantage_id, directory in agents:
+            run_seed(directory, vantage_id, args.rounds, args.targets)
+        db_size = os.path.getsize(os.path.join(agents[0][1], "ping_data.db"))
+        batch_size = delta_bytes(agents[0][1])
+        report["db_bytes"] = db_size
+        report["delta_bytes"] = batch_size
+        print(f"  单个代理的数据库 {db_size:,} 字节，全部行的增量批次（gzip）{batch_size:,} 字节")
+
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        server = start_server(collector, port, "collector")
+        try:
+            print("push: 各代理同时推送到收集端")
+            started = time.perf_counter()
+            processes = [ping_monitor_cmd(directory, "--sync-push", url, wait=False) for _v, directory in agents]
+            for process in processes:
+                process.communicate()
+            elapsed = time.perf_counter() - started
+            total = rows_per_agent * args.agents
+            report["phases"]["push"] = {"rows": total, "seconds": round(elapsed, 3), "rows_per_sec": round(total / elapsed, 1)}
+            print(f"  {total} 行，{elapsed:.2f} 秒，{total / elapsed:,.0f} 行/秒")
+            counts = counts_by_vantage(collector)
+            check(all(counts.get(v) == rows_per_agent for v, _d in agents), f"每个采集点 {rows_per_agent} 行", failures)
+
+            print("重复同步")
+            ping_monitor_cmd(agents[0][1], "--sync-push", url)
+            conn = sqlite3.connect(os.path.join(agents[0][1], "ping_data.db"))
+            batch = vantage_sync.read_batch(conn, "ping_results", 0, 100)
+            conn.close()
+            vantage_sync.request_json(f"{url}/sync/batch", batch)
+            check(counts_by_vantage(collector) == counts, "再次推送和重复发送同一批次后行数不变", failures)
+
+            print("增量推送: 代理 0 新写入一轮")
+            run_seed(agents[0][1], agents[0][0], 1, args.targets, start_round=args.rounds)
+            state = vantage_sync.request_json(f"{url}/sync/high-water?vantage={agents[0][0]}")
+            new_bytes = delta_bytes(agents[0][1], state["tables"]["ping_results"])
+            started = time.perf_counter()
+            ping_monitor_cmd(agents[0][1], "--sync-push", url)
+            elapsed = time.perf_counter() - started
+            report["phases"]["incremental_push"] = {"rows": args.targets, "seconds": round(elapsed, 3), "delta_bytes": new_bytes}
+            print(f"  {args.targets} 行，{new_bytes:,} 字节，{elapsed:.2f} 秒（含进程启动）")
+            check(counts_by_vantage(collector).get(agents[0][0]) == rows_per_agent + args.targets, "只合并新的一轮", failures)
+        finally:
+            stop_server(server)
+
+        print("pull: 另一个收集端从各代理拉取")
+        puller = os.path.join(root, "puller")
+        os.makedirs(puller)
+        servers = []
+        try:
+            urls = []
+            for _vantage_id, directory in agents:
+                agent_port = free_port()
+                servers.append(start_server(directory, agent_port))
+                urls.append(f"http://127.0.0.1:{agent_port}")
+            pull_args = ["--vantage", "puller"]
+            for agent_url in urls:
+                pull_args += ["--sync-pull", agent_url]
+            started = time.perf_counter()
+            ping_monitor_cmd(puller, *pull_args)
+            elapsed = time.perf_counter() - started
+            total = rows_per_agent * args.agents + args.targets
+            report["phases"]["pull"] = {"rows": total, "seconds": round(elapsed, 3), "rows_per_sec": round(total / elapsed, 1)}
+            print(f"  {total} 行，{elapsed:.2f} 秒，{total / elapsed:,.0f} 行/秒")
+            pulled = counts_by_vantage(puller)
+            ping_monitor_cmd(puller, *pull_args)
+            check(pulled == counts_by_vantage(collector), "拉取结果与推送结果一致", failures)
+            check(counts_by_vantage(puller) == pulled, "再次拉取后行数不变", failures)
+        finally:
+            for process in servers:
+                stop_server(process)
+
+    report["failures"] = failures
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print("全部检查通过" if not failures else f"{len(failures)} 项检查失败")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+模拟 ip-api 批量接口的本地 HTTP 服务
+
+POST /batch 接收 IP 列表，按顺序返回每个 IP 的查询结果，并带上 X-Rl / X-Ttl
+响应头；geo_service.GeoLookupService 的 batch_url 指向它即可在没有网络时测试
+traceroute 的完整流程。
+"""
+
+import http.server
+import json
+import threading
+
+
+class _GeoHandler(http.server.BaseHTTPRequestHandler):
+    server_ref = None
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            ips = json.loads(self.rfile.read(length) or b"[]")
+        except ValueError:
+            self.send_error(400)
+            return
+        self.server_ref.requests += 1
+        self.server_ref.queried += len(ips)
+        body = json.dumps([
+            {"status": "success", "country": "Benchland", "regionName": "Region", "city": f"City-{ip[-1]}", "query": ip}
+            for ip in ips
+        ]).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Rl", "1000")
+        self.send_header("X-Ttl", "60")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGeoServer:
+    """在后台线程中运行的假地理位置服务，requests / queried 统计收到的请求数和 IP 数"""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        handler = type("GeoHandler", (_GeoHandler,), {"server_ref": self})
+        self.httpd = http.server.ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.requests = 0
+        self.queried = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/batch"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-geo", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成与真实系统命令格式一致的 ping / traceroute 输出
+
+桩命令（stubs/ping、stubs/traceroute）和解析基准共用这里的生成函数。输出格式：
+- ping: linux、macos、windows（英文）、windows_zh（中文"时间="）
+- traceroute: linux（traceroute -n -q N）、darwin（macOS，回复地址改变时另起一行）、
+  windows（tracert -d，中文系统）
+
+同一目标在相同参数下得到相同的路径，延迟和丢包按随机数种子生成。
+"""
+
+import random
+import zlib
+
+PING_PLATFORMS = ("linux", "macos", "windows", "windows_zh")
+TRACEROUTE_PLATFORMS = ("linux", "darwin", "windows")
+
+
+def _rng(target, seed):
+    return random.Random(zlib.crc32(f"{seed}:{target}".encode('utf-8')))
+
+
+def sample_rtts(target, count, loss=0.0, rtt=20.0, seed=0):
+    """每个探测序号的往返时间（毫秒），丢包为 None"""
+    rng = _rng(target, seed)
+    return [None if rng.random() < loss else max(0.05, rng.gauss(rtt, rtt * 0.1)) for _ in range(count)]
+
+
+def ping_output(target, rtts, platform="linux"):
+    """按平台格式生成一次 ping 的完整输出"""
+    count = len(rtts)
+    received = [x for x in rtts if x is not None]
+    lines = []
+    if platform in ("linux", "macos"):
+        first_seq = 0 if platform == "macos" else 1
+        if platform == "macos":
+            lines.append(f"PING {target} ({target}): 56 data bytes")
+        else:
+            lines.append(f"PING {target} ({target}) 56(84) bytes of data.")
+        for i, value in enumerate(rtts):
+            if value is None:
+                if platform == "macos":
+                    lines.append(f"Request timeout for icmp_seq {i + first_seq}")
+                continue
+            lines.append(f"64 bytes from {target}: icmp_seq={i + first_seq} ttl=55 time={value:.3f} ms")
+        lines.append("")
+        lines.append(f"--- {target} ping statistics ---")
+        loss = 100.0 * (count - len(received)) / count if count else 0.0
+        lines.append(f"{count} packets transmitted, {len(received)} received, {loss:.0f}% packet loss, time {count * 1000}ms")
+        if received:
+            mean = sum(received) / len(received)
+            lines.append(f"rtt min/avg/max/mdev = {min(received):.3f}/{mean:.3f}/{max(received):.3f}/0.100 ms")
+        return "\n".join(lines) + "\n"
+
+    zh = platform == "windows_zh"
+    lines.append("")
+    lines.append(f"正在 Ping {target} 具有 32 字节的数据:" if zh else f"Pinging {target} with 32 bytes of data:")
+    for value in rtts:
+        if value is None:
+            lines.append("请求超时。" if zh else "Request timed out.")
+            continue
+        # Windows 只显示整数毫秒，这里保证至少 1ms，避免出现 "<1ms"
+        ms = max(1, int(round(value)))
+        if zh:
+            lines.append(f"来自 {target} 的回复: 字节=32 时间={ms}ms TTL=55")
+        else:
+            lines.append(f"Reply from {target}: bytes=32 time={ms}ms TTL=55")
+    lines.append("")
+    lost = count - len(received)
+    if zh:
+        lines.append(f"{target} 的 Ping 统计信息:")
+        lines.append(f"    数据包: 已发送 = {count}，已接收 = {len(received)}，丢失 = {lost} ({100 * lost // max(count, 1)}% 丢失)，")
+    else:
+        lines.append(f"Ping statistics for {target}:")
+        lines.append(f"    Packets: Sent = {count}, Received = {len(received)}, Lost = {lost} ({100 * lost // max(count, 1)}% loss),")
+    return "\n".join(lines) + "\n"
+
+
+def hop_address(target, hop, seed=0):
+    """目标路径上第 hop 跳的地址（与目标地址族相同）"""
+    value = zlib.crc32(f"{seed}:{target}:{hop}".encode('utf-8'))
+    if ":" in target:
+        return f"2001:db8:{hop:x}::{value & 0xFFFF:x}:{value >> 16:x}"
+    if hop == 1:
+        return "192.168.1.1"
+    return f"{10 + value % 200}.{(value >> 8) & 0xFF}.{(value >> 16) & 0xFF}.{1 + (value >> 24) % 254}"
+
+
+def trace_hops(target, hops=12, loss=0.0, rtt=20.0, seed=0, queries=1, ecmp=0.0):
+    """目标路径上各跳每次探测的 [(回复地址, 往返时间), ...]，没有回复的探测为 (None, None)
+
+    loss 为中间跳完全不回复的比例（每次探测另外按 loss/3 丢失），ecmp 为某次探测由
+    同一跳的另一台路由器回复的比例。最后一跳是目标本身。
+    """
+    rng = _rng(target, seed)
+    path = []
+    for hop in range(1, hops + 1):
+        last = hop == hops
+        if not last and rng.random() < loss:
+            path.append([(None, None)] * queries)
+            continue
+        address = target if last else hop_address(target, hop, seed)
+        probes = []
+        for _ in range(queries):
+            if not last and rng.random() < loss / 3:
+                probes.append((None, None))
+                continue
+            responder = address
+            if not last and rng.random() < ecmp:
+                responder = hop_address(target, hop, seed + 1)
+            probes.append((responder, max(0.05, rtt * hop / hops + rng.gauss(0, rtt * 0.05))))
+        path.append(probes)
+    return path
+
+
+def windows_rtt(value):
+    """tracert 显示的往返时间：整数毫秒，不足 1 毫秒显示为 <1"""
+    ms = int(round(value))
+    return "<1 毫秒" if ms < 1 else f"{ms} ms"
+
+
+def traceroute_output(target, path, platform="linux", max_hops=30):
+    """按平台格式生成一次 traceroute / tracert 的完整输出
+
+    linux 同一跳的不同回复地址写在同一行，darwin 另起一行，windows 每跳固定显示各次探测
+    的往返时间，行末为最后一个回复的地址。
+    """
+    lines = []
+    if platform in ("linux", "darwin"):
+        size = "60 byte" if platform == "linux" else "52 byte"
+        lines.append(f"traceroute to {target} ({target}), {max_hops} hops max, {size} packets")
+        for hop, probes in enumerate(path, 1):
+            line = f"{hop:2d} "
+            printed = None
+            for address, value in probes:
+                if address is None:
+                    line += " *"
+                    continue
+                if address != printed:
+                    if printed is not None and platform == "darwin":
+                        lines.append(line)
+                        line = "   "
+                    line += f" {address}"
+                    printed = address
+                line += f"  {value:.3f} ms"
+            lines.append(line)
+        return "\n".join(lines) + "\n"
+
+    lines.append("")
+    lines.append(f"通过最多 {max_hops} 个跃点跟踪到 {target} 的路由")
+    lines.append("")
+    for hop, probes in enumerate(path, 1):
+        cells = "".join(f"{'*' if value is None else windows_rtt(value):>9}" for _address, value in probes)
+        responders = [address for address, _value in probes if address is not None]
+        lines.append(f"{hop:3d}{cells}  {responders[-1] if responders else '请求超时。'}")
+    lines.append("")
+    lines.append("跟踪完成。")
+    return "\n".join(lines) + "\n"
+
+
+def expected_hops(path, platform="linux"):
+    """输出中应解析出的各跳：[{"hop", "ip", "rtts"}]，ip 为第一个回复的地址，rtts 为显示的往返时间"""
+    expected = []
+    for hop, probes in enumerate(path, 1):
+        responders = [address for address, _value in probes if address is not None]
+        if platform == "windows":
+            # tracert 只显示最后一个回复的地址
+            ip = responders[-1] if responders else "*"
+            rtts = [0.5 if round(value) < 1 else float(int(round(value))) for _a, value in probes if value is not None]
+        else:
+            ip = responders[0] if responders else "*"
+            rtts = [round(value, 3) for _a, value in probes if value is not None]
+        expected.append({"hop": hop, "ip": ip, "rtts": rtts})
+    return expected
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+traceroute_parser 之前 traceroute_monitor 使用的解析器，仅供基准测试对比
+
+每行用 re.match 取跳数，再对整行依次做 IPv6、IPv4 的 findall；宽松的 IPv6
+正则会把 "12:34" 这样的时间当作地址，也不解析往返时间。
+"""
+
+import re
+
+IPV4_REGEX = re.compile(r'\b(?:\d{1,3}\.){3}\d{1,3}\b')
+IPV6_REGEX = re.compile(r'([a-fA-F0-9:]+:+[a-fA-F0-9:]+)')
+
+
+def iter_traceroute_hops(lines, os_type):
+    """逐行解析traceroute/tracert的输出，每完成一跳就产出该跳 (支持 IPv4 和 IPv6)
+
+    lines 可以是任意行迭代器（例如仍在运行的进程的输出）；一跳在下一跳开始或输出结束时产出，
+    调用方可以在整个命令结束前就开始处理已发现的跳。
+    """
+    current = None # 当前跳的条目
+    current_hop_num = 0
+    first_line = True
+
+    for line in lines:
+        line = line.strip()
+        if first_line:
+            first_line = False
+            # Linux traceroute 通常第一行是标题
+            if os_type == "linux" and "traceroute to" in line:
+                continue
+        if not line:
+            continue
+
+        hop_num_match = re.match(r'^\s*(\d+)', line)
+        if hop_num_match and int(hop_num_match.group(1)) != current_hop_num:
+            # 新的一跳开始，上一跳已经完整
+            if current is not None:
+                yield current
+            current = None
+            current_hop_num = int(hop_num_match.group(1))
+
+        # 查找行中的所有 IPv4 和 IPv6 地址
+        # 优先查找 IPv6
+        ips_found = IPV6_REGEX.findall(line)
+        if not ips_found:
+            # 如果没找到 IPv6，再查找 IPv4
+            ips_found = IPV4_REGEX.findall(line)
+
+        # Windows tracert 的标题行等出现在第一跳之前，跳数为 0，忽略
+        if current_hop_num <= 0:
+            continue
+
+        if "*" in line and not ips_found:
+            # 超时或请求无法到达
+            if current is None:
+                current = {"hop": current_hop_num, "ip": "*", "location": "请求超时"}
+            continue
+
+        # 通常一行只关心一个IP，取找到的最后一个作为代表
+        if ips_found:
+            if current is None:
+                current = {"hop": current_hop_num, "ip": ips_found[-1], "location": "查询中..."}
+            elif current["ip"] == "*":
+                # 如果现有条目是超时 "*", 则替换它；已有有效IP时保留第一个
+                current["ip"] = ips_found[-1]
+
+    if current is not None:
+        yield current
+
+def parse_traceroute_output(output, os_type):
+    """解析traceroute/tracert命令的完整输出，提取IP地址 (支持 IPv4 和 IPv6)"""
+    return list(iter_traceroute_hops(output.strip().splitlines(), os_type))
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+探测、解析和存储热路径的基准测试
+
+每个场景和规模在独立的子进程中运行（工作目录为临时目录，PATH 最前面是
+stubs/ 中的假 ping / traceroute），不需要网络，也不会修改仓库中的数据库和配置。
+地理位置查询由本地的假 ip-api 服务回答。
+
+场景:
+  parse_ping             parse_ping_output 解析各平台的 ping 输出（outputs/s）
+  parse_traceroute       traceroute_parser 解析 traceroute / tracert 输出（outputs/s）
+  ping_round             run_ping_test 使用系统 ping 引擎完整跑一轮（targets/s）
+  ping_round_sharded     同上，目标按IP分给 BENCH_SHARD_WORKERS 个工作进程（targets/s）
+  traceroute_round       traceroute_monitor.main 使用系统命令引擎完整跑一轮（targets/s）
+  db_ping_insert         save_results_to_db 写入一轮 ping 结果（rows/s）
+  db_traceroute_insert   save_traceroute_results_to_db 写入一轮 traceroute 结果（rows/s）
+
+用法:
+  python benchmarks/run_benchmarks.py --sizes 10,100,1000 --output results.json
+  python benchmarks/run_benchmarks.py --quick --compare baseline.json --threshold 0.2
+
+--compare 时任一结果比基线慢超过 threshold（比例）则以返回码 1 退出。
+依赖没有安装（例如 traceroute_monitor 需要 requests）的场景记为 skipped。
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STUB_DIR = os.path.join(BENCH_DIR, "stubs")
+
+# 结果文件格式版本
+RESULT_SCHEMA = 1
+# 默认规模（目标数 / 输出条数）
+DEFAULT_SIZES = (10, 100, 1000)
+QUICK_SIZES = (10, 50)
+# 每个场景重复执行的次数，取最快的一次
+REPEATS = 3
+# 解析场景每次测量的最短时间（秒）
+PARSE_MIN_TIME = 0.2
+# 单个场景子进程的超时时间（秒）
+WORKER_TIMEOUT = 600
+# 模拟 ping 的每轮包数和丢包率
+BENCH_PING_COUNT = 10
+BENCH_LOSS = 0.1
+# 分片场景的工作进程数
+BENCH_SHARD_WORKERS = 4
+# 模拟路径的跳数和每跳探测次数
+BENCH_HOPS = 12
+BENCH_TRACE_QUERIES = 3
+# 子进程输出结果行的前缀
+RESULT_MARKER = "BENCH_RESULT "
+
+
+def synthetic_ips(size):
+    """size 个保留地址段中的目标，每 4 个中有 1 个 IPv6"""
+    ips = []
+    for i in range(size):
+        if i % 4 == 3:
+            ips.append(f"2001:db8::{i:x}")
+        else:
+            ips.append(f"198.18.{i // 250}.{i % 250 + 1}")
+    return ips
+
+
+def write_ip_config(ips):
+    with open("ip_config.json", "w", encoding="utf-8") as f:
+        json.dump([{"ip": ip, "region": f"Bench-{i}"} for i, ip in enumerate(ips)], f)
+
+
+def best_of(func, repeats=REPEATS, min_time=0.0):
+    """重复执行 func，返回单次调用最短的耗时（秒）
+
+    min_time 大于 0 时每次测量连续调用到至少 min_time 秒再取平均，减少计时误差。
+    """
+    best = None
+    for _ in range(repeats):
+        calls = 0
+        started = time.perf_counter()
+        while True:
+            func()
+            calls += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= min_time:
+                break
+        elapsed /= calls
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def rate(name, params, metric, amount, elapsed):
+    return {"name": name, "params": params, "metric": metric,
+            "value": round(amount / elapsed, 3) if elapsed > 0 else None, "elapsed": round(elapsed, 6)}
+
+
+# --- 场景（在子进程中执行，工作目录为临时目录） ---
+
+def bench_parse_ping(size):
+    import fake_outputs
+    import ping_monitor
+
+    results = []
+    for os_type in fake_outputs.PING_PLATFORMS:
+        first_seq = 0 if os_type == "macos" else 1
+        outputs = [
+            fake_outputs.ping_output(ip, fake_outputs.sample_rtts(ip, BENCH_PING_COUNT, BENCH_LOSS), os_type)
+            for ip in synthetic_ips(size)
+        ]
+
+        def run():
+            for output in outputs:
+                ping_monitor.parse_ping_output(output, BENCH_PING_COUNT, first_seq)
+
+        elapsed = best_of(run, min_time=PARSE_MIN_TIME)
+        results.append(rate("parse_ping", {"size": size, "platform": os_type}, "outputs_per_sec", size, elapsed))
+    return results
+
+
+def bench_parse_traceroute(size):
+    import fake_outputs
+    import traceroute_parser
+
+    results = []
+    for os_type in fake_outputs.TRACEROUTE_PLATFORMS:
+        outputs = [
+            fake_outputs.traceroute_output(
+                ip, fake_outputs.trace_hops(ip, BENCH_HOPS, BENCH_LOSS, queries=BENCH_TRACE_QUERIES), os_type
+            )
+            for ip in synthetic_ips(size)
+        ]
+        hops = sum(len(traceroute_parser.parse(output, os_type)) for output in outputs)
+
+        def run():
+            for output in outputs:
+                traceroute_parser.parse(output, os_type)
+
+        elapsed = best_of(run, min_time=PARSE_MIN_TIME)
+        results.append(rate("parse_traceroute", {"size": size, "platform": os_type}, "outputs_per_sec", size, elapsed))
+        results.append(rate("parse_traceroute", {"size": size, "platform": os_type}, "hops_per_sec", hops, elapsed))
+    return results
+
+
+def timed_ping_round(size, workers=0):
+    import ping_monitor
+
+    write_ip_config(synthetic_ips(size))
+    ping_monitor.PROBE_ENGINE = "subprocess"
+    ping_monitor.PING_COUNT = BENCH_PING_COUNT
+    ping_monitor.SHARD_WORKERS = workers
+    ping_monitor.load_ip_config()
+    # 第一轮包含建表，单独执行不计时
+    ping_monitor.run_ping_test()
+    return best_of(ping_monitor.run_ping_test, repeats=1)
+
+
+def bench_ping_round(size):
+    elapsed = timed_ping_round(size)
+    return [rate("ping_round", {"size": size, "engine": "subprocess"}, "targets_per_sec", size, elapsed)]
+
+
+def bench_ping_round_sharded(size):
+    elapsed = timed_ping_round(size, BENCH_SHARD_WORKERS)
+    params = {"size": size, "engine": "subprocess", "workers": BENCH_SHARD_WORKERS}
+    return [rate("ping_round_sharded", params, "targets_per_sec", size, elapsed)]
+
+
+def bench_traceroute_round(size):
+    import fake_geo_server
+    import geo_service
+    import traceroute_monitor
+
+    write_ip_config(synthetic_ips(size))
+    server = fake_geo_server.FakeGeoServer().start()
+    try:
+        traceroute_monitor._geo_service = geo_service.GeoLookupService(
+            cache=traceroute_monitor.get_geo_cache(), batch_url=server.url, requests_per_minute=60000
+        )
+        sys.argv = ["traceroute_monitor.py", "--engine", "subprocess", "--cleanup-days", "0"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            traceroute_monitor.main()
+            elapsed = time.perf_counter() - started
+    finally:
+        server.stop()
+    params = {"size": size, "engine": "subprocess", "geo_requests": server.requests}
+    return [rate("traceroute_round", params, "targets_per_sec", size, elapsed)]
+
+
+def synthetic_ping_results(ips, timestamp):
+    import fake_outputs
+    import ping_monitor
+
+    results = []
+    for ip in ips:
+        result = ping_monitor.parse_ping_output(
+            fake_outputs.ping_output(ip, fake_outputs.sample_rtts(ip, BENCH_PING_COUNT, BENCH_LOSS)), BENCH_PING_COUNT
+        )
+        results.append(ping_monitor.handle_ping_result(ip, result, timestamp, BENCH_PING_COUNT))
+    return results
+
+
+def bench_db_ping_insert(size):
+    import db_writer
+    import ping_monitor
+
+    ping_monitor.init_database()
+    ips = synthetic_ips(size)
+    base = datetime.datetime(2024, 1, 1)
+    # 每次测量写入不同时间戳的一轮结果，结果提前生成，只统计写入
+    batches = [
+        synthetic_ping_results(ips, (base + datetime.timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S"))
+        for i in range(REPEATS)
+    ]
+    elapsed = best_of(lambda: ping_monitor.save_results_to_db(batches.pop()))
+    db_writer.close_writer(ping_monitor.DB_FILE)
+    return [rate("db_ping_insert", {"size": size}, "rows_per_sec", size, elapsed)]
+
+
+def bench_db_traceroute_insert(size):
+    import db_writer
+    import fake_outputs
+    import traceroute_monitor
+
+    traceroute_monitor.init_traceroute_database()
+    results = []
+    for ip in synthetic_ips(size):
+        hops = []
+        for hop, probes in enumerate(fake_outputs.trace_hops(ip, BENCH_HOPS, BENCH_LOSS), 1):
+            address, value = probes[0]
+            hops.append({"hop": hop, "ip": address or "*", "location": "Benchland", "rtt": value})
+        results.append({"target": ip, "hops": hops, "error": None})
+
+    elapsed = best_of(lambda: traceroute_monitor.save_traceroute_results_to_db(results))
+    db_writer.close_writer(traceroute_monitor.DB_FILE)
+    return [rate("db_traceroute_insert", {"size": size}, "rows_per_sec", size, elapsed)]
+
+
+SCENARIOS = {
+    "parse_ping": bench_parse_ping,
+    "parse_traceroute": bench_parse_traceroute,
+    "ping_round": bench_ping_round,
+    "ping_round_sharded": bench_ping_round_sharded,
+    "traceroute_round": bench_traceroute_round,
+    "db_ping_insert": bench_db_ping_insert,
+    "db_traceroute_insert": bench_db_traceroute_insert,
+}
+
+
+def run_worker(name, size):
+    """子进程入口：执行一个场景并把结果作为一行 JSON 输出"""
+    sys.path[:0] = [REPO_DIR, BENCH_DIR]
+    try:
+        # 被测代码的打印输出不应混入结果行
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = SCENARIOS[name](size)
+    except ImportError as e:
+        results = [{"name": name, "params": {"size": size}, "metric": None, "value": None,
+                    "skipped": f"缺少依赖: {e.name or str(e)}"}]
+    print(RESULT_MARKER + json.dumps(results, ensure_ascii=False))
+
+
+# --- 调度、输出和比较 ---
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def spawn_worker(name, size):
+    env = dict(os.environ)
+    env["PATH"] = STUB_DIR + os.pathsep + env.get("PATH", "")
+    env["BENCH_STUB_LOSS"] = str(BENCH_LOSS)
+    env["BENCH_STUB_HOPS"] = str(BENCH_HOPS)
+    with tempfile.TemporaryDirectory(prefix=f"bench-{name}-") as workdir:
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", name, str(size)],
+            cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, timeout=WORKER_TIMEOUT,
+        )
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    tail = proc.stderr.strip().splitlines()[-5:]
+    return [{"name": name, "params": {"size": size}, "metric": None, "value": None,
+             "error": f"返回码 {proc.returncode}: " + " | ".join(tail)}]
+
+
+def result_key(result):
+    return (result["name"], result.get("metric"), json.dumps(
+        {k: v for k, v in result["params"].items() if k != "geo_requests"}, sort_keys=True))
+
+
+def compare(results, baseline_file, threshold):
+    """与基线比较，返回变慢超过 threshold 的结果描述列表"""
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = {result_key(r): r for r in json.load(f)["results"] if r.get("value")}
+    regressions = []
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None or not result.get("value"):
+            continue
+        change = result["value"] / old["value"] - 1
+        result["baseline"] = old["value"]
+        result["change"] = round(change, 4)
+        if change < -threshold:
+            regressions.append(f"{result['name']} {result['params']} {result['metric']}: "
+                               f"{old['value']} -> {result['value']} ({change:+.1%})")
+    return regressions
+
+
+def print_table(results):
+    print(f"{'场景':<22} {'参数':<40} {'指标':<18} {'数值':>14} {'变化':>8}")
+    print("-" * 106)
+    for r in results:
+        params = ", ".join(f"{k}={v}" for k, v in r["params"].items())
+        if r.get("value") is None:
+            print(f"{r['name']:<22} {params:<40} {r.get('skipped') or r.get('error', '')}")
+            continue
+        change = f"{r['change']:+.1%}" if "change" in r else ""
+        print(f"{r['name']:<22} {params:<40} {r['metric']:<18} {r['value']:>14,.1f} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='探测、解析和存储热路径的基准测试（使用假 ping/traceroute 和假地理位置服务）')
+    parser.add_argument('--sizes', type=str, default=",".join(map(str, DEFAULT_SIZES)),
+                        help=f'逗号分隔的规模列表 (默认: {",".join(map(str, DEFAULT_SIZES))})')
+    parser.add_argument('--quick', action='store_true', help=f'只运行小规模 ({",".join(map(str, QUICK_SIZES))})')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='只运行指定场景（可重复），默认运行全部')
+    parser.add_argument('--output', type=str, help='把结果写入 JSON 文件')
+    parser.add_argument('--compare', type=str, metavar='BASELINE', help='与基线结果文件比较')
+    parser.add_argument('--threshold', type=float, default=0.2, help='判定为性能下降的比例 (默认: 0.2)')
+    parser.add_argument('--worker', nargs=2, metavar=('SCENARIO', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker[0], int(args.worker[1]))
+        return 0
+
+    sizes = QUICK_SIZES if args.quick else [int(s) for s in args.sizes.split(",") if s.strip()]
+    results = []
+    for name in args.scenario or SCENARIOS:
+        for size in sizes:
+            print(f"运行 {name} (size={size})...", file=sys.stderr)
+            results.extend(spawn_worker(name, size))
+
+    regressions = compare(results, args.compare, args.threshold) if args.compare else []
+    print_table(results)
+
+    if args.output:
+        report = {
+            "schema": RESULT_SCHEMA,
+            "generated_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}", file=sys.stderr)
+
+    if regressions:
+        print(f"\n{len(regressions)} 项比基线慢 {args.threshold:.0%} 以上:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
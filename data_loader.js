@@ -0,0 +1,137 @@
+// 按日期范围加载数据分片（index.html 与 report.html 共用）
+//
+// ping_monitor.py 会把数据按天导出到 shards/ 目录，并生成 shards/manifest.json。
+// 页面只下载所选日期范围内的分片，把它们的数据合并到一个内存数据库中；
+// 没有清单文件时回退到下载完整的 ping_data.db。
+
+const SHARD_MANIFEST_URL = 'shards/manifest.json';
+
+// 读取分片清单，不存在时返回 null
+async function fetchShardManifest() {
+    try {
+        const response = await fetch(SHARD_MANIFEST_URL, { cache: 'no-cache' });
+        if (!response.ok) {
+            return null;
+        }
+        const manifest = await response.json();
+        return Array.isArray(manifest.shards) ? manifest : null;
+    } catch (error) {
+        console.warn('读取分片清单失败，改为加载完整数据库：', error);
+        return null;
+    }
+}
+
+// 下载完整的 ping_data.db
+async function fetchFullDatabase(SQL) {
+    const response = await fetch('ping_data.db');
+    if (!response.ok) {
+        throw new Error('无法加载数据库文件：' + response.statusText);
+    }
+    const arrayBuffer = await response.arrayBuffer();
+    const db = new SQL.Database(new Uint8Array(arrayBuffer));
+    dropMergedRows(db);
+    return db;
+}
+
+// 与数据分片一致，页面只显示本机的结果：删除内存副本中从其他采集点合并来的行
+// （source_id 不为空）。同一个 IP 在各采集点共用一个 ip 值，混在一起会让图表交替显示不同采集点
+function dropMergedRows(db) {
+    ['ping_results', 'traceroute_results'].forEach(table => {
+        const info = db.exec(`PRAGMA table_info(${table})`)[0];
+        if (info && info.values.some(row => row[1] === 'source_id')) {
+            db.run(`DELETE FROM ${table} WHERE source_id IS NOT NULL`);
+        }
+    });
+}
+
+// 计算相对于今天的日期字符串（YYYY-MM-DD，本地时间）
+function shardDateOffset(days) {
+    const date = new Date();
+    date.setDate(date.getDate() + days);
+    const pad = n => String(n).padStart(2, '0');
+    return `${date.getFullYear()}-${pad(date.getMonth() + 1)}-${pad(date.getDate())}`;
+}
+
+// 按日期范围（含两端，空值表示不限）过滤清单中的分片
+function selectShards(manifest, startDate, endDate) {
+    return manifest.shards.filter(shard =>
+        (!startDate || shard.date >= startDate) && (!endDate || shard.date <= endDate)
+    );
+}
+
+// 把一个分片中的表结构和数据复制到目标数据库
+function mergeShardInto(db, shardDb) {
+    const schema = shardDb.exec(
+        "SELECT type, name, tbl_name, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY type DESC"
+    )[0];
+    if (!schema) return;
+
+    schema.values.forEach(([type, name, tableName, sql]) => {
+        if (type === 'table') {
+            db.run(sql.replace(/^CREATE TABLE/i, 'CREATE TABLE IF NOT EXISTS'));
+        } else if (type === 'index') {
+            db.run(sql.replace(/^CREATE INDEX/i, 'CREATE INDEX IF NOT EXISTS'));
+        }
+    });
+
+    schema.values.filter(([type]) => type === 'table').forEach(([, tableName]) => {
+        const columns = shardDb.exec(`PRAGMA table_info(${tableName})`)[0].values.map(row => row[1]);
+        const placeholders = columns.map(() => '?').join(', ');
+        // 主键相同的行（例如重新加载当天的分片）保留最新版本
+        const insert = db.prepare(`INSERT OR REPLACE INTO ${tableName} (${columns.join(', ')}) VALUES (${placeholders})`);
+        const select = shardDb.prepare(`SELECT ${columns.join(', ')} FROM ${tableName}`);
+        db.run('BEGIN');
+        while (select.step()) {
+            insert.run(select.get());
+        }
+        db.run('COMMIT');
+        select.free();
+        insert.free();
+    });
+}
+
+// 分片加载器：记录已加载的分片，按需下载缺失的日期
+class ShardedDatabase {
+    constructor(SQL, manifest) {
+        this.SQL = SQL;
+        this.manifest = manifest;
+        this.db = new SQL.Database();
+        this.loaded = new Set();
+    }
+
+    // 清单中最早和最晚的日期
+    dateRange() {
+        const shards = this.manifest.shards;
+        if (shards.length === 0) return { minDate: null, maxDate: null };
+        return { minDate: shards[0].date, maxDate: shards[shards.length - 1].date };
+    }
+
+    // 确保日期范围内的分片都已加载，onProgress(已完成数, 总数) 可选
+    async ensureRange(startDate, endDate, onProgress) {
+        const pending = selectShards(this.manifest, startDate, endDate)
+            .filter(shard => !this.loaded.has(shard.file));
+        let done = 0;
+        // 并行下载，按顺序合并
+        const downloads = pending.map(shard =>
+            fetch(`shards/${shard.file}?v=${shard.hash}`).then(response => {
+                if (!response.ok) {
+                    throw new Error(`无法加载数据分片 ${shard.file}：${response.statusText}`);
+                }
+                return response.arrayBuffer();
+            })
+        );
+        for (let i = 0; i < pending.length; i++) {
+            const buffer = await downloads[i];
+            const shardDb = new this.SQL.Database(new Uint8Array(buffer));
+            try {
+                mergeShardInto(this.db, shardDb);
+            } finally {
+                shardDb.close();
+            }
+            this.loaded.add(pending[i].file);
+            done++;
+            if (onProgress) onProgress(done, pending.length);
+        }
+        return pending.length;
+    }
+}
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基于 SQLite 在线备份 API 的数据库快照
+
+快照通过 Connection.backup 分步复制（不阻塞其他写入者，也不会复制到写了一半的
+文件），压缩为 backups/ping_data_<时间戳>.db.gz。保留策略为：最近一天每小时保留
+一份、最近一个月每天保留一份，更早的快照自动删除，因此备份占用的空间只与保留
+周期有关，而与探测频率无关。
+"""
+
+import datetime
+import gzip
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import logging
+
+logger = logging.getLogger("ping_monitor")
+
+# 快照文件名前缀和时间格式
+SNAPSHOT_PREFIX = "ping_data_"
+SNAPSHOT_TIME_FORMAT = "%Y%m%d_%H%M%S"
+SNAPSHOT_PATTERN = re.compile(r'^ping_data_(\d{8}_\d{6})\.db(\.gz)?$')
+# 每小时保留一份快照的时长（小时）
+HOURLY_RETENTION_HOURS = 24
+# 每天保留一份快照的时长（天）
+DAILY_RETENTION_DAYS = 30
+# 两次快照之间的最短间隔（秒），到期前的 --backup 调用会直接跳过
+MIN_BACKUP_INTERVAL = 3600
+# 在线备份每一步复制的页数，以及步与步之间让出锁的时间（秒）
+BACKUP_PAGES_PER_STEP = 1024
+BACKUP_STEP_SLEEP = 0.005
+
+
+def list_snapshots(backup_dir):
+    """列出备份目录中的快照，返回按时间升序排列的 [(时间, 路径)]"""
+    if not os.path.isdir(backup_dir):
+        return []
+    snapshots = []
+    for name in os.listdir(backup_dir):
+        match = SNAPSHOT_PATTERN.match(name)
+        if not match:
+            continue
+        taken_at = datetime.datetime.strptime(match.group(1), SNAPSHOT_TIME_FORMAT)
+        snapshots.append((taken_at, os.path.join(backup_dir, name)))
+    snapshots.sort()
+    return snapshots
+
+
+def create_snapshot(db_file, backup_dir, now=None):
+    """使用在线备份 API 创建压缩快照，返回快照路径"""
+    now = now or datetime.datetime.now()
+    os.makedirs(backup_dir, exist_ok=True)
+    target = os.path.join(backup_dir, f"{SNAPSHOT_PREFIX}{now.strftime(SNAPSHOT_TIME_FORMAT)}.db.gz")
+
+    fd, raw_path = tempfile.mkstemp(suffix=".db", dir=backup_dir)
+    os.close(fd)
+    try:
+        src = sqlite3.connect(db_file)
+        dst = sqlite3.connect(raw_path)
+        try:
+            src.backup(dst, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP)
+        finally:
+            dst.close()
+            src.close()
+
+        # 先写入临时文件再重命名，避免留下不完整的快照
+        partial = target + ".part"
+        with open(raw_path, 'rb') as f_in, gzip.open(partial, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.replace(partial, target)
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+    return target
+
+
+def select_snapshots_to_keep(snapshots, now=None):
+    """按保留策略选出需要保留的快照路径
+
+    最近 HOURLY_RETENTION_HOURS 小时内每小时保留最新的一份，最近
+    DAILY_RETENTION_DAYS 天内每天保留最新的一份，最新的一份始终保留。
+    """
+    now = now or datetime.datetime.now()
+    hourly_cutoff = now - datetime.timedelta(hours=HOURLY_RETENTION_HOURS)
+    daily_cutoff = now - datetime.timedelta(days=DAILY_RETENTION_DAYS)
+
+    keep = set()
+    hourly = {}
+    daily = {}
+    # 快照按时间升序排列，后出现的覆盖同一时间段内较早的
+    for taken_at, path in snapshots:
+        if taken_at >= hourly_cutoff:
+            hourly[taken_at.strftime("%Y%m%d%H")] = path
+        if taken_at >= daily_cutoff:
+            daily[taken_at.strftime("%Y%m%d")] = path
+    keep.update(hourly.values())
+    keep.update(daily.values())
+    if snapshots:
+        keep.add(snapshots[-1][1])
+    return keep
+
+
+def prune_snapshots(backup_dir, now=None):
+    """删除不在保留策略内的快照，返回删除的数量"""
+    snapshots = list_snapshots(backup_dir)
+    keep = select_snapshots_to_keep(snapshots, now)
+    removed = 0
+    for _taken_at, path in snapshots:
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError as e:
+            logger.warning(f"删除旧备份 {path} 失败: {str(e)}")
+    return removed
+
+
+def backup_if_due(db_file, backup_dir, min_interval=MIN_BACKUP_INTERVAL, now=None):
+    """距离上一份快照超过 min_interval 秒时创建新快照并执行保留策略
+
+    返回新快照路径，未到期时返回 None。
+    """
+    now = now or datetime.datetime.now()
+    snapshots = list_snapshots(backup_dir)
+    if snapshots and (now - snapshots[-1][0]).total_seconds() < min_interval:
+        logger.info(f"距上次备份不足 {min_interval} 秒，跳过备份")
+        return None
+    path = create_snapshot(db_file, backup_dir, now)
+    removed = prune_snapshots(backup_dir, now)
+    logger.info(f"数据库备份成功: {path}，清理旧备份 {removed} 个")
+    return path
+
+
+def restore_snapshot(snapshot_path, db_file):
+    """将快照恢复到数据库文件（通过在线备份 API 写入，正在运行的读取者不会读到半个文件）"""
+    if not os.path.exists(snapshot_path):
+        raise FileNotFoundError(f"备份文件 {snapshot_path} 不存在")
+
+    fd, raw_path = tempfile.mkstemp(suffix=".db", dir=os.path.dirname(os.path.abspath(db_file)))
+    os.close(fd)
+    try:
+        if snapshot_path.endswith(".gz"):
+            with gzip.open(snapshot_path, 'rb') as f_in, open(raw_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        else:
+            shutil.copyfile(snapshot_path, raw_path)
+
+        src = sqlite3.connect(raw_path)
+        dst = sqlite3.connect(db_file)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
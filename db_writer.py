@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ping_data.db 的单一写入线程
+
+ping_monitor.py 和 traceroute_monitor.py 都通过这里写入数据库：一个后台线程
+持有唯一的 WAL 模式连接，从队列中取出写入请求，把同一时间段内排队的所有请求
+合并到一个事务里用 executemany 提交。一轮探测只产生一次 fsync，两个工具并发
+运行时也不会再出现 "database is locked"。
+"""
+
+import concurrent.futures
+import queue
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger("ping_monitor")
+
+# 等待锁的超时时间（秒），另一个进程正在写入时会在此时间内重试
+BUSY_TIMEOUT = 30
+# 单个事务最多合并的写入请求数
+MAX_BATCH_REQUESTS = 500
+# 两次主动 WAL 检查点的最短间隔（秒），与常驻模式导出数据分片的间隔一致；
+# 间隔内由 SQLite 的 wal_autocheckpoint（默认 1000 页）按 WAL 大小检查点
+CHECKPOINT_INTERVAL = 60
+# 队列关闭标记
+_STOP = object()
+
+# 数据库文件 -> DBWriter，同一进程内共享
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def configure_connection(conn):
+    """为连接设置 WAL 模式和并发相关参数"""
+    # 新建的数据库启用增量回收（必须在切换 WAL 和建表之前设置，对已有数据库没有影响，见 retention.py）
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WAL 模式下 NORMAL 已能保证数据库一致性，且每个事务只在检查点时 fsync
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT * 1000}")
+    return conn
+
+
+class DBWriter(threading.Thread):
+    """持有单个连接、按批次提交写入请求的后台线程"""
+
+    def __init__(self, db_file):
+        super().__init__(name=f"db-writer-{db_file}", daemon=True)
+        self.db_file = db_file
+        self._queue = queue.Queue()
+        self._conn = None
+        # 连接初始化完成（或失败）后置位
+        self._ready = threading.Event()
+        self._init_error = None
+        self._last_checkpoint = time.monotonic()
+
+    def run(self):
+        try:
+            self._conn = configure_connection(
+                sqlite3.connect(self.db_file, timeout=BUSY_TIMEOUT, isolation_level=None)
+            )
+        except Exception as e:
+            self._init_error = e
+            self._ready.set()
+            logger.error(f"数据库写入线程初始化失败: {str(e)}")
+            return
+        self._ready.set()
+
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            # 取出当前已排队的全部请求，合并为一个事务
+            while len(batch) < MAX_BATCH_REQUESTS:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+                batch = [item for item in batch if item is not _STOP]
+            if batch:
+                self._commit_batch(batch)
+
+        self._conn.close()
+
+    def _commit_batch(self, batch):
+        """在一个事务中执行一批写入请求"""
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+            for statements, _future in batch:
+                for sql, rows in statements:
+                    self._conn.executemany(sql, rows)
+            self._conn.execute("COMMIT")
+        except Exception as e:
+            logger.error(f"批量写入数据库失败，改为逐条提交: {str(e)}")
+            if self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            # 逐个请求重试，只让出错的请求失败
+            for item in batch:
+                self._commit_one(item)
+            return
+
+        for statements, future in batch:
+            future.set_result(sum(len(rows) for _sql, rows in statements))
+        self._checkpoint_if_due()
+
+    def _checkpoint_if_due(self):
+        """距上次检查点超过 CHECKPOINT_INTERVAL 秒时把 WAL 同步回主数据库文件
+
+        浏览器直接下载 ping_data.db 时最多落后 CHECKPOINT_INTERVAL 秒；关闭最后一个连接时
+        SQLite 会再做一次检查点。
+        """
+        now = time.monotonic()
+        if now - self._last_checkpoint < CHECKPOINT_INTERVAL:
+            return
+        self._last_checkpoint = now
+        try:
+            self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        except sqlite3.Error as e:
+            logger.debug(f"WAL 检查点失败: {str(e)}")
+
+    def _commit_one(self, item):
+        statements, future = item
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+            for sql, rows in statements:
+                self._conn.executemany(sql, rows)
+            self._conn.execute("COMMIT")
+            future.set_result(sum(len(rows) for _sql, rows in statements))
+        except Exception as e:
+            if self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            future.set_exception(e)
+
+    def submit_group(self, statements):
+        """提交必须在同一事务中完成的多条语句 [(sql, rows), ...]
+
+        返回写入完成后得到各语句行数之和的 Future。
+        """
+        future = concurrent.futures.Future()
+        # 跳过没有数据的语句
+        statements = [(sql, rows) for sql, rows in ((sql, list(rows)) for sql, rows in statements) if rows]
+        if not statements:
+            future.set_result(0)
+            return future
+        self._ready.wait()
+        if self._init_error is not None:
+            future.set_exception(self._init_error)
+            return future
+        self._queue.put((statements, future))
+        return future
+
+    def submit(self, sql, rows):
+        """提交一组使用同一条 SQL 的行，返回写入完成后得到行数的 Future"""
+        return self.submit_group([(sql, rows)])
+
+    def write(self, sql, rows):
+        """提交并等待写入完成，返回写入的行数"""
+        return self.submit(sql, rows).result()
+
+    def write_group(self, statements):
+        """提交多条语句并等待它们在同一事务中写入完成"""
+        return self.submit_group(statements).result()
+
+    def queue_depth(self):
+        """排队等待写入的请求数"""
+        return self._queue.qsize()
+
+    def close(self):
+        """写完队列中剩余的请求后关闭连接"""
+        if self.is_alive():
+            self._queue.put(_STOP)
+            self.join()
+
+
+def get_writer(db_file):
+    """获取（必要时启动）指定数据库文件的共享写入线程"""
+    with _writers_lock:
+        writer = _writers.get(db_file)
+        if writer is None or not writer.is_alive():
+            writer = DBWriter(db_file)
+            writer.start()
+            _writers[db_file] = writer
+        return writer
+
+
+def close_writer(db_file):
+    """关闭指定数据库文件的写入线程"""
+    with _writers_lock:
+        writer = _writers.pop(db_file, None)
+    if writer is not None:
+        writer.close()
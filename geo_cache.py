@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Traceroute 跳点地理位置的持久化缓存
+
+查询结果保存在 ping_data.db 的 geo_cache 表中，按 IP 缓存并设置过期时间；
+API 明确返回失败的 IP（保留地址等）也会缓存较短的时间，避免反复查询。
+进程内再用一个 LRU 字典缓存最近使用的条目，同一次运行中重复出现的骨干路由器
+不需要再读数据库。超时、网络错误等临时性失败不会写入缓存。
+"""
+
+import collections
+import sqlite3
+import threading
+import time
+import logging
+
+import db_writer
+
+logger = logging.getLogger("traceroute_monitor")
+
+# 成功结果的缓存时间（秒）
+GEO_CACHE_TTL = 7 * 24 * 3600
+# API 返回失败结果的缓存时间（秒）
+GEO_NEGATIVE_TTL = 6 * 3600
+# 内存 LRU 缓存的最大条目数
+GEO_MEMORY_CACHE_SIZE = 4096
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS geo_cache (
+        ip TEXT PRIMARY KEY,
+        status TEXT NOT NULL,       -- "success" 或 "fail"
+        location TEXT,
+        message TEXT,
+        fetched_at INTEGER NOT NULL,  -- 查询时间（Unix 时间戳）
+        expires_at INTEGER NOT NULL   -- 过期时间（Unix 时间戳）
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_geo_cache_expires ON geo_cache (expires_at)',
+]
+
+GEO_UPSERT_SQL = '''
+INSERT INTO geo_cache (ip, status, location, message, fetched_at, expires_at)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (ip) DO UPDATE SET
+    status = excluded.status,
+    location = excluded.location,
+    message = excluded.message,
+    fetched_at = excluded.fetched_at,
+    expires_at = excluded.expires_at
+'''
+
+
+def init_geo_cache_table(conn):
+    """创建地理位置缓存表（如果不存在）"""
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def purge_expired(conn, now=None):
+    """删除已过期的缓存条目，返回删除的行数"""
+    now = int(time.time()) if now is None else now
+    cursor = conn.execute('DELETE FROM geo_cache WHERE expires_at < ?', (now,))
+    return cursor.rowcount
+
+
+class GeoCache:
+    """内存 LRU + SQLite 两级地理位置缓存，可在多个线程中共享"""
+
+    def __init__(self, db_file, ttl=GEO_CACHE_TTL, negative_ttl=GEO_NEGATIVE_TTL,
+                 memory_size=GEO_MEMORY_CACHE_SIZE):
+        self.db_file = db_file
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory_size = memory_size
+        # ip -> (结果字典, 过期时间)
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "stores": 0}
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_file, timeout=db_writer.BUSY_TIMEOUT, check_same_thread=False)
+            init_geo_cache_table(self._conn)
+            self._conn.commit()
+        return self._conn
+
+    def _remember(self, ip, result, expires_at):
+        self._memory[ip] = (result, expires_at)
+        self._memory.move_to_end(ip)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get(self, ip):
+        """返回未过期的缓存结果，没有时返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(ip)
+            if entry is not None:
+                if entry[1] > now:
+                    self._memory.move_to_end(ip)
+                    self.stats["memory_hits"] += 1
+                    return dict(entry[0])
+                del self._memory[ip]
+
+            try:
+                row = self._connection().execute(
+                    'SELECT status, location, message, expires_at FROM geo_cache WHERE ip = ? AND expires_at > ?',
+                    (ip, int(now))
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"读取地理位置缓存失败: {str(e)}")
+                row = None
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+
+            status, location, message, expires_at = row
+            result = {"status": status, "location": location, "query": ip}
+            if message is not None:
+                result["message"] = message
+            self._remember(ip, result, expires_at)
+            self.stats["db_hits"] += 1
+            return dict(result)
+
+    def put(self, ip, result):
+        """缓存一次查询结果，失败结果使用较短的过期时间"""
+        now = int(time.time())
+        success = result.get("status") == "success"
+        expires_at = now + (self.ttl if success else self.negative_ttl)
+        entry = {"status": result.get("status", "fail"), "location": result.get("location"), "query": ip}
+        if result.get("message") is not None:
+            entry["message"] = result["message"]
+        with self._lock:
+            self._remember(ip, entry, expires_at)
+            self.stats["stores"] += 1
+        # 通过共享写入线程异步落盘，不阻塞查询线程
+        future = db_writer.get_writer(self.db_file).submit(GEO_UPSERT_SQL, [
+            (ip, entry["status"], entry["location"], entry.get("message"), now, expires_at)
+        ])
+        future.add_done_callback(self._log_write_error)
+
+    @staticmethod
+    def _log_write_error(future):
+        error = future.exception()
+        if error is not None:
+            logger.warning(f"写入地理位置缓存失败: {str(error)}")
+
+    def hit_rate(self):
+        """缓存命中率（0~1），没有查询时返回 None"""
+        hits = self.stats["memory_hits"] + self.stats["db_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else None
+
+    def log_stats(self):
+        """记录本次运行的缓存命中情况"""
+        rate = self.hit_rate()
+        if rate is None:
+            logger.info("地理位置缓存: 本次运行没有查询")
+            return
+        logger.info(
+            f"地理位置缓存命中率 {rate:.1%}（内存 {self.stats['memory_hits']}，"
+            f"数据库 {self.stats['db_hits']}，未命中 {self.stats['misses']}，新写入 {self.stats['stores']}）"
+        )
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+进程内共享的地理位置查询服务
+
+所有并发的 traceroute 都通过同一个服务查询跳点位置：
+- 同一 IP 正在查询时，后来的请求直接等待同一个 Future，不会重复发请求
+- 排队的 IP 由一个后台线程合并，使用 ip-api 的批量接口一次查询最多 100 个
+- 令牌桶按 API 配额限制请求速率，并根据响应头 X-Rl / X-Ttl 在配额用尽时暂停
+- 所有请求复用同一个 requests.Session 的连接池
+"""
+
+import concurrent.futures
+import threading
+import time
+import logging
+
+import requests
+
+from ip_range_db import format_location
+
+logger = logging.getLogger("traceroute_monitor")
+
+# ip-api 批量查询接口 (限制: 15次/分钟，每次最多100个IP)
+GEO_BATCH_API_URL = "http://ip-api.com/batch?fields=status,message,country,regionName,city,query"
+GEO_BATCH_REQUESTS_PER_MINUTE = 15
+GEO_BATCH_SIZE = 100
+# 收集同一批 IP 的等待时间（秒）
+GEO_BATCH_WINDOW = 0.2
+# 单次 HTTP 请求超时（秒）
+GEO_REQUEST_TIMEOUT = 10
+
+
+class TokenBucket:
+    """线程安全的令牌桶限速器"""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        # 服务端要求的暂停截止时间
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """取走一个令牌，没有可用令牌时阻塞等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """清空令牌并暂停指定秒数（服务端配额已用尽）"""
+        with self._lock:
+            self.tokens = 0.0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def transient_failure(ip, message, location):
+    """临时性失败（超时、网络错误等），不应写入缓存"""
+    return {"status": "fail", "message": message, "query": ip, "location": location, "transient": True}
+
+
+def parse_geo_response(data, ip):
+    """把 ip-api 返回的单个对象转换为查询结果"""
+    if data.get("status") == "success":
+        location = format_location(data.get('country', ''), data.get('regionName', ''), data.get('city', ''))
+        return {"status": "success", "location": location, "query": data.get("query", ip)}
+    logger.warning(f"IP {ip} 地理位置查询失败: {data.get('message', '未知错误')}")
+    return {"status": "fail", "message": data.get("message"), "query": ip, "location": "查询失败"}
+
+
+class GeoLookupService:
+    """合并、限速并批量执行地理位置查询"""
+
+    def __init__(self, cache=None, batch_url=GEO_BATCH_API_URL,
+                 requests_per_minute=GEO_BATCH_REQUESTS_PER_MINUTE,
+                 batch_size=GEO_BATCH_SIZE, batch_window=GEO_BATCH_WINDOW):
+        self.cache = cache
+        self.batch_url = batch_url
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.bucket = TokenBucket(requests_per_minute)
+        self.session = requests.Session()
+        # ip -> 尚未完成的 Future
+        self._inflight = {}
+        self._pending = []
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = None
+        self.stats = {"requests": 0, "queried": 0, "coalesced": 0}
+
+    def submit(self, ip):
+        """提交查询，返回得到结果字典的 Future"""
+        with self._cond:
+            future = self._inflight.get(ip)
+            if future is not None:
+                self.stats["coalesced"] += 1
+                return future
+
+        cached = self.cache.get(ip) if self.cache is not None else None
+        if cached is not None:
+            future = concurrent.futures.Future()
+            future.set_result(cached)
+            return future
+
+        with self._cond:
+            # 查缓存期间可能已有其他线程提交了同一个 IP
+            future = self._inflight.get(ip)
+            if future is not None:
+                self.stats["coalesced"] += 1
+                return future
+            future = concurrent.futures.Future()
+            self._inflight[ip] = future
+            self._pending.append(ip)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="geo-lookup", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def lookup(self, ip):
+        """查询并等待结果"""
+        return self.submit(ip).result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                full = len(self._pending) >= self.batch_size
+            if not full:
+                # 稍等片刻，让同时出现的其他跳点进入同一批
+                time.sleep(self.batch_window)
+            with self._cond:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+            self.bucket.acquire()
+            try:
+                results = self._fetch(batch)
+            except Exception as e:
+                logger.error(f"批量地理位置查询异常: {str(e)}")
+                results = {}
+            for ip in batch:
+                result = results.get(ip) or transient_failure(ip, "响应中缺少该IP", "查询失败")
+                if self.cache is not None and not result.get("transient"):
+                    self.cache.put(ip, result)
+                with self._cond:
+                    future = self._inflight.pop(ip)
+                future.set_result(result)
+
+    def _fetch(self, batch):
+        """执行一次批量请求，返回 ip -> 结果"""
+        self.stats["requests"] += 1
+        self.stats["queried"] += len(batch)
+        try:
+            response = self.session.post(self.batch_url, json=batch, timeout=GEO_REQUEST_TIMEOUT)
+            self._respect_rate_headers(response)
+            response.raise_for_status()
+            items = response.json()
+        except requests.exceptions.Timeout:
+            logger.warning(f"批量地理位置查询超时（{len(batch)} 个IP）")
+            return {ip: transient_failure(ip, "查询超时", "查询超时") for ip in batch}
+        except requests.exceptions.RequestException as e:
+            logger.error(f"批量地理位置查询请求错误: {str(e)}")
+            return {ip: transient_failure(ip, str(e), "查询错误") for ip in batch}
+        except ValueError:
+            logger.error(f"无法解析批量地理位置查询的响应: {response.text}")
+            return {ip: transient_failure(ip, "响应解析失败", "解析失败") for ip in batch}
+        # 结果顺序与请求顺序一致
+        return {ip: parse_geo_response(item, ip) for ip, item in zip(batch, items)}
+
+    def _respect_rate_headers(self, response):
+        """X-Rl 为本周期剩余请求数，X-Ttl 为距离配额重置的秒数"""
+        try:
+            remaining = int(response.headers.get("X-Rl", 1))
+            reset = int(response.headers.get("X-Ttl", 0))
+        except ValueError:
+            return
+        if remaining <= 0 or response.status_code == 429:
+            logger.warning(f"地理位置 API 配额已用尽，暂停 {reset} 秒")
+            self.bucket.pause(max(reset, 1))
+
+    def log_stats(self):
+        logger.info(
+            f"地理位置查询: {self.stats['requests']} 次批量请求共查询 {self.stats['queried']} 个IP，"
+            f"合并重复查询 {self.stats['coalesced']} 次"
+        )
+
+    def close(self):
+        """处理完排队的查询后停止后台线程并关闭连接池"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.session.close()
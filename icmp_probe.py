@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基于 asyncio 的进程内 ICMP 探测引擎
+
+使用一个事件循环、每个地址族一个 ICMP 套接字（优先使用无需特权的 ICMP
+数据报套接字，其次是原始套接字），对所有目标并发发送回显请求，按
+(标识符, 回复来源地址, 序列号) 匹配回复。整个探测轮次大约只需一个 PING_COUNT 周期。
+发送缓冲区已满时请求会排队，等套接字可写后重试，不记为丢包。
+"""
+
+import asyncio
+import collections
+import errno
+import itertools
+import os
+import socket
+import struct
+import sys
+import time
+import logging
+
+logger = logging.getLogger("ping_monitor")
+
+# ICMP 报文类型
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+
+# 回显请求的负载长度（字节），与系统 ping 默认的 56 字节一致
+PAYLOAD_SIZE = 56
+# 单个套接字接收缓冲区大小
+RECV_BUFFER_SIZE = 4096
+# 网卡队列已满（ENOBUFS）时重试发送的间隔（秒），这时套接字仍会报告可写
+SEND_RETRY_DELAY = 0.01
+
+
+class ICMPUnavailable(Exception):
+    """当前主机不允许创建任何 ICMP 套接字"""
+
+
+def checksum(data):
+    """计算 ICMP 校验和（RFC 1071）"""
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def build_echo_request(family, ident, seq, payload):
+    """构造 ICMP/ICMPv6 回显请求报文"""
+    if family == socket.AF_INET6:
+        # ICMPv6 的校验和由内核计算（包含伪首部）
+        return struct.pack("!BBHHH", ICMPV6_ECHO_REQUEST, 0, 0, ident, seq) + payload
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    csum = checksum(header + payload)
+    return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, csum, ident, seq) + payload
+
+
+def parse_echo_reply(family, data):
+    """解析回显回复，返回 (标识符, 序列号)，不是回显回复时返回 None"""
+    if family == socket.AF_INET and len(data) >= 20 and data[0] >> 4 == 4:
+        # 原始套接字（以及 macOS 的数据报套接字）会带上 IPv4 首部
+        data = data[(data[0] & 0x0F) * 4:]
+    if len(data) < 8:
+        return None
+    icmp_type, _code, _csum, ident, seq = struct.unpack("!BBHHH", data[:8])
+    expected = ICMPV6_ECHO_REPLY if family == socket.AF_INET6 else ICMP_ECHO_REPLY
+    if icmp_type != expected:
+        return None
+    return ident, seq
+
+
+def open_icmp_socket(family):
+    """打开 ICMP 套接字，返回 (socket, 是否为数据报套接字)
+
+    优先尝试无需 root 的 ICMP 数据报套接字（Linux 需 net.ipv4.ping_group_range 允许，
+    macOS 默认可用），失败后再尝试原始套接字。
+    """
+    proto = socket.IPPROTO_ICMPV6 if family == socket.AF_INET6 else socket.IPPROTO_ICMP
+    errors = []
+    for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+        try:
+            sock = socket.socket(family, sock_type, proto)
+        except OSError as e:
+            errors.append(str(e))
+            continue
+        sock.setblocking(False)
+        return sock, sock_type == socket.SOCK_DGRAM
+    raise ICMPUnavailable("; ".join(errors))
+
+
+class _FamilyChannel:
+    """单个地址族的收发通道，负责标识符与序列号分配和回复匹配
+
+    序列号只有 16 位，一轮超过 65536 个请求时会重复，因此按 (目标地址, 序列号) 匹配回复，
+    同时校验回复的来源地址。
+    """
+
+    def __init__(self, family, engine, loop):
+        self.family = family
+        self.engine = engine
+        self.loop = loop
+        self.sock, self.is_dgram = open_icmp_socket(family)
+        if self.is_dgram:
+            # 数据报套接字的标识符由内核改写为本地端口，需要先绑定
+            self.sock.bind(("::", 0) if family == socket.AF_INET6 else ("0.0.0.0", 0))
+            self.ident = self.sock.getsockname()[1] & 0xFFFF
+        else:
+            self.ident = (os.getpid() ^ id(self)) & 0xFFFF
+        self._seq = itertools.count()
+        # (目标地址, 序列号) -> (目标IP, 探测序号, 发送时间)
+        self.pending = {}
+        # 发送缓冲区已满时排队等待重试的请求
+        self.backlog = collections.deque()
+        self._retry = None
+
+    def next_seq(self):
+        return next(self._seq) & 0xFFFF
+
+    def send(self, ip, sockaddr, probe_index):
+        seq = self.next_seq()
+        payload = struct.pack("!d", time.time()).ljust(PAYLOAD_SIZE, b'\x00')
+        packet = build_echo_request(self.family, self.ident, seq, payload)
+        self.backlog.append(((sockaddr[0], seq), ip, probe_index, packet, sockaddr))
+        if len(self.backlog) == 1:
+            self.flush()
+
+    def flush(self):
+        """按顺序发送排队的请求，发送缓冲区已满时等待可写（或稍后）再继续"""
+        self._retry = None
+        self.loop.remove_writer(self.sock.fileno())
+        while self.backlog:
+            key, ip, probe_index, packet, sockaddr = self.backlog[0]
+            sent = time.perf_counter()
+            try:
+                self.sock.sendto(packet, sockaddr)
+            except (BlockingIOError, InterruptedError):
+                self.loop.add_writer(self.sock.fileno(), self.flush)
+                return
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    self._retry = self.loop.call_later(SEND_RETRY_DELAY, self.flush)
+                    return
+                # 其他发送失败视为丢包（例如网络不可达）
+                logger.debug(f"向 {ip} 发送 ICMP 请求失败: {str(e)}")
+            else:
+                self.pending[key] = (ip, probe_index, sent)
+            self.backlog.popleft()
+
+    def abandon(self):
+        """停止重试，返回仍未发出的请求数"""
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+        self.loop.remove_writer(self.sock.fileno())
+        unsent = len(self.backlog)
+        self.backlog.clear()
+        return unsent
+
+    def on_readable(self):
+        """事件循环回调：读取套接字中所有待处理的回复"""
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(RECV_BUFFER_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.debug(f"读取 ICMP 回复失败: {str(e)}")
+                return
+            received = time.perf_counter()
+            parsed = parse_echo_reply(self.family, data)
+            if parsed is None:
+                continue
+            ident, seq = parsed
+            # 数据报套接字只会收到属于自己的回复，内核已完成标识符匹配
+            if not self.is_dgram and ident != self.ident:
+                continue
+            entry = self.pending.pop((addr[0], seq), None)
+            if entry is None:
+                continue
+            ip, probe_index, sent = entry
+            self.engine.record(ip, probe_index, (received - sent) * 1000.0)
+
+    def close(self):
+        self.sock.close()
+
+
+class ICMPProbeEngine:
+    """在单个事件循环中对一组目标执行 ICMP 探测"""
+
+    def __init__(self, count, interval=1.0, timeout=1.0):
+        self.count = count
+        self.interval = interval
+        self.timeout = timeout
+        self.channels = {}
+        # 目标IP -> 每个探测序号对应的延迟（毫秒），未收到回复为 None
+        self.samples = {}
+
+    def record(self, ip, probe_index, latency_ms):
+        slots = self.samples.get(ip)
+        if slots is not None and slots[probe_index] is None:
+            slots[probe_index] = latency_ms
+
+    def _channel(self, family, loop):
+        """按需打开地址族通道，无法打开时返回 None"""
+        if family not in self.channels:
+            try:
+                self.channels[family] = _FamilyChannel(family, self, loop)
+            except (ICMPUnavailable, OSError) as e:
+                name = "IPv6" if family == socket.AF_INET6 else "IPv4"
+                logger.warning(f"无法创建 {name} ICMP 套接字: {str(e)}")
+                self.channels[family] = None
+        return self.channels[family]
+
+    async def _resolve(self, loop, ip):
+        """解析目标地址，返回 (family, sockaddr)"""
+        infos = await loop.getaddrinfo(ip, None, type=socket.SOCK_RAW)
+        family, _type, _proto, _canon, sockaddr = infos[0]
+        return family, sockaddr
+
+    async def run(self, ips):
+        """探测所有目标，返回 (结果字典, 无法使用 ICMP 探测的目标列表)"""
+        loop = asyncio.get_running_loop()
+        targets = []
+        unsupported = []
+        results = {}
+
+        for ip in ips:
+            try:
+                family, sockaddr = await self._resolve(loop, ip)
+            except OSError as e:
+                results[ip] = {"success": False, "error": f"地址解析失败: {str(e)}"}
+                continue
+            channel = self._channel(family, loop)
+            if channel is None:
+                unsupported.append(ip)
+                continue
+            targets.append((ip, channel, sockaddr))
+            self.samples[ip] = [None] * self.count
+
+        if not targets:
+            return results, unsupported
+
+        active = [c for c in self.channels.values() if c is not None]
+        for channel in active:
+            loop.add_reader(channel.sock.fileno(), channel.on_readable)
+        try:
+            start = loop.time()
+            for probe_index in range(self.count):
+                for ip, channel, sockaddr in targets:
+                    channel.send(ip, sockaddr, probe_index)
+                # 按固定间隔发送下一轮，与系统 ping 的节奏一致
+                next_round = start + (probe_index + 1) * self.interval
+                if probe_index < self.count - 1:
+                    await asyncio.sleep(max(0.0, next_round - loop.time()))
+            # 等待最后一轮的回复
+            await asyncio.sleep(self.timeout)
+        finally:
+            unsent = 0
+            for channel in active:
+                unsent += channel.abandon()
+                loop.remove_reader(channel.sock.fileno())
+                channel.close()
+            self.channels.clear()
+        if unsent:
+            logger.warning(f"{unsent} 个 ICMP 请求因发送缓冲区持续已满未能发出，按丢包计")
+
+        for ip, _channel, _sockaddr in targets:
+            results[ip] = build_result(self.samples[ip], self.count, self.timeout)
+        return results, unsupported
+
+
+def build_result(slots, count, timeout=None):
+    """将每个探测序号的延迟转换为 save_result_to_db 使用的结果字典"""
+    # 超时后才到达的回复按丢包处理
+    samples = [
+        round(x, 3) if x is not None and (timeout is None or x <= timeout * 1000.0) else None
+        for x in slots
+    ]
+    latencies = [x for x in samples if x is not None]
+    if not latencies:
+        return {"success": False, "error": "Ping请求失败"}
+    return {
+        "success": True,
+        "latencies": latencies,
+        "samples": samples,
+        "average": round(sum(latencies) / len(latencies)),  # 精确到整数
+        "min": round(min(latencies)),                       # 精确到整数
+        "max": round(max(latencies)),                       # 精确到整数
+        "packet_loss": count - len(latencies)
+    }
+
+
+def icmp_supported():
+    """判断当前平台是否可以使用异步 ICMP 引擎"""
+    # Windows 默认的 Proactor 事件循环不支持 add_reader
+    return sys.platform != "win32"
+
+
+def probe_targets(ips, count, interval=1.0, timeout=1.0):
+    """同步入口：探测所有目标，返回 (结果字典, 需要回退到系统 ping 的目标列表)
+
+    当任何地址族的 ICMP 套接字都无法创建时抛出 ICMPUnavailable。
+    """
+    if not icmp_supported():
+        raise ICMPUnavailable("当前平台不支持异步 ICMP 引擎")
+    engine = ICMPProbeEngine(count, interval=interval, timeout=timeout)
+    results, unsupported = asyncio.run(engine.run(list(ips)))
+    if unsupported and not results:
+        raise ICMPUnavailable("无法创建 ICMP 套接字")
+    return results, unsupported
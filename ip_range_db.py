@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线 IP 地址段 -> 地理位置数据库
+
+从本地 CSV 文件（每行：起始IP,结束IP,国家,省份,城市）构建按起始地址排序的
+区间索引，IPv4 和 IPv6 分开存放，查询时用 bisect 二分查找，单次查询只需几微秒。
+起始/结束地址可以写成点分/冒号格式，也可以写成整数（与常见的 IP 段数据库一致）。
+
+索引第一次构建后保存为同名的 .idx 二进制文件：地址以定长大端字节存放，
+加载时直接 mmap，不需要重新解析 CSV；CSV 的大小或修改时间变化后自动重建。
+"""
+
+import bisect
+import csv
+import ipaddress
+import json
+import mmap
+import os
+import struct
+import logging
+
+logger = logging.getLogger("traceroute_monitor")
+
+# 索引文件格式
+INDEX_MAGIC = b"IPRIDX01"
+INDEX_SUFFIX = ".idx"
+# 文件头：魔数、CSV 大小、CSV 修改时间（纳秒）、IPv4 区间数、IPv6 区间数、地名表长度
+_HEADER = struct.Struct("<8sQQQQQ")
+# 地址宽度（字节）
+_WIDTHS = {4: 4, 6: 16}
+
+
+class _KeyView:
+    """把缓冲区中连续存放的定长地址当作有序序列，供 bisect 使用"""
+
+    def __init__(self, buf, offset, count, width):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+        self.width = width
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.offset + i * self.width
+        return self.buf[start:start + self.width]
+
+
+def _parse_address(text):
+    """解析起始/结束地址，返回 (版本, 整数值)"""
+    text = text.strip()
+    if "." in text or ":" in text:
+        addr = ipaddress.ip_address(text)
+        return addr.version, int(addr)
+    value = int(text)
+    return (4 if value <= 0xFFFFFFFF else 6), value
+
+
+def format_location(country, region, city):
+    """与在线 API 相同的地名格式"""
+    region = region.replace(' Province', '').replace(' Region', '')
+    parts = [part for part in (country, region, city) if part]
+    return " - ".join(parts) if parts else "未知地点"
+
+
+def read_ranges(csv_path):
+    """读取 CSV，返回 {4: [(起始, 结束, 地名)], 6: [...]}，跳过无法解析的行"""
+    ranges = {4: [], 6: []}
+    skipped = 0
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 3 or row[0].startswith('#'):
+                continue
+            try:
+                version, start = _parse_address(row[0])
+                end_version, end = _parse_address(row[1])
+            except ValueError:
+                # 标题行或格式错误的行
+                skipped += 1
+                continue
+            if end < start:
+                skipped += 1
+                continue
+            if version != end_version:
+                # 整数格式下结束地址超过 32 位时，整段按 IPv6 处理
+                version = 6
+            fields = [field.strip() for field in row[2:5]] + [""] * (5 - len(row))
+            ranges[version].append((start, end, format_location(*fields[:3])))
+    if skipped:
+        logger.warning(f"离线地理位置数据 {csv_path} 中有 {skipped} 行无法解析，已跳过")
+    return ranges
+
+
+def build_index(csv_path, index_path):
+    """由 CSV 构建二进制索引文件"""
+    ranges = read_ranges(csv_path)
+    locations = []
+    location_ids = {}
+    sections = []
+    for version in (4, 6):
+        width = _WIDTHS[version]
+        items = sorted(ranges[version])
+        starts = bytearray()
+        ends = bytearray()
+        ids = bytearray()
+        for start, end, location in items:
+            if location not in location_ids:
+                location_ids[location] = len(locations)
+                locations.append(location)
+            starts += start.to_bytes(width, "big")
+            ends += end.to_bytes(width, "big")
+            ids += struct.pack("<I", location_ids[location])
+        sections.append((len(items), starts + ends + ids))
+
+    location_blob = json.dumps(locations, ensure_ascii=False).encode('utf-8')
+    stat = os.stat(csv_path)
+    header = _HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns,
+                          sections[0][0], sections[1][0], len(location_blob))
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        for _count, data in sections:
+            f.write(data)
+        f.write(location_blob)
+    os.replace(tmp_path, index_path)
+    logger.info(f"已构建离线地理位置索引 {index_path}（IPv4 {sections[0][0]} 段，IPv6 {sections[1][0]} 段）")
+
+
+class IPRangeDB:
+    """基于 mmap 索引文件的 IP 段查询"""
+
+    def __init__(self, index_path):
+        with open(index_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.source_size, self.source_mtime_ns, count4, count6, blob_len = _HEADER.unpack_from(self._mm, 0)
+        if magic != INDEX_MAGIC:
+            self._mm.close()
+            raise ValueError(f"{index_path} 不是有效的离线地理位置索引")
+
+        # 每个地址族：[起始地址视图, 结束地址视图, 地名序号偏移]
+        self._tables = {}
+        offset = _HEADER.size
+        for version, count in ((4, count4), (6, count6)):
+            width = _WIDTHS[version]
+            starts = _KeyView(self._mm, offset, count, width)
+            ends = _KeyView(self._mm, offset + count * width, count, width)
+            ids_offset = offset + 2 * count * width
+            self._tables[version] = (starts, ends, ids_offset)
+            offset = ids_offset + 4 * count
+        self.locations = json.loads(self._mm[offset:offset + blob_len].decode('utf-8'))
+
+    def __len__(self):
+        return sum(len(table[0]) for table in self._tables.values())
+
+    def lookup(self, ip):
+        """返回 IP 所在地址段的地名，不在任何地址段内时返回 None"""
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if addr.version == 6 and addr.ipv4_mapped is not None:
+            addr = addr.ipv4_mapped
+        starts, ends, ids_offset = self._tables[addr.version]
+        key = addr.packed
+        i = bisect.bisect_right(starts, key) - 1
+        if i < 0 or ends[i] < key:
+            return None
+        (location_id,) = struct.unpack_from("<I", self._mm, ids_offset + 4 * i)
+        return self.locations[location_id]
+
+    def close(self):
+        self._mm.close()
+
+
+def _index_is_current(csv_path, index_path):
+    """索引文件存在且与 CSV 的大小和修改时间一致"""
+    try:
+        with open(index_path, 'rb') as f:
+            header = f.read(_HEADER.size)
+        magic, size, mtime_ns = _HEADER.unpack(header)[:3]
+    except (OSError, struct.error):
+        return False
+    stat = os.stat(csv_path)
+    return magic == INDEX_MAGIC and size == stat.st_size and mtime_ns == stat.st_mtime_ns
+
+
+def open_range_db(csv_path, index_path=None):
+    """打开离线数据库，索引不存在或已过期时先重建"""
+    index_path = index_path or csv_path + INDEX_SUFFIX
+    if not _index_is_current(csv_path, index_path):
+        build_index(csv_path, index_path)
+    return IPRangeDB(index_path)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+逐包延迟的紧凑二进制编码
+
+每个探测序号占一个小端 float32 槽位（单位：毫秒），未收到回复的槽位为 NaN。
+10 次探测只需 40 字节，读取时可以直接作为 array('f') / numpy.float32 /
+JavaScript Float32Array 的缓冲区视图，无需再做字符串解析。
+"""
+
+import math
+import sys
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # numpy 为可选依赖
+    np = None
+
+# 丢包槽位标记
+LOST = float('nan')
+# 单个槽位的字节数
+SLOT_SIZE = 4
+
+
+def encode_samples(samples):
+    """将每个探测序号的延迟（None 表示丢包）编码为 BLOB"""
+    values = array('f', (LOST if x is None else x for x in samples))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def decode_latencies(blob):
+    """将 BLOB 解码为 array('f')，丢包槽位为 NaN"""
+    values = array('f')
+    if blob:
+        values.frombytes(blob)
+        if sys.byteorder == 'big':
+            values.byteswap()
+    return values
+
+
+def decode_samples(blob):
+    """将 BLOB 解码为列表，丢包槽位为 None"""
+    return [None if math.isnan(x) else x for x in decode_latencies(blob)]
+
+
+def decode_numpy(blob):
+    """将 BLOB 零拷贝解码为 numpy.float32 数组（需要安装 numpy）"""
+    if np is None:
+        raise ImportError("decode_numpy 需要安装 numpy")
+    return np.frombuffer(blob or b'', dtype='<f4')
+
+
+def received_latencies(blob):
+    """只返回收到回复的槽位的延迟"""
+    return [x for x in decode_latencies(blob) if not math.isnan(x)]
+
+
+def lost_slots(blob):
+    """返回丢包的探测序号（从0开始）"""
+    return [i for i, x in enumerate(decode_latencies(blob)) if math.isnan(x)]
+
+
+def samples_from_text(text, packet_loss=0):
+    """从旧的逗号分隔文本构造槽位列表
+
+    旧数据没有记录丢包发生在哪个序号，丢包槽位统一补在末尾。
+    """
+    samples = [float(x) for x in text.split(',') if x.strip()] if text else []
+    return samples + [None] * max(0, packet_loss or 0)
+
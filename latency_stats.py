@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+单次测试内逐包延迟的统计量
+
+根据每个探测序号的往返时间（毫秒，精确到微秒，None 表示丢包）计算平均值、
+p50/p90/p99 百分位、平均偏差（与 ping 的 mdev 相同，即总体标准差）以及
+RFC 3550 定义的到达间隔抖动。往返时间由同一时钟上的发送和接收时间相减得到，
+因此 RFC 3550 中相邻两包传输时间之差 D(i-1, i) 就是两次往返时间之差。
+
+安装了 numpy 时使用向量化实现，否则使用纯 Python 实现，两者结果一致。
+"""
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 计算的百分位
+PERCENTILES = (50, 90, 99)
+# RFC 3550 抖动估计的增益
+JITTER_GAIN = 1 / 16
+# 统计结果保留的小数位数（毫秒，3 位即微秒）
+STATS_PRECISION = 3
+
+
+def received(samples):
+    """按序列号顺序返回收到回复的延迟"""
+    return [x for x in samples if x is not None and not math.isnan(x)]
+
+
+def percentile(sorted_values, q):
+    """线性插值百分位（与 numpy.percentile 的默认方法一致）"""
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    position = (len(sorted_values) - 1) * q / 100.0
+    lower = math.floor(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def rfc3550_jitter(values):
+    """按 RFC 3550 6.4.1 逐包更新的抖动：J += (|D| - J) / 16"""
+    jitter = 0.0
+    for previous, current in zip(values, values[1:]):
+        jitter += (abs(current - previous) - jitter) * JITTER_GAIN
+    return jitter
+
+
+def _stats_python(values):
+    n = len(values)
+    mean = sum(values) / n
+    variance = max(sum(x * x for x in values) / n - mean * mean, 0.0)
+    ordered = sorted(values)
+    stats = {"mean": mean, "mdev": math.sqrt(variance), "jitter": rfc3550_jitter(values)}
+    for q in PERCENTILES:
+        stats[f"p{q}"] = percentile(ordered, q)
+    return stats
+
+
+def _stats_numpy(values):
+    arr = np.asarray(values, dtype=np.float64)
+    stats = {"mean": float(arr.mean()), "mdev": float(arr.std())}
+    for q, value in zip(PERCENTILES, np.percentile(arr, PERCENTILES)):
+        stats[f"p{q}"] = float(value)
+    # 递推式展开后是对 |D| 的指数加权和：J_n = Σ |D_k| · g · (1 - g)^(n - k)
+    deltas = np.abs(np.diff(arr))
+    weights = JITTER_GAIN * (1 - JITTER_GAIN) ** np.arange(len(deltas) - 1, -1, -1)
+    stats["jitter"] = float(deltas @ weights) if len(deltas) else 0.0
+    return stats
+
+
+def compute_stats(samples):
+    """计算一次测试的延迟统计量，没有收到任何回复时返回 None
+
+    返回 {"mean", "p50", "p90", "p99", "mdev", "jitter"}，单位为毫秒。
+    """
+    values = received(samples)
+    if not values:
+        return None
+    stats = _stats_numpy(values) if np is not None else _stats_python(values)
+    return {key: round(value, STATS_PRECISION) for key, value in stats.items()}
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+常驻模式的 Prometheus 指标端点
+
+探测结果和程序自身的耗时在内存中累计，内置的 HTTP 服务（只用标准库）在
+/metrics 上按 Prometheus 文本格式输出，抓取时不访问数据库。
+
+目标指标（标签 ip、region）：最近一轮的平均延迟、丢包率、是否成功、探测
+时间，以及逐包延迟的直方图。自身指标：每轮探测耗时、数据库写入耗时、写入
+队列长度、探测轮次和写入失败次数。
+"""
+
+import bisect
+import http.server
+import threading
+import time
+import logging
+
+logger = logging.getLogger("ping_monitor")
+
+# 指标名前缀
+METRIC_PREFIX = "ping_monitor"
+# Prometheus 文本格式的 Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# 逐包延迟直方图的桶上界（毫秒）
+RTT_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 400, 800, 1600)
+# 耗时直方图的桶上界（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape_label(value):
+    """转义标签值中的反斜杠、双引号和换行"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """累计直方图（各桶计数在输出时再做前缀和）"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            yield f"{name}_bucket{format_labels(labels + (('le', format_value(float(bound))),))} {cumulative}"
+        yield f"{name}_sum{format_labels(labels)} {format_value(self.sum)}"
+        yield f"{name}_count{format_labels(labels)} {self.count}"
+
+
+class MetricsRegistry:
+    """线程安全的内存指标存储"""
+
+    # 指标名 -> (类型, 说明)
+    DESCRIPTIONS = {
+        "target_rtt_milliseconds": ("gauge", "最近一轮探测的平均往返时间"),
+        "target_loss_ratio": ("gauge", "最近一轮探测的丢包率"),
+        "target_up": ("gauge", "最近一轮探测是否收到回复"),
+        "target_last_probe_timestamp_seconds": ("gauge", "最近一轮探测的时间（Unix 时间戳）"),
+        "target_probe_count": ("gauge", "最近一轮探测发送的包数"),
+        "probe_rtt_milliseconds": ("histogram", "逐包往返时间"),
+        "probe_round_duration_seconds": ("histogram", "一轮探测（含写入数据库）的耗时"),
+        "db_write_duration_seconds": ("histogram", "一次写入数据库（含排队）的耗时"),
+        "db_write_queue_depth": ("gauge", "数据库写入线程中排队的请求数"),
+        "probe_rounds_total": ("counter", "已完成的探测轮次"),
+        "db_write_errors_total": ("counter", "写入数据库失败的次数"),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 指标名 -> {标签元组: 值或 Histogram}
+        self._values = {}
+        # 指标名 -> 返回当前值的函数（抓取时调用）
+        self._callbacks = {}
+
+    def _series(self, name):
+        return self._values.setdefault(name, {})
+
+    def set(self, name, value, labels=()):
+        with self._lock:
+            self._series(name)[labels] = value
+
+    def inc(self, name, amount=1, labels=()):
+        with self._lock:
+            series = self._series(name)
+            series[labels] = series.get(labels, 0) + amount
+
+    def observe(self, name, value, labels=(), buckets=DURATION_BUCKETS):
+        with self._lock:
+            series = self._series(name)
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram(buckets)
+            histogram.observe(value)
+
+    def set_callback(self, name, func):
+        """抓取时调用 func() 得到指标的值"""
+        with self._lock:
+            self._callbacks[name] = func
+
+    def record_result(self, result, region):
+        """记录一个目标的一轮探测结果（ping_monitor 的结果字典）"""
+        labels = (("ip", result["ip"]), ("region", region))
+        count = result.get("probe_count") or 0
+        with self._lock:
+            self._series("target_up")[labels] = 1 if result["success"] else 0
+            self._series("target_last_probe_timestamp_seconds")[labels] = time.time()
+            if count:
+                self._series("target_probe_count")[labels] = count
+            if result["success"]:
+                latencies = result["latencies"]
+                self._series("target_rtt_milliseconds")[labels] = sum(latencies) / len(latencies)
+                if count:
+                    self._series("target_loss_ratio")[labels] = result["packet_loss"] / count
+                histograms = self._series("probe_rtt_milliseconds")
+                histogram = histograms.get(labels)
+                if histogram is None:
+                    histogram = histograms[labels] = Histogram(RTT_BUCKETS)
+                for latency in latencies:
+                    histogram.observe(latency)
+            else:
+                self._series("target_loss_ratio")[labels] = 1.0
+                # 没有收到回复时不再保留上一轮的延迟
+                self._series("target_rtt_milliseconds").pop(labels, None)
+
+    def remove_target(self, ip):
+        """目标从配置中删除后不再输出它的指标"""
+        with self._lock:
+            for name, series in self._values.items():
+                if name.startswith(("target_", "probe_rtt")):
+                    for labels in [labels for labels in series if labels and labels[0] == ("ip", ip)]:
+                        del series[labels]
+
+    def render(self):
+        """按 Prometheus 文本格式输出全部指标"""
+        with self._lock:
+            values = {name: dict(series) for name, series in self._values.items()}
+            callbacks = dict(self._callbacks)
+        for name, func in callbacks.items():
+            try:
+                values[name] = {(): func()}
+            except Exception as e:
+                logger.debug(f"获取指标 {name} 失败: {str(e)}")
+
+        lines = []
+        for name in sorted(values):
+            kind, help_text = self.DESCRIPTIONS.get(name, ("gauge", name))
+            full_name = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in values[name].items():
+                if isinstance(value, Histogram):
+                    lines.extend(value.lines(full_name, labels))
+                else:
+                    lines.append(f"{full_name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"指标请求 {self.address_string()}: {format % args}")
+
+
+def start_server(registry, port, host=""):
+    """在后台线程中启动指标 HTTP 服务，返回服务对象（调用 shutdown() 停止）"""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info(f"指标服务已启动: http://{host or '0.0.0.0'}:{server.server_address[1]}/metrics")
+    return server
@@ -1,14 +1,16 @@
 // 全局SQL.js数据库对象
 let db = null;
+// 使用数据分片时的加载器（见 data_loader.js），为 null 时表示已加载完整数据库
+let shardedDb = null;
+// 使用数据分片时默认加载的天数
+const DEFAULT_RANGE_DAYS = 7;
+// latest.json 摘要卡片的渲染结果
+let latestSnapshotPromise = Promise.resolve(false);
 
-// IP列表和配置信息
-const IPS = [
-    {ip: "129.150.63.51", region: "美国-凤凰城"},
-    {ip: "2603:c024:450a:90ab:fc23:a611:7a38:ca2d", region: "美国-圣何塞"},
-    {ip: "140.238.25.169", region: "日本-东京"},
-    {ip: "2603:c022:8001:8b08:6ddb:7f1a:75c:cf89", region: "韩国-首尔"},
-    {ip: "43.134.207.202", region: "HongKong"},
-];
+// IP列表和地区，由 ping_monitor.py 导出的 targets.json 提供
+let IPS = [];
+// targets.json 的读取结果（失败时为 null）
+let targetsPromise = Promise.resolve(null);
 
 // 全局状态和配置
 const PING_COUNT = 10;
@@ -36,22 +38,20 @@ async function initSqlJs() {
         // 更新加载进度
         updateProgress(30, "正在加载数据库文件...");
         
-        // 加载数据库文件
-        const response = await fetch('ping_data.db');
-        if (!response.ok) {
-            throw new Error('无法加载数据库文件：' + response.statusText);
+        // 优先按日期范围加载数据分片，没有分片清单时加载完整数据库
+        const manifest = await fetchShardManifest();
+        if (manifest) {
+            shardedDb = new ShardedDatabase(SQL, manifest);
+            db = shardedDb.db;
+            const range = defaultShardRange();
+            await shardedDb.ensureRange(range.startDate, range.endDate, (done, total) => {
+                updateProgress(30 + Math.round(60 * done / total), `正在加载数据分片 (${done}/${total})...`);
+            });
+        } else {
+            updateProgress(50, "正在处理数据库...");
+            db = await fetchFullDatabase(SQL);
         }
         
-        // 获取数据库文件内容
-        const arrayBuffer = await response.arrayBuffer();
-        
-        // 更新加载进度
-        updateProgress(70, "正在处理数据库...");
-        
-        // 打开数据库
-        const uInt8Array = new Uint8Array(arrayBuffer);
-        db = new SQL.Database(uInt8Array);
-        
         // 更新加载进度
         updateProgress(100, "数据库加载完成！");
         
@@ -146,26 +146,74 @@ function updateProgress(percent, message) {
     loadingText.textContent = message;
 }
 
+// 读取 ping_monitor.py 导出的目标列表，不存在或读取失败时返回 null
+async function fetchTargets() {
+    try {
+        // 文件很小，每次向服务器确认是否有新版本（未变化时返回 304）
+        const response = await fetch('targets.json', { cache: 'no-cache' });
+        if (!response.ok) {
+            return null;
+        }
+        const data = await response.json();
+        return Array.isArray(data.targets) ? data.targets : null;
+    } catch (error) {
+        console.warn('读取目标列表失败，改为从数据库中获取：', error);
+        return null;
+    }
+}
+
+// 没有 targets.json 时，从已加载的数据中取每个IP最近使用的地区（已加载的数据只包含本机的结果，见 data_loader.js）
+function targetsFromDatabase() {
+    const targets = [];
+    try {
+        const stmt = db.prepare(`
+            SELECT ip, region FROM ping_results
+            WHERE id IN (SELECT MAX(id) FROM ping_results GROUP BY ip)
+            ORDER BY ip
+        `);
+        while (stmt.step()) {
+            const row = stmt.getAsObject();
+            targets.push({ip: row.ip, region: row.region});
+        }
+        stmt.free();
+    } catch (error) {
+        console.error('从数据库获取目标列表出错：', error);
+    }
+    return targets;
+}
+
 // 初始化页面
 function initPage() {
-    // 填充IP选择框
-    populateIpSelect();
+    // 填充IP选择框，并在目标列表就绪后加载最新IP状态（latest.json 已渲染时跳过数据库查询）
+    Promise.all([targetsPromise, latestSnapshotPromise]).then(([targets, rendered]) => {
+        IPS = targets || targetsFromDatabase();
+        populateIpSelect();
+        if (!rendered) {
+            loadLatestResults();
+        }
+    });
     
     // 获取日期范围
     const dateRange = getDateRange();
     
-    // 设置日期选择器默认值
+    // 设置日期选择器默认值（使用数据分片时默认只显示已加载的最近几天）
+    const initialRange = shardedDb ? defaultShardRange() : { startDate: dateRange.minDate, endDate: dateRange.maxDate };
     if (dateRange.minDate) {
-        document.getElementById('startDate').value = dateRange.minDate;
-        filters.startDate = dateRange.minDate;
+        document.getElementById('startDate').min = dateRange.minDate;
+        document.getElementById('endDate').min = dateRange.minDate;
     }
     if (dateRange.maxDate) {
-        document.getElementById('endDate').value = dateRange.maxDate;
-        filters.endDate = dateRange.maxDate;
+        document.getElementById('startDate').max = dateRange.maxDate;
+        document.getElementById('endDate').max = dateRange.maxDate;
+    }
+    if (initialRange.startDate) {
+        document.getElementById('startDate').value = initialRange.startDate;
+        filters.startDate = initialRange.startDate;
+    }
+    if (initialRange.endDate) {
+        document.getElementById('endDate').value = initialRange.endDate;
+        filters.endDate = initialRange.endDate;
     }
-    
-    // 加载最新IP状态
-    loadLatestResults();
     
     // 加载第一页数据
     loadPagedResults();
@@ -192,8 +240,19 @@ function populateIpSelect() {
     });
 }
 
+// 使用数据分片时默认加载的日期范围（最近 DEFAULT_RANGE_DAYS 天，限制在已有数据内）
+function defaultShardRange() {
+    const { minDate, maxDate } = shardedDb.dateRange();
+    let startDate = shardDateOffset(1 - DEFAULT_RANGE_DAYS);
+    if (minDate && startDate < minDate) startDate = minDate;
+    return { startDate, endDate: maxDate };
+}
+
 // 获取数据库中的日期范围
 function getDateRange() {
+    if (shardedDb) {
+        return shardedDb.dateRange();
+    }
     try {
         const stmt = db.prepare("SELECT MIN(timestamp), MAX(timestamp) FROM ping_results");
         const result = stmt.getAsObject({});
@@ -241,18 +300,43 @@ function loadLatestResults() {
         updateSummaryCards(results);
         
         // 更新最后更新时间
-        if (results.length > 0) {
-            const latestTime = results.reduce((latest, current) => {
-                return (latest.timestamp > current.timestamp) ? latest : current;
-            }).timestamp;
-            
-            document.getElementById('lastUpdate').textContent = `最后更新时间: ${latestTime}`;
-        }
+        updateLastUpdateTime(results);
     } catch (error) {
         console.error('加载最新结果出错：', error);
     }
 }
 
+// 更新最后更新时间
+function updateLastUpdateTime(results) {
+    if (results.length > 0) {
+        const latestTime = results.reduce((latest, current) => {
+            return (latest.timestamp > current.timestamp) ? latest : current;
+        }).timestamp;
+        
+        document.getElementById('lastUpdate').textContent = `最后更新时间: ${latestTime}`;
+    }
+}
+
+// 从 ping_monitor.py 导出的 latest.json 渲染摘要卡片，无需等待SQL.js和数据库；成功时返回 true
+async function renderLatestSnapshot() {
+    try {
+        const response = await fetch('latest.json', { cache: 'no-cache' });
+        if (!response.ok) {
+            return false;
+        }
+        const snapshot = await response.json();
+        if (!Array.isArray(snapshot.results) || snapshot.results.length === 0) {
+            return false;
+        }
+        updateSummaryCards(snapshot.results);
+        updateLastUpdateTime(snapshot.results);
+        return true;
+    } catch (error) {
+        console.warn('读取最新状态快照失败，改为从数据库查询：', error);
+        return false;
+    }
+}
+
 // 更新摘要卡片
 function updateSummaryCards(results) {
     const container = document.getElementById('summaryContainer');
@@ -263,7 +347,7 @@ function updateSummaryCards(results) {
         const statusText = result.success === 1 ? '正常' : '错误';
         const avgLatency = result.success === 1 ? `${result.avg_latency} ms` : 'N/A';
         const packetLossRate = result.success === 1 ? 
-            ((result.packet_loss / PING_COUNT) * 100).toFixed(1) + '%' : 
+            ((result.packet_loss / (result.probe_count || PING_COUNT)) * 100).toFixed(1) + '%' : 
             '100%';
         
         const card = document.createElement('div');
@@ -382,12 +466,13 @@ function updateResultTable(results) {
             minLatency = `${entry.min_latency} ms`;
             maxLatency = `${entry.max_latency} ms`;
             
-            const packetLossRate = (entry.packet_loss / PING_COUNT) * 100;
+            // 自适应调度下每轮探测包数不同，旧数据没有 probe_count 时按 PING_COUNT 计
+            const packetLossRate = (entry.packet_loss / (entry.probe_count || PING_COUNT)) * 100;
             packetLoss = `${packetLossRate.toFixed(1)}%`;
             
-            // 解析延迟数据
-            const latencies = entry.latencies ? entry.latencies.split(',') : [];
-            latenciesDisplay = latencies.map(lat => parseFloat(lat).toFixed(1)).join(', ');
+            // 解析延迟数据（丢包的探测序号显示为 *）
+            const latencies = decodeLatencies(entry);
+            latenciesDisplay = latencies.map(lat => lat === null ? '*' : lat.toFixed(1)).join(', ');
         } else {
             avgLatency = 'N/A';
             minLatency = 'N/A';
@@ -413,6 +498,19 @@ function updateResultTable(results) {
     });
 }
 
+// 解码逐包延迟：优先使用 latencies_packed（小端 float32，每个探测序号一个槽位，NaN 表示丢包），
+// 旧数据回退到逗号分隔的 latencies 文本
+function decodeLatencies(entry) {
+    const packed = entry.latencies_packed;
+    if (packed && packed.byteLength) {
+        // 缓冲区未按4字节对齐时先复制一份
+        const bytes = packed.byteOffset % 4 === 0 ? packed : packed.slice();
+        const values = new Float32Array(bytes.buffer, bytes.byteOffset, Math.floor(bytes.byteLength / 4));
+        return Array.from(values, v => Number.isNaN(v) ? null : v);
+    }
+    return entry.latencies ? entry.latencies.split(',').map(parseFloat) : [];
+}
+
 // 更新分页控件
 function updatePagination() {
     const pagination = document.getElementById('pagination');
@@ -483,25 +581,36 @@ function updatePagination() {
 // 设置事件监听器
 function setupEventListeners() {
     // 筛选表单提交
-    document.getElementById('filterForm').addEventListener('submit', function(e) {
+    document.getElementById('filterForm').addEventListener('submit', async function(e) {
         e.preventDefault();
         
         filters.startDate = document.getElementById('startDate').value;
         filters.endDate = document.getElementById('endDate').value;
         filters.ipFilter = document.getElementById('ipFilter').value;
         
+        // 使用数据分片时先下载所选范围内尚未加载的分片
+        if (shardedDb) {
+            try {
+                await shardedDb.ensureRange(filters.startDate, filters.endDate);
+            } catch (error) {
+                console.error('加载数据分片出错：', error);
+            }
+        }
+        
         currentPage = 1;
         loadPagedResults();
     });
     
     // 重置筛选
     document.getElementById('resetFilter').addEventListener('click', function() {
-        document.getElementById('startDate').value = '';
-        document.getElementById('endDate').value = '';
+        // 使用数据分片时恢复默认范围，避免一次加载全部数据
+        const range = shardedDb ? defaultShardRange() : { startDate: '', endDate: '' };
+        document.getElementById('startDate').value = range.startDate || '';
+        document.getElementById('endDate').value = range.endDate || '';
         document.getElementById('ipFilter').value = '';
         
-        filters.startDate = '';
-        filters.endDate = '';
+        filters.startDate = range.startDate || '';
+        filters.endDate = range.endDate || '';
         filters.ipFilter = '';
         
         currentPage = 1;
@@ -518,6 +627,10 @@ function setupEventListeners() {
 
 // 页面加载完成后初始化
 document.addEventListener('DOMContentLoaded', () => {
+    // 先用 latest.json 显示摘要卡片，同时读取目标列表
+    latestSnapshotPromise = renderLatestSnapshot();
+    targetsPromise = fetchTargets();
+    
     // 初始化SQL.js并加载数据库
     initSqlJs();
 }); 
\ No newline at end of file
@@ -13,8 +13,25 @@ import math
 import sys
 import json
 import logging
+import signal
+import threading
+import queue
 from logging.handlers import RotatingFileHandler
 
+import db_backup
+import db_writer
+import icmp_probe
+import latency_codec
+import latency_stats
+import metrics
+import retention
+import rollups
+import static_export
+import scheduler
+import shard_pool
+import target_registry
+import vantage_sync
+
 # 日志配置
 LOG_FILE = "ping_monitor.log"
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
@@ -55,7 +72,7 @@ def setup_logger():
 # 创建日志记录器
 logger = setup_logger()
 
-# 指定要ping的IP地址列表及其地区
+# 默认的IP地址列表及其地区（ip_config.json 不存在时写入）
 IPS = [
     {"ip": "129.150.63.51", "region": "美国-凤凰城"},
     {"ip": "2603:c024:450a:90ab:fc23:a611:7a38:ca2d", "region": "美国-圣何塞"},
@@ -67,23 +84,23 @@ IPS = [
 # IP配置文件
 IP_CONFIG_FILE = "ip_config.json"
 
+# 监控目标注册表（按IP、分组和标签索引）
+TARGETS = target_registry.TargetRegistry(IP_CONFIG_FILE, logger)
+
 # 加载IP配置
 def load_ip_config():
     """从JSON文件加载IP配置"""
-    global IPS, IP_ADDRESSES
     if os.path.exists(IP_CONFIG_FILE):
         try:
-            with open(IP_CONFIG_FILE, 'r', encoding='utf-8') as f:
-                IPS = json.load(f)
-            # 更新IP地址列表
-            IP_ADDRESSES = [item["ip"] for item in IPS]
-            logger.info(f"成功加载IP配置，共{len(IPS)}个IP")
+            count = TARGETS.load()
+            logger.info(f"成功加载IP配置，共{count}个IP")
             return True
         except Exception as e:
             logger.error(f"加载IP配置失败: {str(e)}")
             return False
     else:
         # 创建默认配置
+        TARGETS.replace(IPS)
         save_ip_config()
         return True
 
@@ -91,8 +108,7 @@ def load_ip_config():
 def save_ip_config():
     """将IP配置保存到JSON文件"""
     try:
-        with open(IP_CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(IPS, f, ensure_ascii=False, indent=4)
+        TARGETS.save()
         logger.info(f"成功保存IP配置到{IP_CONFIG_FILE}")
         return True
     except Exception as e:
@@ -102,145 +118,335 @@ def save_ip_config():
 # 添加IP
 def add_ip(ip, region):
     """添加一个新的IP及其地区"""
-    # 检查IP是否已存在
-    for item in IPS:
-        if item["ip"] == ip:
-            logger.warning(f"IP {ip} 已存在，地区为 {item['region']}")
-            return False
-            
-    # 添加新IP
-    IPS.append({"ip": ip, "region": region})
+    try:
+        target = TARGETS.add({"ip": ip, "region": region})
+    except KeyError:
+        logger.warning(f"IP {ip} 已存在，地区为 {TARGETS.region(ip)}")
+        return False
+    except ValueError as e:
+        logger.error(f"添加 IP 失败: {str(e)}")
+        return False
+
     # 保存配置
     if save_ip_config():
-        logger.info(f"成功添加 IP: {ip}, 地区: {region}")
-        # 更新IP地址列表
-        global IP_ADDRESSES
-        IP_ADDRESSES = [item["ip"] for item in IPS]
+        logger.info(f"成功添加 IP: {target['ip']}, 地区: {target['region']}")
         return True
     return False
 
 # 修改IP地区
 def update_ip_region(ip, region):
     """修改现有IP的地区信息"""
-    for i, item in enumerate(IPS):
-        if item["ip"] == ip:
-            old_region = item["region"]
-            IPS[i]["region"] = region
-            if save_ip_config():
-                logger.info(f"成功更新 IP: {ip} 的地区从 {old_region} 到 {region}")
-                return True
-            return False
-    
-    logger.warning(f"IP {ip} 不存在")
+    try:
+        old, target = TARGETS.update(ip, region=region)
+    except KeyError:
+        logger.warning(f"IP {ip} 不存在")
+        return False
+
+    if save_ip_config():
+        logger.info(f"成功更新 IP: {target['ip']} 的地区从 {old['region']} 到 {target['region']}")
+        return True
     return False
 
 # 删除IP
 def delete_ip(ip):
     """删除一个IP"""
-    for i, item in enumerate(IPS):
-        if item["ip"] == ip:
-            region = item["region"]
-            IPS.pop(i)
-            if save_ip_config():
-                logger.info(f"成功删除 IP: {ip}, 地区: {region}")
-                # 更新IP地址列表
-                global IP_ADDRESSES
-                IP_ADDRESSES = [item["ip"] for item in IPS]
-                return True
-            return False
-    
-    logger.warning(f"IP {ip} 不存在")
+    try:
+        target = TARGETS.remove(ip)
+    except KeyError:
+        logger.warning(f"IP {ip} 不存在")
+        return False
+
+    if save_ip_config():
+        logger.info(f"成功删除 IP: {target['ip']}, 地区: {target['region']}")
+        return True
     return False
 
-# 更新JavaScript配置
-def update_js_config():
-    """更新JavaScript配置文件中的IP列表"""
-    js_file = "ping_monitor.js"
-    if not os.path.exists(js_file):
-        logger.error(f"JavaScript文件 {js_file} 不存在")
+def fill_missing_regions(items):
+    """用 traceroute_monitor 的地理位置后端（缓存、离线库或批量 API）补全缺少地区的条目"""
+    # 只有需要补全时才加载地理位置相关模块
+    import traceroute_monitor
+
+    pending = {}
+    for item in items:
+        if isinstance(item, dict) and not item.get("region"):
+            try:
+                ip = target_registry.normalize_ip(item.get("ip"))
+            except ValueError:
+                continue
+            if ip not in pending:
+                pending[ip] = traceroute_monitor.submit_geolocation(ip)
+    if not pending:
+        return 0
+    logger.info(f"正在查询 {len(pending)} 个IP的地区...")
+    filled = 0
+    try:
+        for item in items:
+            if not isinstance(item, dict) or item.get("region"):
+                continue
+            try:
+                future = pending.get(target_registry.normalize_ip(item.get("ip")))
+            except ValueError:
+                continue
+            result = future.result()
+            # 私有地址等没有具体地名的结果不用于补全
+            if result.get("status") == "success" and result.get("location"):
+                item["region"] = result["location"]
+                filled += 1
+    finally:
+        traceroute_monitor.close_geolocation()
+    logger.info(f"已补全 {filled} 个IP的地区")
+    return filled
+
+def print_target_diff(diff):
+    """显示批量导入的差异"""
+    for target in diff["added"]:
+        print(f"+ {target['ip']:<45} {target['region']}")
+    for old, target in diff["updated"]:
+        changes = [
+            f"{field}: {old.get(field)} -> {target.get(field)}"
+            for field in sorted(set(old) | set(target)) if old.get(field) != target.get(field)
+        ]
+        print(f"~ {target['ip']:<45} {', '.join(changes)}")
+    for target in diff["removed"]:
+        print(f"- {target['ip']:<45} {target['region']}")
+    for message in diff["invalid"]:
+        print(f"! {message}")
+    print(
+        f"新增 {len(diff['added'])}，修改 {len(diff['updated'])}，删除 {len(diff['removed'])}，"
+        f"未变化 {diff['unchanged']}，无效 {len(diff['invalid'])}，重复 {diff['duplicates']}"
+    )
+
+def import_ip_config(path, dry_run=False, replace=False, geo_fill=False):
+    """从 CSV/JSON 文件批量导入目标：校验、去重并合并，只写一次配置文件"""
+    try:
+        items = target_registry.read_targets_file(path)
+    except Exception as e:
+        logger.error(f"读取导入文件 {path} 失败: {str(e)}")
         return False
-    
+    if geo_fill:
+        fill_missing_regions(items)
+
+    diff = TARGETS.diff(items, replace=replace)
+    print_target_diff(diff)
+    if dry_run:
+        print("试运行，未修改配置")
+        return True
+    if not (diff["added"] or diff["updated"] or diff["removed"]):
+        logger.info("导入的目标与当前配置一致，无需修改")
+        return True
+
+    TARGETS.apply(diff)
+    if save_ip_config():
+        logger.info(
+            f"成功导入 {path}：新增 {len(diff['added'])} 个，修改 {len(diff['updated'])} 个，"
+            f"删除 {len(diff['removed'])} 个目标"
+        )
+        return True
+    return False
+
+def export_ip_config(path=None):
+    """把目标导出为 CSV/JSON 文件（按扩展名），未指定文件时以 JSON 输出到标准输出"""
+    fmt = "csv" if path and path.lower().endswith(".csv") else "json"
+    content = target_registry.format_targets(TARGETS.targets(), fmt)
+    if path is None:
+        sys.stdout.write(content)
+        return True
     try:
-        # 读取JavaScript文件
-        with open(js_file, 'r', encoding='utf-8') as f:
-            js_content = f.read()
-        
-        # 构建新的IP配置字符串
-        ip_config_str = "const IPS = [\n"
-        for item in IPS:
-            ip_config_str += f'    {{ip: "{item["ip"]}", region: "{item["region"]}"}},\n'
-        ip_config_str += "];"
-        
-        # 使用正则表达式替换IP配置部分
-        import re
-        pattern = r'const IPS = \[.*?\];'
-        new_js_content = re.sub(pattern, ip_config_str, js_content, flags=re.DOTALL)
-        
-        # 保存更新后的JavaScript文件
-        with open(js_file, 'w', encoding='utf-8') as f:
-            f.write(new_js_content)
-        
-        logger.info(f"成功更新JavaScript配置文件 {js_file}")
+        static_export.write_file_atomic(path, content.encode('utf-8'))
+        logger.info(f"成功导出 {len(TARGETS)} 个目标到 {path}")
         return True
     except Exception as e:
-        logger.error(f"更新JavaScript配置失败: {str(e)}")
+        logger.error(f"导出目标到 {path} 失败: {str(e)}")
         return False
 
-# 初始化IP地址列表，注意这里仅包含IP而不是完整的字典对象
-IP_ADDRESSES = [item["ip"] for item in IPS]
+# 导出网页使用的目标列表
+def export_targets():
+    """把当前目标列表写入网页读取的 targets.json（内容不变时不重写）"""
+    try:
+        digest = static_export.export_targets(TARGETS.targets(), static_export.TARGETS_FILE)
+        logger.debug(f"目标列表已导出到 {static_export.TARGETS_FILE}（版本 {digest}）")
+        return True
+    except Exception as e:
+        logger.error(f"导出目标列表失败: {str(e)}")
+        return False
 
 # 每个IP ping的次数
 PING_COUNT = 10
 
+# 探测引擎: "icmp" 使用内置的异步 ICMP 引擎, "subprocess" 使用系统 ping 命令
+PROBE_ENGINE = "icmp"
+# 同一目标两次探测之间的间隔（秒）
+PROBE_INTERVAL = 1.0
+# 单次探测的超时时间（秒）
+PROBE_TIMEOUT = 1.0
+
+# 常驻模式: 未在 ip_config.json 中指定 interval 的目标的默认探测间隔（秒）
+DAEMON_DEFAULT_INTERVAL = 300
+# 常驻模式: 数据库备份间隔（秒），与快照保留策略的最小粒度一致
+DAEMON_BACKUP_INTERVAL = db_backup.MIN_BACKUP_INTERVAL
+# 常驻模式: 旧数据清理间隔（秒）
+DAEMON_CLEANUP_INTERVAL = 24 * 3600
+# 常驻模式: 导出网页数据分片的间隔（秒）
+DAEMON_EXPORT_INTERVAL = 60
+# 常驻模式: 同时进行的探测轮次上限
+DAEMON_MAX_CONCURRENT_ROUNDS = 4
+# 常驻模式: 调度循环的最长等待时间（秒）
+DAEMON_TICK = 1.0
+# 常驻模式: Prometheus 指标端口，0 表示不启动指标服务
+METRICS_PORT = 0
+# 常驻模式: 指标服务监听的地址，空字符串表示所有地址
+METRICS_HOST = ""
+# 启用指标服务时的内存指标（metrics.MetricsRegistry），未启用时为 None
+METRICS = None
+# 分片探测的工作进程数（按IP一致性哈希分配目标），0 或 1 时在主进程中探测
+SHARD_WORKERS = 0
+# SHARD_WORKERS > 1 时的分片探测进程池（shard_pool.ShardPool）
+SHARD_POOL = None
+# 分片执行时间上限在预计耗时之外的余量（秒），超过上限的工作进程视为卡住并被结束
+SHARD_TIME_MARGIN = 30
+# 使用系统 ping 命令探测时的最大并发数
+SUBPROCESS_PING_WORKERS = 5
+# 本机的采集点编号（保存在数据库的 sync_meta 表中，默认为主机名），init_database 时读取
+VANTAGE_ID = None
+# 收集端地址：推送本机的新结果（单次运行时推送一次，常驻模式下按 DAEMON_SYNC_INTERVAL 推送）
+SYNC_PUSH_URL = ""
+# 代理端地址列表：从这些采集点拉取新结果合并到本库
+SYNC_PULL_URLS = []
+# 同步服务端口（0 表示不启动），既接收推送也供收集端拉取
+SYNC_PORT = 0
+# 同步服务监听地址，默认只接受本机连接；监听其他地址时必须设置 SYNC_TOKEN
+SYNC_HOST = vantage_sync.DEFAULT_HOST
+# 同步请求的共享令牌（为空时不校验，只能监听本机地址）
+SYNC_TOKEN = ""
+# 常驻模式: 推送/拉取的间隔（秒）
+DAEMON_SYNC_INTERVAL = 60
+# 常驻模式: 检查 ip_config.json 是否被修改的间隔（秒）
+DAEMON_CONFIG_CHECK_INTERVAL = 5.0
+# 常驻模式: 根据丢包和抖动自动调整各目标的探测间隔和每轮探测包数
+ADAPTIVE_SCHEDULING = True
+# 自适应级别 -> (间隔倍数, 探测包数倍数)
+ADAPTIVE_LEVELS = {
+    scheduler.LEVEL_QUIET: (2.0, 0.5),   # 连续稳定: 降低采样
+    scheduler.LEVEL_NORMAL: (1.0, 1.0),
+    scheduler.LEVEL_ALERT: (0.25, 2.0),  # 丢包或抖动: 加密采样
+}
+# 单轮丢包率达到该值即进入 alert 级别
+ADAPTIVE_LOSS_THRESHOLD = 0.1
+# 单轮 RFC 3550 抖动达到该值（毫秒）即进入 alert 级别
+ADAPTIVE_JITTER_THRESHOLD = 20.0
+# alert 级别连续正常多少轮后恢复为 normal
+ADAPTIVE_RECOVERY_ROUNDS = 3
+# normal 级别连续正常多少轮后降为 quiet
+ADAPTIVE_QUIET_ROUNDS = 12
+# 每轮最少探测包数
+ADAPTIVE_MIN_COUNT = 3
+# 所有目标合计的平均发包速率上限（包/秒），0 表示不限制
+DAEMON_PPS_BUDGET = 20.0
+
 # 数据库文件路径
 DB_FILE = "ping_data.db"
+# 原始结果（ping_results）的保留天数，0 表示不清理
+DATA_RETENTION_DAYS = retention.RAW_RETENTION_DAYS
+# 预聚合表的保留天数，0 表示不清理
+ROLLUP_RETENTION_DAYS = retention.ROLLUP_RETENTION_DAYS
+
+# 逐包延迟的存储方式:
+#   "packed" - 只写入 latencies_packed（float32 BLOB，每个探测序号一个槽位，丢包为 NaN）
+#   "text"   - 只写入旧的逗号分隔文本列 latencies
+#   "both"   - 两者都写入
+LATENCY_STORAGE = "packed"
 
 # 数据库备份目录
 BACKUP_DIR = "backups"
 
-def backup_database():
-    """备份数据库文件"""
-    if not os.path.exists(BACKUP_DIR):
-        os.makedirs(BACKUP_DIR)
-    
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_file = os.path.join(BACKUP_DIR, f"ping_data_{timestamp}.db")
-    
+# 是否为网页导出按天切分的数据分片（shards/ 目录）
+EXPORT_SHARDS = True
+# 是否为网页导出最新状态和汇总快照（latest.json / summary.json）
+EXPORT_SNAPSHOTS = True
+
+def backup_database(force=False):
+    """创建数据库快照并按保留策略清理旧快照
+
+    默认距上一份快照不足 db_backup.MIN_BACKUP_INTERVAL 秒时跳过；force=True 时总是备份。
+    """
+    if not os.path.exists(DB_FILE):
+        logger.warning(f"数据库文件 {DB_FILE} 不存在，跳过备份")
+        return False
     try:
-        import shutil
-        shutil.copy2(DB_FILE, backup_file)
-        logger.info(f"数据库备份成功: {backup_file}")
+        db_backup.backup_if_due(DB_FILE, BACKUP_DIR, min_interval=0 if force else db_backup.MIN_BACKUP_INTERVAL)
         return True
     except Exception as e:
         logger.error(f"数据库备份失败: {str(e)}")
         return False
 
-def cleanup_old_data(days=30):
-    """清理指定天数前的数据"""
+def restore_database(snapshot):
+    """从快照恢复数据库，snapshot 为 "latest" 时使用最新的快照"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # 计算截止日期
-        cutoff_date = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
-        
-        # 删除旧数据
-        cursor.execute("DELETE FROM ping_results WHERE timestamp < ?", (cutoff_date,))
-        deleted_count = cursor.rowcount
-        
-        conn.commit()
-        conn.close()
-        
-        logger.info(f"成功清理{deleted_count}条{days}天前的数据")
+        if snapshot == "latest":
+            snapshots = db_backup.list_snapshots(BACKUP_DIR)
+            if not snapshots:
+                logger.error(f"备份目录 {BACKUP_DIR} 中没有可用的快照")
+                return False
+            snapshot = snapshots[-1][1]
+        db_backup.restore_snapshot(snapshot, DB_FILE)
+        logger.info(f"已从 {snapshot} 恢复数据库")
+        return True
+    except Exception as e:
+        logger.error(f"恢复数据库失败: {str(e)}")
+        return False
+
+def cleanup_old_data(days=None):
+    """清理 days 天（默认 DATA_RETENTION_DAYS）前的原始数据和 ROLLUP_RETENTION_DAYS 天前的预聚合数据
+
+    按 epoch 索引分块删除并增量回收空闲页，见 retention.py。
+    """
+    days = DATA_RETENTION_DAYS if days is None else days
+    try:
+        deleted, freed_pages = retention.purge_expired(
+            DB_FILE, ("ping_results", "ping_rollups", "ping_rollup_histogram"), days, ROLLUP_RETENTION_DAYS
+        )
+        if deleted.get("ping_results"):
+            logger.info(f"成功清理{deleted['ping_results']}条{days}天前的数据")
+        rollup_count = deleted.get("ping_rollups", 0) + deleted.get("ping_rollup_histogram", 0)
+        if rollup_count:
+            logger.info(f"成功清理{rollup_count}条{ROLLUP_RETENTION_DAYS}天前的预聚合数据")
+        if freed_pages:
+            logger.info(f"回收了 {freed_pages} 个空闲页")
         return True
     except Exception as e:
         logger.error(f"清理旧数据失败: {str(e)}")
         return False
 
+def compact_database():
+    """启用增量回收并整库 VACUUM 一次（已有数据库只需执行一次）"""
+    try:
+        init_database()
+        before, after = retention.compact(DB_FILE)
+        logger.info(f"数据库压缩完成: {before / 1048576:.1f} MB -> {after / 1048576:.1f} MB，之后的清理会增量回收空间")
+        return True
+    except Exception as e:
+        logger.error(f"压缩数据库失败: {str(e)}")
+        return False
+
+# 在原始表结构之后新增的列，旧数据库初始化时补充
+PING_EXTRA_COLUMNS = [
+    ('latencies_packed', 'BLOB'),
+    # 逐包延迟的统计量（毫秒，精确到微秒），见 latency_stats.py
+    ('mean_latency', 'REAL'),
+    ('p50_latency', 'REAL'),
+    ('p90_latency', 'REAL'),
+    ('p99_latency', 'REAL'),
+    ('mdev_latency', 'REAL'),
+    ('jitter', 'REAL'),
+    # 本轮发送的探测包数（自适应调度下各轮不同，旧数据为空时按 PING_COUNT 计）
+    ('probe_count', 'INTEGER'),
+]
+
 def init_database():
     """初始化SQLite数据库"""
+    global VANTAGE_ID
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = db_writer.configure_connection(sqlite3.connect(DB_FILE))
         cursor = conn.cursor()
         
         # 创建ping结果表
@@ -256,14 +462,36 @@ def init_database():
             max_latency REAL,
             packet_loss INTEGER,
             latencies TEXT,
-            error TEXT
+            error TEXT,
+            latencies_packed BLOB,
+            mean_latency REAL,
+            p50_latency REAL,
+            p90_latency REAL,
+            p99_latency REAL,
+            mdev_latency REAL,
+            jitter REAL
         )
         ''')
         
+        # 旧数据库补充新增的列
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(ping_results)')}
+        for column, col_type in PING_EXTRA_COLUMNS:
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE ping_results ADD COLUMN {column} {col_type}')
+        
         # 创建索引以提高查询效率
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_ip ON ping_results (ip)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON ping_results (timestamp)')
         
+        # 数据保留使用的整数时间戳列
+        retention.init_epoch_column(conn, "ping_results")
+        
+        # 采集点编号和合并去重用的列
+        VANTAGE_ID = vantage_sync.init_sync_schema(conn, "ping_results", VANTAGE_ID)
+        
+        # 创建预聚合表
+        rollups.init_rollup_tables(conn)
+        
         conn.commit()
         conn.close()
         logger.info("数据库初始化成功")
@@ -271,59 +499,193 @@ def init_database():
         logger.error(f"数据库初始化失败: {str(e)}")
         raise
 
+def migrate_latencies(batch_size=5000):
+    """将旧的逗号分隔延迟文本转换为 latencies_packed
+
+    LATENCY_STORAGE 为 "packed" 时同时清空文本列；分批提交，避免长时间持有写锁。
+    """
+    try:
+        init_database()
+        conn = db_writer.configure_connection(sqlite3.connect(DB_FILE, timeout=db_writer.BUSY_TIMEOUT))
+        clear_text = LATENCY_STORAGE == "packed"
+        converted = 0
+        while True:
+            rows = conn.execute('''
+                SELECT id, latencies, packet_loss FROM ping_results
+                WHERE latencies IS NOT NULL AND latencies_packed IS NULL
+                LIMIT ?
+            ''', (batch_size,)).fetchall()
+            if not rows:
+                break
+            updates = [
+                (latency_codec.encode_samples(latency_codec.samples_from_text(text, packet_loss)), row_id)
+                for row_id, text, packet_loss in rows
+            ]
+            with conn:
+                conn.executemany('UPDATE ping_results SET latencies_packed = ? WHERE id = ?', updates)
+                if clear_text:
+                    conn.executemany('UPDATE ping_results SET latencies = NULL WHERE id = ?', [(row_id,) for _, row_id in updates])
+            converted += len(rows)
+            logger.info(f"已转换 {converted} 条延迟记录")
+        conn.close()
+        logger.info(f"延迟数据迁移完成，共转换 {converted} 条记录（可执行 --compact 回收空间）")
+        return True
+    except Exception as e:
+        logger.error(f"延迟数据迁移失败: {str(e)}")
+        return False
+
+def decode_stored_latencies(row):
+    """从 (ip, timestamp, success, packet_loss, latencies, latencies_packed) 还原 (延迟列表, 丢包数)"""
+    _ip, _timestamp, success, packet_loss, text, packed = row
+    if not success:
+        return [], packet_loss if packet_loss is not None else PING_COUNT
+    if packed is not None:
+        return latency_codec.received_latencies(packed), packet_loss or 0
+    latencies = [float(x) for x in text.split(',') if x.strip()] if text else []
+    return latencies, packet_loss or 0
+
+def backfill_rollups():
+    """根据已有的原始数据重建预聚合表"""
+    try:
+        init_database()
+        conn = db_writer.configure_connection(sqlite3.connect(DB_FILE, timeout=db_writer.BUSY_TIMEOUT))
+        raw_cutoff = None
+        if DATA_RETENTION_DAYS > 0:
+            raw_cutoff = (datetime.datetime.now() - datetime.timedelta(days=DATA_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        processed = rollups.backfill_rollups(conn, decode_stored_latencies, raw_cutoff=raw_cutoff)
+        conn.close()
+        logger.info(f"预聚合表回填完成，共处理 {processed} 条原始记录")
+        return True
+    except Exception as e:
+        logger.error(f"预聚合表回填失败: {str(e)}")
+        return False
+
+def backfill_latency_stats(batch_size=5000):
+    """为升级前的记录补算 mean/p50/p90/p99/mdev/jitter 列"""
+    try:
+        init_database()
+        conn = db_writer.configure_connection(sqlite3.connect(DB_FILE, timeout=db_writer.BUSY_TIMEOUT))
+        last_id = 0
+        updated = 0
+        while True:
+            rows = conn.execute('''
+                SELECT id, latencies, latencies_packed FROM ping_results
+                WHERE id > ? AND success = 1 AND mean_latency IS NULL
+                ORDER BY id LIMIT ?
+            ''', (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for row_id, text, packed in rows:
+                if packed is not None:
+                    samples = latency_codec.decode_samples(packed)
+                else:
+                    samples = [float(x) for x in text.split(',') if x.strip()] if text else []
+                stats = latency_stats.compute_stats(samples)
+                if stats is not None:
+                    updates.append((stats["mean"], stats["p50"], stats["p90"], stats["p99"],
+                                    stats["mdev"], stats["jitter"], row_id))
+            with conn:
+                conn.executemany('''
+                    UPDATE ping_results SET mean_latency = ?, p50_latency = ?, p90_latency = ?,
+                        p99_latency = ?, mdev_latency = ?, jitter = ?
+                    WHERE id = ?
+                ''', updates)
+            last_id = rows[-1][0]
+            updated += len(updates)
+            logger.info(f"已补算 {updated} 条记录的延迟统计")
+        conn.close()
+        logger.info(f"延迟统计补算完成，共更新 {updated} 条记录")
+        return True
+    except Exception as e:
+        logger.error(f"延迟统计补算失败: {str(e)}")
+        return False
+
 def get_ip_region(ip):
     """根据IP获取对应的地区信息"""
-    for item in IPS:
-        if item["ip"] == ip:
-            return item["region"]
-    return "未知地区"
+    return TARGETS.region(ip)
+
+def target_probe_settings(ip):
+    """目标每轮的 (探测包数, 单次探测超时秒数)，未单独设置时使用全局默认值"""
+    target = TARGETS.get(ip) or {}
+    return target.get("count", PING_COUNT), target.get("timeout", PROBE_TIMEOUT)
 
-def ping_ip(ip):
-    """对指定IP进行ping测试并返回结果"""
+def group_by_probe_settings(ips):
+    """按探测包数和超时分组，同一组的目标可以在同一轮中探测"""
+    groups = {}
+    for ip in ips:
+        groups.setdefault(target_probe_settings(ip), []).append(ip)
+    return groups
+
+def parse_ping_output(output, count, first_seq=1):
+    """解析系统ping命令的输出（Linux/macOS/Windows，含中文"时间="），返回测试结果字典
+
+    first_seq 为第一个探测包的 icmp_seq（macOS 从0开始，Linux 从1开始）。
+    """
     results = []
+    # 每个探测序号对应的延迟，未收到回复为 None
+    samples = [None] * count
+
+    # 解析输出提取延迟数据
+    lines = output.splitlines()
+    for line in lines:
+        if "time=" in line or "时间=" in line:
+            # 提取延迟值
+            parts = line.split("time=") if "time=" in line else line.split("时间=")
+            if len(parts) > 1:
+                latency_part = parts[1].strip().split()[0]
+                latency = float(latency_part.replace("ms", ""))
+                results.append(latency)
+                
+                # 记录延迟对应的探测序号（Windows 输出中没有序号，按到达顺序排列）
+                seq_index = len(results) - 1
+                if "icmp_seq=" in line:
+                    seq_part = line.split("icmp_seq=")[1].split()[0]
+                    if seq_part.isdigit():
+                        seq_index = int(seq_part) - first_seq
+                if 0 <= seq_index < count:
+                    samples[seq_index] = latency
+    
+    # 计算平均、最小、最大延迟
+    if results:
+        avg_latency = sum(results) / len(results)
+        min_latency = min(results)
+        max_latency = max(results)
+        return {
+            "success": True,
+            "latencies": results,
+            "samples": samples,
+            "average": round(avg_latency),  # 精确到整数
+            "min": round(min_latency),      # 精确到整数
+            "max": round(max_latency),      # 精确到整数
+            "packet_loss": count - len(results)
+        }
+    else:
+        return {
+            "success": False,
+            "error": "无法解析延迟值"
+        }
+
+def ping_ip(ip, count=None, timeout=None):
+    """对指定IP进行ping测试并返回结果（count 为探测包数，timeout 为每包超时秒数）"""
+    count = count or PING_COUNT
+    timeout = timeout or PROBE_TIMEOUT
+    # macOS 的 icmp_seq 从0开始，Linux 从1开始
+    first_seq = 0 if platform.system().lower() == "darwin" else 1
     
     # 根据操作系统调整ping命令
     ping_cmd = []
     if platform.system().lower() == "windows":
         # Windows系统下的ping命令
-        ping_cmd = ["ping", "-n", str(PING_COUNT), "-w", "1000", ip]  # 添加1秒超时
+        ping_cmd = ["ping", "-n", str(count), "-w", str(int(timeout * 1000)), ip]  # 超时单位为毫秒
     else:
         # Linux/Mac系统下的ping命令
-        ping_cmd = ["ping", "-c", str(PING_COUNT), "-W", "1", ip]  # 添加1秒超时
+        ping_cmd = ["ping", "-c", str(count), "-W", str(max(1, math.ceil(timeout))), ip]  # 超时单位为秒
     
     try:
         # 执行ping命令
         output = subprocess.check_output(ping_cmd, universal_newlines=True, stderr=subprocess.STDOUT)
-        
-        # 解析输出提取延迟数据
-        lines = output.splitlines()
-        for line in lines:
-            if "time=" in line or "时间=" in line:
-                # 提取延迟值
-                parts = line.split("time=") if "time=" in line else line.split("时间=")
-                if len(parts) > 1:
-                    latency_part = parts[1].strip().split()[0]
-                    latency = float(latency_part.replace("ms", ""))
-                    results.append(latency)
-        
-        # 计算平均、最小、最大延迟
-        if results:
-            avg_latency = sum(results) / len(results)
-            min_latency = min(results)
-            max_latency = max(results)
-            return {
-                "success": True,
-                "latencies": results,
-                "average": round(avg_latency),  # 精确到整数
-                "min": round(min_latency),      # 精确到整数
-                "max": round(max_latency),      # 精确到整数
-                "packet_loss": PING_COUNT - len(results)
-            }
-        else:
-            return {
-                "success": False,
-                "error": "无法解析延迟值"
-            }
+        return parse_ping_output(output, count, first_seq)
     except subprocess.CalledProcessError as e:
         logger.error(f"Ping {ip} 失败: {str(e)}")
         return {
@@ -337,97 +699,577 @@ def ping_ip(ip):
             "error": str(e)
         }
 
-def save_result_to_db(result):
-    """将结果保存到SQLite数据库"""
+# ping_results 插入语句
+PING_INSERT_SQL = '''
+INSERT INTO ping_results 
+(ip, region, timestamp, success, avg_latency, min_latency, max_latency, packet_loss, latencies, error, latencies_packed,
+ mean_latency, p50_latency, p90_latency, p99_latency, mdev_latency, jitter, probe_count, vantage_id, epoch)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def latency_stat_columns(result):
+    """计算 mean/p50/p90/p99/mdev/jitter 列的值"""
+    samples = result.get("samples")
+    if samples is None:
+        samples = result["latencies"]
+    stats = latency_stats.compute_stats(samples)
+    if stats is None:
+        return (None,) * 6
+    return (stats["mean"], stats["p50"], stats["p90"], stats["p99"], stats["mdev"], stats["jitter"])
+
+def encode_latency_columns(result):
+    """按 LATENCY_STORAGE 生成 (latencies 文本, latencies_packed BLOB)"""
+    text = packed = None
+    if LATENCY_STORAGE in ("text", "both"):
+        text = ','.join(str(x) for x in result["latencies"])
+    if LATENCY_STORAGE in ("packed", "both"):
+        samples = result.get("samples")
+        if samples is None:
+            samples = result["latencies"] + [None] * result["packet_loss"]
+        packed = latency_codec.encode_samples(samples)
+    return text, packed
+
+def result_to_row(result):
+    """将测试结果转换为 ping_results 表的一行"""
+    # 获取IP对应的地区
+    region = get_ip_region(result["ip"])
+
+    if result["success"]:
+        latencies_text, latencies_packed = encode_latency_columns(result)
+        return (
+            result["ip"],
+            region,
+            result["timestamp"],
+            1,  # success=True
+            result["average"],
+            result["min"],
+            result["max"],
+            result["packet_loss"],
+            latencies_text,
+            None,
+            latencies_packed
+        ) + latency_stat_columns(result) + (
+            result.get("probe_count", PING_COUNT), VANTAGE_ID, retention.epoch_seconds(result["timestamp"])
+        )
+    return (
+        result["ip"],
+        region,
+        result["timestamp"],
+        0,  # success=False
+        None,
+        None,
+        None,
+        result.get("probe_count", PING_COUNT),  # 全部丢包
+        None,
+        result["error"],
+        None
+    ) + (None,) * 6 + (result.get("probe_count", PING_COUNT), VANTAGE_ID, retention.epoch_seconds(result["timestamp"]))
+
+def save_results_to_db(results):
+    """将一轮的所有结果连同预聚合表的增量在一个事务中写入数据库"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # 获取IP对应的地区
-        region = get_ip_region(result["ip"])
-        
-        if result["success"]:
-            cursor.execute('''
-            INSERT INTO ping_results 
-            (ip, region, timestamp, success, avg_latency, min_latency, max_latency, packet_loss, latencies, error)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                result["ip"],
-                region,
-                result["timestamp"],
-                1,  # success=True
-                result["average"],
-                result["min"],
-                result["max"],
-                result["packet_loss"],
-                ','.join(str(x) for x in result["latencies"]),
-                None
-            ))
-        else:
-            cursor.execute('''
-            INSERT INTO ping_results 
-            (ip, region, timestamp, success, avg_latency, min_latency, max_latency, packet_loss, latencies, error)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                result["ip"],
-                region,
-                result["timestamp"],
-                0,  # success=False
-                None,
-                None,
-                None,
-                PING_COUNT,  # 全部丢包
-                None,
-                result["error"]
-            ))
-        
-        conn.commit()
-        conn.close()
-        logger.debug(f"成功保存 {result['ip']} 的测试结果到数据库")
+        statements = [(PING_INSERT_SQL, [result_to_row(r) for r in results])]
+        statements.extend(rollups.accumulate_results(results, PING_COUNT))
+        started = time.perf_counter()
+        count = db_writer.get_writer(DB_FILE).write_group(statements)
+        if METRICS is not None:
+            METRICS.observe("db_write_duration_seconds", time.perf_counter() - started)
+        logger.debug(f"成功保存 {len(results)} 条测试结果到数据库（含预聚合表共写入 {count} 行）")
+        return True
     except Exception as e:
+        if METRICS is not None:
+            METRICS.inc("db_write_errors_total")
         logger.error(f"保存测试结果到数据库失败: {str(e)}")
+        return False
+
+def save_result_to_db(result):
+    """将单条结果保存到SQLite数据库"""
+    return save_results_to_db([result])
+
+def handle_ping_result(ip, result, timestamp, count=PING_COUNT):
+    """补全结果中的IP、时间戳和本轮探测包数"""
+    result["ip"] = ip
+    result["timestamp"] = timestamp
+    result["probe_count"] = count
+
+    logger.info(f"IP {ip} ({get_ip_region(ip)}) 测试完成")
+    return result
+
+def run_subprocess_pings(ips, timestamp, count=PING_COUNT, timeout=None):
+    """使用系统ping命令并行测试指定IP，返回结果列表"""
+    results = []
+    # 使用线程池并行执行ping测试
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(ips), SUBPROCESS_PING_WORKERS)) as executor:  # 限制最大并发数
+        # 提交所有ping任务
+        future_to_ip = {executor.submit(ping_ip, ip, count, timeout): ip for ip in ips}
+
+        # 处理结果
+        for future in concurrent.futures.as_completed(future_to_ip):
+            ip = future_to_ip[future]
+            try:
+                results.append(handle_ping_result(ip, future.result(), timestamp, count))
+            except Exception as e:
+                logger.error(f"IP {ip} 测试出错: {str(e)}")
+    return results
+
+def probe_targets(ips, count, timeout, timestamp):
+    """探测一组IP并解析结果（不写数据库），分片模式下在工作进程中执行"""
+    results = []
+    # 需要使用系统 ping 命令探测的IP
+    fallback_ips = list(ips)
+
+    if PROBE_ENGINE == "icmp":
+        try:
+            probe_results, fallback_ips = icmp_probe.probe_targets(
+                ips, count, interval=PROBE_INTERVAL, timeout=timeout
+            )
+            for ip, result in probe_results.items():
+                results.append(handle_ping_result(ip, result, timestamp, count))
+            if fallback_ips:
+                logger.warning(f"{len(fallback_ips)} 个IP无法使用ICMP引擎，改用系统ping命令")
+        except icmp_probe.ICMPUnavailable as e:
+            logger.warning(f"ICMP引擎不可用（{str(e)}），改用系统ping命令")
+            fallback_ips = list(ips)
+
+    if fallback_ips:
+        results.extend(run_subprocess_pings(fallback_ips, timestamp, count, timeout))
+    return results
+
+def run_probe_round(ips, count=None, timeout=None):
+    """对指定IP执行一轮探测（每个IP发送 count 个包，默认 PING_COUNT），并将整轮结果写入数据库
+
+    分片模式下各分片在工作进程中探测，每个分片完成后立即写入，不必等待最慢的分片；
+    分片超过 shard_time_limit 仍未完成时以 ShardError 失败，卡住的工作进程被结束后重启。
+    """
+    count = count or PING_COUNT
+    timeout = timeout or PROBE_TIMEOUT
+    started = time.perf_counter()
+    # 当前时间戳
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    if SHARD_POOL is not None:
+        results = []
+        largest = max(map(len, SHARD_POOL.ring.split(ips).values()), default=0)
+        futures = SHARD_POOL.submit(ips, count, timeout, timestamp,
+                                    time_limit=shard_time_limit(largest, count, timeout))
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                shard_results = future.result()
+            except shard_pool.ShardError as e:
+                logger.error(str(e))
+                continue
+            save_results_to_db(shard_results)
+            results.extend(shard_results)
+    else:
+        results = probe_targets(ips, count, timeout, timestamp)
+        save_results_to_db(results)
+    if METRICS is not None:
+        for result in results:
+            METRICS.record_result(result, get_ip_region(result["ip"]))
+        METRICS.observe("probe_round_duration_seconds", time.perf_counter() - started)
+        METRICS.inc("probe_rounds_total")
+    return results
+
+def init_shard_worker(engine):
+    """分片工作进程的初始化：使用与主进程相同的探测引擎，spawn 方式启动时重新加载目标（用于日志中的地区）"""
+    global PROBE_ENGINE
+    PROBE_ENGINE = engine
+    if not len(TARGETS) and os.path.exists(IP_CONFIG_FILE):
+        TARGETS.load()
+
+def start_shard_pool():
+    """SHARD_WORKERS > 1 时启动分片探测进程，失败时记录错误并在主进程中探测"""
+    global SHARD_POOL
+    if SHARD_WORKERS <= 1 or SHARD_POOL is not None:
+        return
+    try:
+        SHARD_POOL = shard_pool.ShardPool(SHARD_WORKERS, probe_targets, init_shard_worker, (PROBE_ENGINE,)).start()
+        logger.info(f"分片探测已启用，共 {SHARD_WORKERS} 个工作进程")
+    except Exception as e:
+        logger.error(f"启动分片探测进程失败，改为在主进程中探测: {str(e)}")
+        SHARD_POOL = None
+
+def stop_shard_pool():
+    """关闭分片探测进程"""
+    global SHARD_POOL
+    if SHARD_POOL is not None:
+        SHARD_POOL.close()
+        SHARD_POOL = None
+
+def export_latest_snapshot():
+    """导出首页摘要卡片使用的 latest.json"""
+    if not EXPORT_SNAPSHOTS:
+        return
+    try:
+        static_export.export_latest(DB_FILE, TARGETS.ips(), static_export.LATEST_FILE, PING_COUNT)
+    except Exception as e:
+        logger.error(f"导出最新状态快照失败: {str(e)}")
+
+def export_static_files():
+    """导出供网页使用的数据分片和汇总快照"""
+    if EXPORT_SHARDS:
+        try:
+            updated = static_export.export_shards(DB_FILE, static_export.SHARD_DIR)
+            logger.debug(f"已更新 {updated} 个数据分片")
+        except Exception as e:
+            logger.error(f"导出数据分片失败: {str(e)}")
+    if EXPORT_SNAPSHOTS:
+        try:
+            static_export.export_summary(DB_FILE, static_export.SUMMARY_FILE)
+        except Exception as e:
+            logger.error(f"导出汇总快照失败: {str(e)}")
 
 def run_ping_test():
     """执行ping测试并更新数据"""
     try:
+        # 工作进程在主进程启动写入线程之前创建
+        start_shard_pool()
+
         # 初始化数据库（如果不存在）
         init_database()
         
-        # 备份数据库
-        backup_database()
-        
         # 清理旧数据
         cleanup_old_data()
         
-        # 当前时间戳
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # 探测包数或超时单独设置的目标分组探测
+        for (count, timeout), ips in group_by_probe_settings(TARGETS.ips()).items():
+            run_probe_round(ips, count, timeout)
         
-        # 使用线程池并行执行ping测试
-        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(IP_ADDRESSES), 5)) as executor:  # 限制最大并发数
-            # 提交所有ping任务
-            future_to_ip = {executor.submit(ping_ip, ip): ip for ip in IP_ADDRESSES}
-            
-            # 处理结果
-            for future in concurrent.futures.as_completed(future_to_ip):
-                ip = future_to_ip[future]
-                try:
-                    result = future.result()
-                    result["ip"] = ip
-                    result["timestamp"] = timestamp
-                    
-                    # 保存到数据库
-                    save_result_to_db(result)
-                    
-                    logger.info(f"IP {ip} ({get_ip_region(ip)}) 测试完成")
-                except Exception as e:
-                    logger.error(f"IP {ip} 测试出错: {str(e)}")
+        # 更新网页使用的目标列表、最新状态、汇总快照和数据分片
+        export_targets()
+        export_latest_snapshot()
+        export_static_files()
         
         logger.info("所有Ping测试完成，数据已保存到数据库")
     except Exception as e:
         logger.error(f"执行ping测试失败: {str(e)}")
+    finally:
+        stop_shard_pool()
+        db_writer.close_writer(DB_FILE)
+
+def init_traceroute_tables():
+    """收集端需要 traceroute_results 表才能合并 traceroute 结果"""
+    try:
+        import traceroute_monitor
+    except ImportError as e:
+        logger.warning(f"无法加载 traceroute_monitor（{str(e)}），不会合并 traceroute 结果")
+        return
+    traceroute_monitor.init_traceroute_database()
+
+def sync_push():
+    """把本机的新结果推送到 SYNC_PUSH_URL"""
+    try:
+        shipped = vantage_sync.push(DB_FILE, SYNC_PUSH_URL, SYNC_TOKEN or None)
+        summary = "，".join(f"{table} {count} 行" for table, count in shipped.items())
+        logger.info(f"已推送到收集端 {SYNC_PUSH_URL}: {summary or '没有新数据'}")
+        return True
+    except Exception as e:
+        logger.error(f"推送到收集端 {SYNC_PUSH_URL} 失败: {str(e)}")
+        return False
+
+def sync_pull():
+    """从 SYNC_PULL_URLS 中的各采集点拉取新结果"""
+    ok = True
+    for url in SYNC_PULL_URLS:
+        try:
+            vantage_id, merged = vantage_sync.pull(DB_FILE, url, SYNC_TOKEN or None)
+            summary = "，".join(f"{table} {count} 行" for table, count in merged.items())
+            logger.info(f"已从采集点 {vantage_id}（{url}）拉取: {summary or '没有新数据'}")
+        except Exception as e:
+            logger.error(f"从 {url} 拉取失败: {str(e)}")
+            ok = False
+    return ok
+
+def sync_once():
+    """常驻模式下的定期同步"""
+    if SYNC_PUSH_URL:
+        sync_push()
+    if SYNC_PULL_URLS:
+        sync_pull()
+
+def start_sync_server():
+    """按 SYNC_PORT 启动同步服务，失败时只记录错误，返回服务对象或 None"""
+    if not SYNC_PORT:
+        return None
+    try:
+        return vantage_sync.start_server(DB_FILE, SYNC_PORT, SYNC_HOST, SYNC_TOKEN or None)
+    except (OSError, vantage_sync.SyncError) as e:
+        logger.error(f"启动同步服务失败: {str(e)}")
+        return None
+
+def run_sync():
+    """不探测，只同步：推送和拉取一次；设置了 SYNC_PORT 时在前台运行同步服务直到收到信号"""
+    init_database()
+    ok = True
+    try:
+        if SYNC_PORT or SYNC_PULL_URLS:
+            init_traceroute_tables()
+        if SYNC_PUSH_URL:
+            ok = sync_push() and ok
+        if SYNC_PULL_URLS:
+            ok = sync_pull() and ok
+        if SYNC_PORT:
+            server = start_sync_server()
+            if server is None:
+                return False
+            stop_event = threading.Event()
+            signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+            if hasattr(signal, "SIGTERM"):
+                signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+            stop_event.wait()
+            server.shutdown()
+            logger.info("同步服务已停止")
+    finally:
+        db_writer.close_writer(DB_FILE)
+    return ok
+
+def run_daemon_round(ips, count=None, timeout=None):
+    """常驻模式下的一轮探测：写入数据库后立即刷新 latest.json，返回本轮结果"""
+    results = run_probe_round(ips, count, timeout)
+    export_latest_snapshot()
+    return results
+
+def round_health(result):
+    """一轮结果的 (丢包率, 抖动毫秒)，供自适应调度判断目标是否稳定"""
+    if not result["success"]:
+        return 1.0, None
+    count = result.get("probe_count", PING_COUNT)
+    stats = latency_stats.compute_stats(result.get("samples") or result["latencies"])
+    return result["packet_loss"] / count, stats["jitter"] if stats else None
+
+def create_adaptive_policy():
+    """按配置创建自适应调度策略"""
+    return scheduler.AdaptivePolicy(
+        ADAPTIVE_LEVELS,
+        loss_threshold=ADAPTIVE_LOSS_THRESHOLD,
+        jitter_threshold=ADAPTIVE_JITTER_THRESHOLD,
+        recovery_rounds=ADAPTIVE_RECOVERY_ROUNDS,
+        quiet_rounds=ADAPTIVE_QUIET_ROUNDS,
+        pps_budget=DAEMON_PPS_BUDGET,
+        min_count=ADAPTIVE_MIN_COUNT,
+    )
+
+def min_round_interval(count, timeout=None):
+    """发送 count 个包的一轮探测本身的耗时（秒），探测间隔不能短于它"""
+    return count * PROBE_INTERVAL + (timeout or PROBE_TIMEOUT)
+
+def shard_time_limit(size, count, timeout=None):
+    """size 个目标的分片在工作进程中执行的时间上限（秒）
+
+    按最慢的情况估计：系统 ping 命令每批 SUBPROCESS_PING_WORKERS 个目标，ICMP 引擎先探测一轮，
+    无法使用时再改用系统 ping 命令。
+    """
+    rounds = math.ceil(size / SUBPROCESS_PING_WORKERS)
+    if PROBE_ENGINE == "icmp":
+        rounds += 1
+    return rounds * min_round_interval(count, timeout) + SHARD_TIME_MARGIN
+
+def get_target_interval(item):
+    """获取目标在常驻模式下的探测间隔（秒）"""
+    try:
+        interval = float(item.get("interval", DAEMON_DEFAULT_INTERVAL))
+    except (TypeError, ValueError):
+        logger.warning(f"IP {item['ip']} 的探测间隔配置无效，使用默认值 {DAEMON_DEFAULT_INTERVAL} 秒")
+        return DAEMON_DEFAULT_INTERVAL
+    # 间隔不能短于一轮探测本身的耗时
+    return max(interval, min_round_interval(item.get("count", PING_COUNT), item.get("timeout")))
+
+def start_metrics_server():
+    """按 METRICS_PORT 启动指标服务，失败时只记录错误，返回服务对象或 None"""
+    global METRICS
+    if not METRICS_PORT:
+        return None
+    METRICS = metrics.MetricsRegistry()
+    METRICS.set_callback("db_write_queue_depth", lambda: db_writer.get_writer(DB_FILE).queue_depth())
+    try:
+        return metrics.start_server(METRICS, METRICS_PORT, METRICS_HOST)
+    except OSError as e:
+        logger.error(f"启动指标服务失败: {str(e)}")
+        METRICS = None
+        return None
+
+def run_daemon():
+    """常驻模式：按每个目标的间隔持续探测，并按各自的周期执行备份和数据清理"""
+    init_database()
+    # 工作进程在主进程启动写入线程和指标服务线程之前创建
+    start_shard_pool()
+    # 启动共享写入线程，整个常驻期间保持同一个数据库连接
+    db_writer.get_writer(DB_FILE)
+    metrics_server = start_metrics_server()
+    sync_server = start_sync_server()
+
+    stop_event = threading.Event()
+
+    def handle_signal(signum, frame):
+        logger.info(f"收到信号 {signum}，正在停止常驻模式...")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, handle_signal)
+
+    sched = scheduler.IntervalScheduler()
+    # 自适应调度：各目标当前的 (间隔, 探测包数)
+    policy = create_adaptive_policy() if ADAPTIVE_SCHEDULING else None
+    plan = {}
+    # 各目标的配置 (基础间隔, 探测包数, 超时)，用于识别热加载后变化的目标
+    configured = {}
+    # 各目标的地区，即指标中 region 标签的值
+    regions = {}
+
+    def sync_targets(now):
+        """按注册表中的目标增删和更新调度，新目标的首次探测时间在间隔内错开"""
+        nonlocal plan
+        current = {}
+        current_regions = {}
+        for item in TARGETS.targets():
+            count = item.get("count", PING_COUNT)
+            current[item["ip"]] = (get_target_interval(item), count, item.get("timeout", PROBE_TIMEOUT))
+            current_regions[item["ip"]] = item.get("region")
+        removed = [ip for ip in configured if ip not in current]
+        changed = {ip for ip, settings in current.items() if configured.get(ip) != settings}
+        # 只改了地区的目标不需要重新调度，但指标的 region 标签已经过时
+        relabeled = [ip for ip, region in current_regions.items() if ip in regions and regions[ip] != region]
+        for ip in removed:
+            del configured[ip]
+            sched.remove(("probe", ip))
+        if METRICS is not None:
+            # 删除或修改的目标不再输出旧标签的指标
+            for ip in set(removed) | changed | set(relabeled):
+                METRICS.remove_target(ip)
+        regions.clear()
+        regions.update(current_regions)
+        added = []
+        for ip in changed:
+            configured[ip] = current[ip]
+            interval, count, timeout = current[ip]
+            # 加密采样时的间隔同样不能短于一轮探测本身的耗时
+            max_count = max(int(round(count * factor)) for _interval, factor in ADAPTIVE_LEVELS.values())
+            added.append((ip, interval, count, min_round_interval(max_count, timeout)))
+        if policy is not None:
+            # 一次热加载只重新计算一次调度计划
+            new_plan = policy.update(added=added, removed=removed)
+        else:
+            new_plan = {ip: settings[:2] for ip, settings in configured.items()}
+        for ip, (interval, _count) in new_plan.items():
+            if ip in changed:
+                sched.add(("probe", ip), interval, now + scheduler.spread_offset(ip, interval))
+            elif interval != plan[ip][0]:
+                # 发包预算重新分配后其他目标的间隔也可能变化
+                sched.set_interval(("probe", ip), interval)
+        plan = new_plan
+        return len(removed), len(changed)
+
+    # 按目标间隔建立调度
+    now = time.monotonic()
+    sync_targets(now)
+    export_targets()
+    if policy is not None:
+        logger.info(f"自适应调度已启用，计划发包速率 {policy.total_pps():.2f} 包/秒（预算 {DAEMON_PPS_BUDGET} 包/秒）")
+    next_config_check = now + DAEMON_CONFIG_CHECK_INTERVAL
+    sched.add(("maintenance", "backup"), DAEMON_BACKUP_INTERVAL, now + DAEMON_BACKUP_INTERVAL)
+    sched.add(("maintenance", "export"), DAEMON_EXPORT_INTERVAL, now + DAEMON_EXPORT_INTERVAL)
+    sched.add(("maintenance", "cleanup"), DAEMON_CLEANUP_INTERVAL, now + scheduler.spread_offset("cleanup", DAEMON_CLEANUP_INTERVAL))
+    if SYNC_PUSH_URL or SYNC_PULL_URLS:
+        sched.add(("maintenance", "sync"), DAEMON_SYNC_INTERVAL, now + DAEMON_SYNC_INTERVAL)
+
+    maintenance_tasks = {
+        # 调度周期即备份周期，不再按快照时间判断是否到期
+        "backup": lambda: backup_database(force=True),
+        "cleanup": cleanup_old_data,
+        "export": export_static_files,
+        "sync": sync_once,
+    }
+    # 正在探测中的IP，防止上一轮未结束时重复提交
+    in_flight = set()
+    in_flight_lock = threading.Lock()
+    # 探测线程完成的结果，由调度循环交给自适应策略（策略只在调度线程中修改）
+    finished = queue.Queue()
+
+    def probe_batch(ips, count, timeout):
+        try:
+            results = run_daemon_round(ips, count, timeout)
+            if policy is not None:
+                finished.put(results)
+        except Exception as e:
+            logger.error(f"执行ping测试失败: {str(e)}")
+        finally:
+            with in_flight_lock:
+                in_flight.difference_update(ips)
+
+    def apply_feedback(now):
+        """根据已完成的探测结果调整调度计划"""
+        nonlocal plan
+        while True:
+            try:
+                results = finished.get_nowait()
+            except queue.Empty:
+                return
+            for result in results:
+                ip = result["ip"]
+                if ip not in plan:
+                    # 目标已在探测期间从配置中删除
+                    continue
+                previous = policy.level(ip)
+                new_plan = policy.observe(ip, *round_health(result))
+                if new_plan is None:
+                    continue
+                interval, count = new_plan[ip]
+                logger.info(
+                    f"IP {ip} 探测级别 {previous} -> {policy.level(ip)}，"
+                    f"间隔 {interval:.0f} 秒，每轮 {count} 个包（合计 {policy.total_pps():.2f} 包/秒）"
+                )
+                # 本目标从现在起按新间隔执行，其余目标只在预算调整时更新间隔
+                sched.add(("probe", ip), interval, now + interval)
+                for other, (other_interval, _count) in new_plan.items():
+                    if other != ip and other_interval != plan[other][0]:
+                        sched.set_interval(("probe", other), other_interval)
+                plan = new_plan
+
+    logger.info(f"进入常驻模式，共 {len(TARGETS)} 个目标")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DAEMON_MAX_CONCURRENT_ROUNDS) as executor:
+        while not stop_event.is_set():
+            now = time.monotonic()
+            # 配置文件被修改后无需重启，直接按新的目标列表调整调度
+            if now >= next_config_check:
+                next_config_check = now + DAEMON_CONFIG_CHECK_INTERVAL
+                if TARGETS.reload_if_changed():
+                    removed, changed = sync_targets(now)
+                    logger.info(f"调度已更新：删除 {removed} 个目标，新增或修改 {changed} 个目标")
+                    export_targets()
+            if policy is not None:
+                apply_feedback(now)
+            # (探测包数, 超时) -> 到期的IP
+            probe_ips = {}
+            for kind, name in sched.pop_due(now):
+                if kind == "maintenance":
+                    executor.submit(maintenance_tasks[name])
+                    continue
+                with in_flight_lock:
+                    if name in in_flight:
+                        logger.warning(f"IP {name} 上一轮探测尚未完成，跳过本轮")
+                        continue
+                    in_flight.add(name)
+                probe_ips.setdefault((plan[name][1], configured[name][2]), []).append(name)
+            # 同一时刻到期且探测包数和超时相同的目标合并为一轮，共用一个事件循环
+            for (count, timeout), ips in probe_ips.items():
+                executor.submit(probe_batch, ips, count, timeout)
+
+            wait = sched.seconds_until_next(time.monotonic())
+            stop_event.wait(DAEMON_TICK if wait is None else min(wait, DAEMON_TICK))
+
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if sync_server is not None:
+        sync_server.shutdown()
+    stop_shard_pool()
+    db_writer.close_writer(DB_FILE)
+    logger.info("常驻模式已停止")
 
 def main():
     """主函数"""
+    global PROBE_ENGINE, METRICS_PORT, SHARD_WORKERS, VANTAGE_ID
+    global SYNC_PUSH_URL, SYNC_PULL_URLS, SYNC_PORT, SYNC_HOST, SYNC_TOKEN
     try:
         # 先加载IP配置
         load_ip_config()
@@ -438,13 +1280,53 @@ def main():
         parser.add_argument('--add', nargs=2, metavar=('IP', '地区'), help='添加新的IP和地区')
         parser.add_argument('--update', nargs=2, metavar=('IP', '新地区'), help='更新IP的地区信息')
         parser.add_argument('--delete', metavar='IP', help='删除指定IP')
-        parser.add_argument('--cleanup', type=int, metavar='天数', help='清理指定天数前的数据')
+        parser.add_argument('--import', dest='import_file', metavar='文件', help='从 CSV/JSON 文件批量导入目标（与现有配置合并）')
+        parser.add_argument('--export', nargs='?', const='-', metavar='文件', help='把目标导出为 CSV/JSON 文件（默认以 JSON 输出到标准输出）')
+        parser.add_argument('--dry-run', action='store_true', help='与 --import 一起使用：只显示差异，不修改配置')
+        parser.add_argument('--replace', action='store_true', help='与 --import 一起使用：删除导入文件中没有的目标')
+        parser.add_argument('--geo-fill', action='store_true', help='与 --import 一起使用：用地理位置查询补全缺少的地区')
+        parser.add_argument('--cleanup', type=int, metavar='天数', help=f'清理指定天数前的原始数据 (默认每次运行清理 {DATA_RETENTION_DAYS} 天前的数据)')
+        parser.add_argument('--backup', action='store_true', help='创建数据库快照并清理过期快照（距上次备份不足1小时时跳过）')
+        parser.add_argument('--restore', nargs='?', const='latest', metavar='快照文件', help='从快照恢复数据库（默认使用最新的快照）')
+        parser.add_argument('--compact', action='store_true', help='启用增量回收并整库压缩一次（已有数据库只需执行一次）')
+        parser.add_argument('--migrate-latencies', action='store_true', help='将旧的逗号分隔延迟文本转换为紧凑的二进制格式')
+        parser.add_argument('--backfill-rollups', action='store_true', help='根据已有的原始数据重建按小时/天的预聚合表')
+        parser.add_argument('--backfill-stats', action='store_true', help='为旧记录补算 p50/p90/p99、mdev 和抖动')
+        parser.add_argument('--daemon', action='store_true', help='常驻模式：按每个目标的间隔持续探测')
+        parser.add_argument('--engine', choices=['icmp', 'subprocess'], help='探测引擎（默认: icmp，不可用时自动回退到系统ping）')
+        parser.add_argument('--metrics-port', type=int, metavar='端口', help='常驻模式下在该端口提供 Prometheus 指标（/metrics）')
+        parser.add_argument('--workers', type=int, metavar='N', help='分片探测：把目标按IP分给 N 个工作进程并行探测（默认: 不分片）')
+        parser.add_argument('--vantage', metavar='编号', help='设置本机的采集点编号（保存在数据库中，默认为主机名）')
+        parser.add_argument('--sync-push', metavar='URL', help='把本机的新结果推送到收集端（常驻模式下定期推送）')
+        parser.add_argument('--sync-pull', action='append', metavar='URL', help='从采集点拉取新结果合并到本库，可以指定多次（常驻模式下定期拉取）')
+        parser.add_argument('--sync-port', type=int, metavar='端口', help='启动同步服务接收推送或供收集端拉取（不与 --daemon 一起使用时只运行同步服务）')
+        parser.add_argument('--sync-host', metavar='地址', help=f'同步服务的监听地址（默认: {vantage_sync.DEFAULT_HOST}，监听其他地址时必须设置 --sync-token）')
+        parser.add_argument('--sync-token', metavar='令牌', help='同步请求的共享令牌')
         args = parser.parse_args()
 
+        if args.vantage:
+            VANTAGE_ID = vantage_sync.validate_vantage_id(args.vantage)
+        if args.sync_push:
+            SYNC_PUSH_URL = args.sync_push
+        if args.sync_pull:
+            SYNC_PULL_URLS = args.sync_pull
+        if args.sync_port is not None:
+            SYNC_PORT = args.sync_port
+        if args.sync_host is not None:
+            SYNC_HOST = args.sync_host
+        if args.sync_token:
+            SYNC_TOKEN = args.sync_token
+        if args.workers is not None:
+            SHARD_WORKERS = args.workers
+        if args.engine:
+            PROBE_ENGINE = args.engine
+        if args.metrics_port is not None:
+            METRICS_PORT = args.metrics_port
+
         if args.info:
             # 显示配置的IP和地区信息
             print("当前配置的IP和地区信息:")
-            for item in IPS:
+            for item in TARGETS.targets():
                 print(f"IP: {item['ip']:<45} 地区: {item['region']}")
             return
         
@@ -452,20 +1334,34 @@ def main():
             # 添加新IP和地区
             ip, region = args.add
             if add_ip(ip, region):
-                update_js_config()
+                export_targets()
             return
         
         elif args.update:
             # 更新IP的地区信息
             ip, region = args.update
             if update_ip_region(ip, region):
-                update_js_config()
+                export_targets()
             return
         
         elif args.delete:
             # 删除指定IP
             if delete_ip(args.delete):
-                update_js_config()
+                export_targets()
+            return
+
+        elif args.import_file:
+            # 批量导入目标
+            if not import_ip_config(args.import_file, args.dry_run, args.replace, args.geo_fill):
+                sys.exit(1)
+            if not args.dry_run:
+                export_targets()
+            return
+
+        elif args.export:
+            # 批量导出目标
+            if not export_ip_config(None if args.export == '-' else args.export):
+                sys.exit(1)
             return
             
         elif args.cleanup:
@@ -473,6 +1369,48 @@ def main():
             cleanup_old_data(args.cleanup)
             return
 
+        elif args.compact:
+            # 启用增量回收
+            if not compact_database():
+                sys.exit(1)
+            return
+
+        elif args.migrate_latencies:
+            # 迁移旧的延迟数据
+            migrate_latencies()
+            return
+
+        elif args.backfill_rollups:
+            # 回填预聚合表
+            backfill_rollups()
+            return
+
+        elif args.backfill_stats:
+            # 补算逐包延迟统计
+            backfill_latency_stats()
+            return
+
+        elif args.backup:
+            # 创建数据库快照
+            backup_database()
+            return
+
+        elif args.restore:
+            # 从快照恢复数据库
+            if not restore_database(args.restore):
+                sys.exit(1)
+            return
+
+        if args.daemon:
+            run_daemon()
+            return
+
+        if args.sync_push or args.sync_pull or args.sync_port:
+            # 只同步，不探测
+            if not run_sync():
+                sys.exit(1)
+            return
+
         # 执行ping测试
         run_ping_test()
     except Exception as e:
@@ -1,6 +1,21 @@
 // 全局变量
 let db = null;
 let charts = {};
+// 报表中最长的统计窗口（天），只需加载这个范围内的数据
+const REPORT_RANGE_DAYS = 30;
+// ping_monitor.py 导出的汇总快照（summary.json），不存在时为 null
+let summarySnapshot = null;
+
+// 读取汇总快照，不存在时返回 null
+async function fetchSummarySnapshot() {
+    try {
+        const response = await fetch('summary.json', { cache: 'no-cache' });
+        return response.ok ? await response.json() : null;
+    } catch (err) {
+        console.warn('读取汇总快照失败，改为从数据库计算:', err);
+        return null;
+    }
+}
 
 // 初始化SQL.js
 async function initializeSqlJs() {
@@ -15,13 +30,19 @@ async function initializeSqlJs() {
     }
 }
 
-// 加载数据库
+// 加载数据库：优先只加载报表覆盖的最近 REPORT_RANGE_DAYS 天的数据分片（见 data_loader.js），
+// 没有分片清单时加载完整的 ping_data.db
 async function loadDatabase() {
     try {
         const SQL = await initializeSqlJs();
-        const response = await fetch('ping_data.db');
-        const arrayBuffer = await response.arrayBuffer();
-        db = new SQL.Database(new Uint8Array(arrayBuffer));
+        const manifest = await fetchShardManifest();
+        if (manifest) {
+            const shardedDb = new ShardedDatabase(SQL, manifest);
+            await shardedDb.ensureRange(shardDateOffset(-REPORT_RANGE_DAYS), null);
+            db = shardedDb.db;
+        } else {
+            db = await fetchFullDatabase(SQL);
+        }
         return true;
     } catch (err) {
         console.error('加载数据库失败:', err);
@@ -37,6 +58,15 @@ function updateLoadingProgress(progress, text) {
     loadingText.textContent = text;
 }
 
+// 判断数据库中是否存在指定的表
+function tableExists(name) {
+    const stmt = db.prepare("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?");
+    stmt.bind([name]);
+    const exists = stmt.step();
+    stmt.free();
+    return exists;
+}
+
 // 计算趋势
 function calculateTrend(current, previous) {
     if (!previous || previous === 0) return { value: 0, text: 'N/A', class: 'text-muted' }; // 处理分母为0的情况
@@ -52,7 +82,20 @@ function calculateTrend(current, previous) {
 
 // 更新概览数据
 function updateOverview() {
-    const query7days = `
+    // 原始数据只保留最近几天，优先使用保留更久的按小时预聚合表（与 static_export._window_stats 口径相同），
+    // 旧数据库回退到扫描原始数据
+    const useRollups = tableExists('ping_rollups');
+    const rollupQuery = (start, end) => `
+        SELECT 
+            SUM(latency_sum) / SUM(latency_count) as avg_latency,
+            (SUM(test_count) - SUM(success_count)) * 100.0 / SUM(test_count) as packet_loss,
+            AVG(CASE WHEN latency_count > 0 THEN (latency_max - latency_min) / (latency_sum / latency_count) END) as stability_index,
+            SUM(test_count) as test_count
+        FROM ping_rollups
+        WHERE granularity = 'hour' AND period_start >= strftime('%Y-%m-%d %H:00:00', 'now', '${start}')
+            ${end ? `AND period_start < strftime('%Y-%m-%d %H:00:00', 'now', '${end}')` : ''}
+    `;
+    const query7days = useRollups ? rollupQuery('-7 days') : `
         SELECT 
             AVG(avg_latency) as avg_latency_7d,
             AVG(CASE WHEN success = 0 THEN 1 ELSE 0 END) * 100 as packet_loss_7d,
@@ -61,7 +104,7 @@ function updateOverview() {
         FROM ping_results
         WHERE timestamp >= datetime('now', '-7 days') AND avg_latency IS NOT NULL AND avg_latency > 0
     `;
-    const query14days = `
+    const query14days = useRollups ? rollupQuery('-14 days', '-7 days') : `
         SELECT 
             AVG(avg_latency) as avg_latency_14d,
             AVG(CASE WHEN success = 0 THEN 1 ELSE 0 END) * 100 as packet_loss_14d,
@@ -71,8 +114,16 @@ function updateOverview() {
     `;
 
     try {
-        const result7days = db.exec(query7days)[0];
-        const result14days = db.exec(query14days)[0];
+        let result7days, result14days;
+        if (summarySnapshot) {
+            // 使用预先计算好的汇总快照，与下面的查询口径相同
+            const toRow = stats => [stats.avg_latency, stats.packet_loss, stats.stability, stats.test_count];
+            result7days = summarySnapshot.current.test_count > 0 ? { values: [toRow(summarySnapshot.current)] } : undefined;
+            result14days = summarySnapshot.previous.test_count > 0 ? { values: [toRow(summarySnapshot.previous)] } : undefined;
+        } else {
+            result7days = db.exec(query7days)[0];
+            result14days = db.exec(query14days)[0];
+        }
 
         if (result7days && result7days.values && result7days.values.length > 0) {
             const data7d = result7days.values[0];
@@ -235,7 +286,17 @@ function calculateStandardDeviation(values) {
 
 // 创建在线率图表
 function createUptimeChart() {
-    const query = `
+    // 优先使用 ping_monitor 维护的按小时预聚合表，旧数据库回退到扫描原始数据
+    const query = tableExists('ping_rollups') ? `
+        SELECT 
+            ip,
+            SUM(success_count) as success_count,
+            SUM(test_count) as total_count
+        FROM ping_rollups
+        WHERE granularity = 'hour' AND period_start >= strftime('%Y-%m-%d %H:00:00', 'now', '-7 days')
+        GROUP BY ip
+        ORDER BY (SUM(success_count) * 1.0 / SUM(test_count)) DESC
+    ` : `
         SELECT 
             ip,
             SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as success_count,
@@ -247,7 +308,15 @@ function createUptimeChart() {
     `;
 
     try {
-        const result = db.exec(query)[0];
+        let result;
+        if (summarySnapshot && summarySnapshot.uptime.length > 0) {
+            // 使用汇总快照中的在线率，按在线率从高到低排序
+            const rows = summarySnapshot.uptime.map(u => [u.ip, u.success_count, u.total_count]);
+            rows.sort((a, b) => b[1] / b[2] - a[1] / a[2]);
+            result = { values: rows };
+        } else {
+            result = db.exec(query)[0];
+        }
         if (result && result.values && result.values.length > 0) {
             const ips = result.values.map(row => row[0]);
             const uptimes = result.values.map(row => calculateUptime(row[1], row[2]).toFixed(1));
@@ -412,8 +481,20 @@ function createTrendCharts(selectedIp = 'all') { // 接收 selectedIp 参数，
     document.getElementById('latencyTrendHeader').textContent = `延迟趋势 (近30天 - ${titleSuffix})`;
     document.getElementById('packetLossTrendHeader').textContent = `丢包率趋势 (近30天 - ${titleSuffix})`;
 
+    // 原始数据只保留最近几天，30天的趋势优先使用按天预聚合表，旧数据库回退到扫描原始数据
+    const useRollups = tableExists('ping_rollups');
+    const rollupIpClause = (selectedIp && selectedIp !== 'all') ? ` AND ip = '${selectedIp.replace(/'/g, "''")}'` : '';
+
     // 延迟趋势
-    const latencyQuery = `
+    const latencyQuery = useRollups ? `
+        SELECT 
+            substr(period_start, 1, 10) as date,
+            SUM(latency_sum) / SUM(latency_count) as avg_latency
+        FROM ping_rollups
+        WHERE granularity = 'day' AND period_start >= date('now', '-30 days') AND latency_count > 0${rollupIpClause}
+        GROUP BY date
+        ORDER BY date
+    ` : `
         SELECT 
             strftime('%Y-%m-%d', timestamp) as date,
             AVG(avg_latency) as avg_latency
@@ -474,7 +555,15 @@ function createTrendCharts(selectedIp = 'all') { // 接收 selectedIp 参数，
     }
     
     // 丢包率趋势
-    const packetLossQuery = `
+    const packetLossQuery = useRollups ? `
+        SELECT 
+            substr(period_start, 1, 10) as date,
+            (SUM(test_count) - SUM(success_count)) * 100.0 / SUM(test_count) as packet_loss
+        FROM ping_rollups
+        WHERE granularity = 'day' AND period_start >= date('now', '-30 days')${rollupIpClause}
+        GROUP BY date
+        ORDER BY date
+    ` : `
         SELECT 
             strftime('%Y-%m-%d', timestamp) as date,
             AVG(CASE WHEN success = 0 THEN 1 ELSE 0 END) * 100 as packet_loss
@@ -795,14 +884,21 @@ async function loadAndDisplayTracerouteFromDB() {
         // SQL 查询：获取每个 target_ip 的最新记录
         // 使用子查询或 ROW_NUMBER() 来获取每个分组的最新记录（取决于 sql.js 支持的 SQLite 版本）
         // 这里使用子查询的方式，更通用
+        // 新数据的跳列表保存在 routes 表中（按 route_id 引用），旧数据仍在 hops_json 列中；
+        // 同时从 route_changes 取出每个目标最近一次路径变化的时间
+        const hasRoutes = tableExists('routes') && tableExists('route_changes');
         const query = `
-            SELECT t1.target_ip, t1.timestamp, t1.hops_json, t1.error
+            SELECT t1.target_ip, t1.timestamp,
+                   ${hasRoutes ? 'COALESCE(r.hops_json, t1.hops_json)' : 't1.hops_json'}, t1.error,
+                   ${hasRoutes ? `(SELECT MAX(c.timestamp) FROM route_changes c
+                                   WHERE c.target_ip = t1.target_ip AND c.old_route_id IS NOT NULL)` : 'NULL'}
             FROM traceroute_results t1
             INNER JOIN (
                 SELECT target_ip, MAX(timestamp) as max_ts
                 FROM traceroute_results
                 GROUP BY target_ip
             ) t2 ON t1.target_ip = t2.target_ip AND t1.timestamp = t2.max_ts
+            ${hasRoutes ? 'LEFT JOIN routes r ON r.route_id = t1.route_id' : ''}
             ORDER BY t1.target_ip;
         `;
         
@@ -829,7 +925,8 @@ async function loadAndDisplayTracerouteFromDB() {
                     target_ip: row[0],
                     timestamp: row[1],
                     hops: hops,
-                    error: row[3]
+                    error: row[3],
+                    routeChangedAt: row[4]
                 };
             });
             displayTracerouteResults(dataToDisplay); // 调用显示函数
@@ -857,15 +954,22 @@ function displayTracerouteResults(results) {
         cardHeader.className = 'card-header d-flex justify-content-between align-items-center'; 
         cardHeader.innerHTML = `
             <span>目标 IP: <strong>${result.target_ip}</strong></span>
-            <small>时间: ${result.timestamp}</small>
+            <small>${result.routeChangedAt ? `路径最近变化: ${result.routeChangedAt} · ` : ''}时间: ${result.timestamp}</small>
         `;
         const cardBody = document.createElement('div');
         cardBody.className = 'card-body p-0';
 
-        if (result.error) {
+        if (result.error && !(result.hops && result.hops.length > 0)) {
             cardBody.style.padding = '1.5rem';
             cardBody.innerHTML = `<p class="error-text">追踪过程中发生错误: ${result.error}</p>`;
         } else if (result.hops && result.hops.length > 0) {
+            // 超时等错误时仍保存了已发现的部分路径
+            if (result.error) {
+                const note = document.createElement('p');
+                note.className = 'error-text px-3 pt-3';
+                note.textContent = `追踪未完成（${result.error}），以下为已发现的节点`;
+                cardBody.appendChild(note);
+            }
             const tableContainer = document.createElement('div');
             tableContainer.className = 'table-responsive';
             const table = document.createElement('table');
@@ -925,6 +1029,9 @@ async function initPage() {
         updateLoadingProgress(10, '正在初始化SQL.js...');
         await initializeSqlJs();
         
+        updateLoadingProgress(20, '正在加载汇总快照...');
+        summarySnapshot = await fetchSummarySnapshot();
+        
         updateLoadingProgress(30, '正在加载 Ping 数据库...');
         const success = await loadDatabase(); // loadDatabase 会设置全局 db 变量
         if (!success || !db) { // 检查 db 是否成功加载
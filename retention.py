@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据保留：按整数时间戳分块删除过期数据，增量回收空闲页
+
+ping_results 和 traceroute_results 增加整数列 epoch（Unix 时间戳，秒）并建立索引，
+过期判断按整数比较，不依赖文本时间戳的格式。删除按 DELETE_CHUNK_SIZE 行分块，每块
+是一个单独的短事务，写入线程最多只需等待一块；删除后的空闲页由
+PRAGMA incremental_vacuum 每次回收至多 VACUUM_PAGES 页，不再整库 VACUUM。
+
+保留期分两层：原始结果保留 RAW_RETENTION_DAYS 天，预聚合表和路径变化记录保留
+ROLLUP_RETENTION_DAYS 天，更早的趋势仍可以从预聚合表查询。
+"""
+
+import datetime
+import functools
+import logging
+import sqlite3
+import time
+
+import db_writer
+import rollups
+
+logger = logging.getLogger("ping_monitor")
+
+# 原始结果的保留天数
+RAW_RETENTION_DAYS = 7
+# 预聚合表和路径变化记录的保留天数
+ROLLUP_RETENTION_DAYS = 365
+# 每个删除事务最多删除的行数
+DELETE_CHUNK_SIZE = 1000
+# 两个删除事务之间的间隔（秒），让等待中的写入线程先拿到写锁
+CHUNK_PAUSE = 0.01
+# 每次维护最多回收的空闲页数
+VACUUM_PAGES = 2048
+# 每个回收事务的页数
+VACUUM_STEP_PAGES = 256
+# 空闲页少于此数时不回收（空闲页会被新写入的数据复用，不必每次都缩小文件）
+VACUUM_MIN_FREE_PAGES = 256
+# 与 ping_results.timestamp 相同的时间格式（本地时间）
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# 表 -> (保留层级, 判断过期的列, 分别删除的粒度列)
+# 带 epoch 列的表按整数比较；预聚合表的 period_start 和 route_changes.timestamp
+# 由程序按固定格式生成，按各自已有的索引比较。预聚合表的索引以 granularity 开头，
+# 按每个粒度分别删除才能按范围查找，否则每次清理都要扫描整个索引
+RETENTION_TABLES = {
+    "ping_results": ("raw", "epoch", None),
+    "traceroute_results": ("raw", "epoch", None),
+    "ping_rollups": ("rollup", "period_start", "granularity"),
+    "ping_rollup_histogram": ("rollup", "period_start", "granularity"),
+    "route_changes": ("rollup", "timestamp", None),
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def epoch_seconds(timestamp):
+    """将 "YYYY-MM-DD HH:MM:SS"（本地时间）转换为 Unix 时间戳（秒）
+
+    一轮探测的结果共用同一个时间戳，缓存后每轮只需解析一次。
+    """
+    return int(time.mktime(time.strptime(timestamp, TIMESTAMP_FORMAT)))
+
+
+def init_epoch_column(conn, table):
+    """为 table 补充 epoch 列和索引（旧数据的 epoch 在清理时分块回填）"""
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    if 'epoch' not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN epoch INTEGER')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_epoch ON {table} (epoch)')
+
+
+def backfill_epoch(conn, table, chunk_size=DELETE_CHUNK_SIZE):
+    """根据文本时间戳分块填充 epoch 为空的行，返回填充的行数
+
+    旧数据和从旧版本采集点同步来的行没有 epoch。时间戳无法解析的行保持为空，不会被删除。
+    """
+    filled = 0
+    last_id = 0
+    while True:
+        ids = [row[0] for row in conn.execute(
+            f'SELECT rowid FROM {table} WHERE epoch IS NULL AND rowid > ? ORDER BY rowid LIMIT ?',
+            (last_id, chunk_size)
+        )]
+        if not ids:
+            return filled
+        filled += conn.execute(f'''
+            UPDATE {table} SET epoch = CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+            WHERE rowid BETWEEN ? AND ? AND epoch IS NULL
+        ''', (ids[0], ids[-1])).rowcount
+        last_id = ids[-1]
+
+
+def delete_chunked(conn, table, column, cutoff, chunk_size=DELETE_CHUNK_SIZE, scope=None):
+    """分块删除 column < cutoff 的行，每块一个事务，返回删除的行数
+
+    scope 为 (列, 值) 时只删除该列等于该值的行。
+    """
+    condition, params = f'{column} < ?', (cutoff,)
+    if scope is not None:
+        condition, params = f'{scope[0]} = ? AND {condition}', (scope[1], cutoff)
+    deleted = 0
+    while True:
+        count = conn.execute(
+            f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {condition} LIMIT ?)',
+            params + (chunk_size,)
+        ).rowcount
+        deleted += count
+        if count < chunk_size:
+            return deleted
+        time.sleep(CHUNK_PAUSE)
+
+
+def cutoff_for(column, days, now):
+    """days 天前的截止值：epoch 列为整数，其他列为 TIMESTAMP_FORMAT 格式的文本"""
+    cutoff = now - datetime.timedelta(days=days)
+    if column == "epoch":
+        return int(cutoff.timestamp())
+    return cutoff.strftime(TIMESTAMP_FORMAT)
+
+
+def existing_tables(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def reclaim_space(conn, pages=VACUUM_PAGES):
+    """增量回收至多 pages 个空闲页，返回回收的页数
+
+    数据库未启用 auto_vacuum=INCREMENTAL 时不回收（空闲页仍会被新数据复用），见 compact()。
+    """
+    free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    if free_pages < VACUUM_MIN_FREE_PAGES:
+        return 0
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        logger.info(f"数据库有 {free_pages} 个空闲页，但未启用增量回收，"
+                    f"可执行一次 python ping_monitor.py --compact 启用")
+        return 0
+    # incremental_vacuum 每执行一步回收一页，executescript 会执行到结束；分成多个短事务
+    remaining = min(free_pages, pages)
+    while remaining > 0:
+        step = min(remaining, VACUUM_STEP_PAGES)
+        conn.executescript(f'PRAGMA incremental_vacuum({int(step)})')
+        remaining -= step
+        if remaining > 0:
+            time.sleep(CHUNK_PAUSE)
+    return free_pages - conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+def purge_expired(db_file, tables, raw_days=RAW_RETENTION_DAYS, rollup_days=ROLLUP_RETENTION_DAYS, now=None):
+    """按分层保留期删除 tables 中的过期行并增量回收空闲页
+
+    保留天数 <= 0 的层级不清理。返回 ({表: 删除的行数}, 回收的页数)。
+    """
+    now = now or datetime.datetime.now()
+    days_for = {"raw": raw_days, "rollup": rollup_days}
+    conn = db_writer.configure_connection(
+        sqlite3.connect(db_file, timeout=db_writer.BUSY_TIMEOUT, isolation_level=None)
+    )
+    try:
+        present = existing_tables(conn)
+        deleted = {}
+        for table in tables:
+            tier, column, partition = RETENTION_TABLES[table]
+            if table not in present or days_for[tier] <= 0:
+                continue
+            if column == "epoch":
+                filled = backfill_epoch(conn, table)
+                if filled:
+                    logger.info(f"已为 {table} 的 {filled} 条旧记录填充 epoch")
+            cutoff = cutoff_for(column, days_for[tier], now)
+            if partition is None:
+                deleted[table] = delete_chunked(conn, table, column, cutoff)
+            else:
+                deleted[table] = sum(
+                    delete_chunked(conn, table, column, cutoff, scope=(partition, granularity))
+                    for granularity in rollups.GRANULARITIES
+                )
+        return deleted, reclaim_space(conn)
+    finally:
+        conn.close()
+
+
+def compact(db_file):
+    """启用 auto_vacuum=INCREMENTAL 并整库 VACUUM 一次，返回 (之前的字节数, 之后的字节数)
+
+    已有数据库只能通过一次 VACUUM 启用增量回收，之后的清理不再需要 VACUUM。
+    新建的数据库在 db_writer.configure_connection 中直接启用。整库 VACUUM 期间其他写入会等待，
+    应在常驻模式停止时执行。
+    """
+    conn = sqlite3.connect(db_file, timeout=db_writer.BUSY_TIMEOUT, isolation_level=None)
+    try:
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        before = conn.execute('PRAGMA page_count').fetchone()[0] * page_size
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+        after = conn.execute('PRAGMA page_count').fetchone()[0] * page_size
+        return before, after
+    finally:
+        conn.close()
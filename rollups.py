@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ping_results 的预聚合表（按 IP × 小时 / IP × 天）
+
+每轮探测的结果在写入 ping_results 的同一个事务中累加到 ping_rollups 和
+ping_rollup_histogram。所有字段都是可加的（次数、总和、平方和、最小/最大值、
+直方图计数），因此增量写入和全量回填得到的结果完全一致，页面和数据保留策略
+都可以直接使用这些小表，而不必反复扫描原始数据。
+"""
+
+import bisect
+import datetime
+import logging
+
+logger = logging.getLogger("ping_monitor")
+
+# 聚合粒度 -> 时间戳截断后的长度（"YYYY-MM-DD HH" / "YYYY-MM-DD"）及补齐的后缀
+GRANULARITIES = {
+    "hour": (13, ":00:00"),
+    "day": (10, " 00:00:00"),
+}
+# 聚合粒度 -> 时间段长度
+PERIOD_LENGTHS = {
+    "hour": datetime.timedelta(hours=1),
+    "day": datetime.timedelta(days=1),
+}
+# 延迟直方图的桶上界（毫秒），最后一个桶收纳所有更大的值
+HISTOGRAM_BOUNDS = [5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000]
+# 回填时每次读取的原始记录数
+BACKFILL_CHUNK_SIZE = 10000
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS ping_rollups (
+        granularity TEXT NOT NULL,       -- "hour" 或 "day"
+        ip TEXT NOT NULL,
+        period_start TEXT NOT NULL,      -- 时间段起点，与 ping_results.timestamp 格式相同
+        test_count INTEGER NOT NULL,     -- 测试次数
+        success_count INTEGER NOT NULL,  -- 成功次数
+        probe_count INTEGER NOT NULL,    -- 发送的探测包数
+        lost_count INTEGER NOT NULL,     -- 丢失的探测包数
+        latency_count INTEGER NOT NULL,  -- 收到回复的探测包数
+        latency_sum REAL NOT NULL,       -- 延迟总和（毫秒）
+        latency_sum_sq REAL NOT NULL,    -- 延迟平方和，用于计算标准差
+        latency_min REAL,
+        latency_max REAL,
+        PRIMARY KEY (granularity, ip, period_start)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS ping_rollup_histogram (
+        granularity TEXT NOT NULL,
+        ip TEXT NOT NULL,
+        period_start TEXT NOT NULL,
+        bucket INTEGER NOT NULL,         -- HISTOGRAM_BOUNDS 中的桶序号
+        count INTEGER NOT NULL,
+        PRIMARY KEY (granularity, ip, period_start, bucket)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_rollups_period ON ping_rollups (granularity, period_start)',
+    'CREATE INDEX IF NOT EXISTS idx_rollup_histogram_period ON ping_rollup_histogram (granularity, period_start)',
+]
+
+ROLLUP_UPSERT_SQL = '''
+INSERT INTO ping_rollups
+(granularity, ip, period_start, test_count, success_count, probe_count, lost_count,
+ latency_count, latency_sum, latency_sum_sq, latency_min, latency_max)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (granularity, ip, period_start) DO UPDATE SET
+    test_count = test_count + excluded.test_count,
+    success_count = success_count + excluded.success_count,
+    probe_count = probe_count + excluded.probe_count,
+    lost_count = lost_count + excluded.lost_count,
+    latency_count = latency_count + excluded.latency_count,
+    latency_sum = latency_sum + excluded.latency_sum,
+    latency_sum_sq = latency_sum_sq + excluded.latency_sum_sq,
+    latency_min = COALESCE(MIN(latency_min, excluded.latency_min), latency_min, excluded.latency_min),
+    latency_max = COALESCE(MAX(latency_max, excluded.latency_max), latency_max, excluded.latency_max)
+'''
+
+HISTOGRAM_UPSERT_SQL = '''
+INSERT INTO ping_rollup_histogram (granularity, ip, period_start, bucket, count)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (granularity, ip, period_start, bucket) DO UPDATE SET
+    count = count + excluded.count
+'''
+
+
+def init_rollup_tables(conn):
+    """创建预聚合表（如果不存在）"""
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def period_start(timestamp, granularity):
+    """将 "YYYY-MM-DD HH:MM:SS" 截断为所属时间段的起点"""
+    length, suffix = GRANULARITIES[granularity]
+    return timestamp[:length] + suffix
+
+
+def first_full_period(timestamp, granularity):
+    """不早于 timestamp 的第一个完整时间段的起点"""
+    start = period_start(timestamp, granularity)
+    if start == timestamp:
+        return start
+    next_start = datetime.datetime.strptime(start, "%Y-%m-%d %H:%M:%S") + PERIOD_LENGTHS[granularity]
+    return next_start.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def histogram_bucket(latency):
+    """返回延迟所属的直方图桶序号"""
+    return bisect.bisect_left(HISTOGRAM_BOUNDS, latency)
+
+
+class RollupAccumulator:
+    """在内存中累加一批结果，再生成写入预聚合表的语句"""
+
+    def __init__(self):
+        # (粒度, ip, 时间段) -> [test, success, probe, lost, count, sum, sum_sq, min, max]
+        self.rollups = {}
+        # (粒度, ip, 时间段, 桶) -> 次数
+        self.histogram = {}
+
+    def add(self, ip, timestamp, success, latencies, lost):
+        """累加一次测试：latencies 为收到回复的延迟，lost 为丢包数"""
+        latencies = list(latencies)
+        for granularity in GRANULARITIES:
+            key = (granularity, ip, period_start(timestamp, granularity))
+            stats = self.rollups.get(key)
+            if stats is None:
+                stats = self.rollups[key] = [0, 0, 0, 0, 0, 0.0, 0.0, None, None]
+            stats[0] += 1
+            stats[1] += 1 if success else 0
+            stats[2] += len(latencies) + lost
+            stats[3] += lost
+            stats[4] += len(latencies)
+            for latency in latencies:
+                stats[5] += latency
+                stats[6] += latency * latency
+                stats[7] = latency if stats[7] is None else min(stats[7], latency)
+                stats[8] = latency if stats[8] is None else max(stats[8], latency)
+                hist_key = key + (histogram_bucket(latency),)
+                self.histogram[hist_key] = self.histogram.get(hist_key, 0) + 1
+
+    def statements(self):
+        """返回 [(sql, rows), ...]，可直接交给 DBWriter.submit_group"""
+        return [
+            (ROLLUP_UPSERT_SQL, [key + tuple(stats) for key, stats in self.rollups.items()]),
+            (HISTOGRAM_UPSERT_SQL, [key + (count,) for key, count in self.histogram.items()]),
+        ]
+
+
+def accumulate_results(results, probe_count):
+    """把一轮探测结果（save_result_to_db 使用的字典）累加为预聚合语句
+
+    失败结果按其 probe_count（自适应调度下每轮包数可能不同）计为全部丢包，没有时使用 probe_count。
+    """
+    acc = RollupAccumulator()
+    for result in results:
+        if result["success"]:
+            acc.add(result["ip"], result["timestamp"], True, result["latencies"], result["packet_loss"])
+        else:
+            acc.add(result["ip"], result["timestamp"], False, [], result.get("probe_count", probe_count))
+    return acc.statements()
+
+
+def rebuild_start(conn, first, granularity, raw_cutoff=None):
+    """回填时 granularity 粒度重建的第一个时间段
+
+    最早的原始记录所在的时间段只有在可能已被清理掉一部分时才保留原有的预聚合值：
+    预聚合表中已有该时间段，或者该时间段跨过原始数据的保留截止时间 raw_cutoff。
+    否则（例如第一次回填）从该时间段开始重建。
+    """
+    start = period_start(first, granularity)
+    if start == first:
+        return start
+    existing = conn.execute(
+        'SELECT 1 FROM ping_rollups WHERE granularity = ? AND period_start = ? LIMIT 1', (granularity, start)
+    ).fetchone()
+    if existing or (raw_cutoff is not None and start < raw_cutoff):
+        return first_full_period(first, granularity)
+    return start
+
+
+def backfill_rollups(conn, decode_row, chunk_size=BACKFILL_CHUNK_SIZE, raw_cutoff=None):
+    """根据 ping_results 中的原始数据重建预聚合表
+
+    decode_row(row) 接收 (ip, timestamp, success, packet_loss, latencies, latencies_packed)，
+    返回 (收到回复的延迟列表, 丢包数)。按 id 分块读取并累加，内存占用与原始数据量无关。
+    原始数据的保留期比预聚合表短，早于原始数据的时间段保留原有的预聚合值，最早的
+    原始记录所在的时间段见 rebuild_start；raw_cutoff 为原始数据的保留截止时间（与
+    timestamp 格式相同），不清理时为 None。
+    回填期间新写入的结果会被重复累加，应在常驻模式停止时执行。
+    """
+    init_rollup_tables(conn)
+    first = conn.execute('SELECT MIN(timestamp) FROM ping_results').fetchone()[0]
+    if first is None:
+        return 0
+    # 粒度 -> 重建的第一个时间段
+    rebuild_from = {granularity: rebuild_start(conn, first, granularity, raw_cutoff) for granularity in GRANULARITIES}
+    with conn:
+        for granularity, start in rebuild_from.items():
+            conn.execute('DELETE FROM ping_rollups WHERE granularity = ? AND period_start >= ?', (granularity, start))
+            conn.execute('DELETE FROM ping_rollup_histogram WHERE granularity = ? AND period_start >= ?',
+                         (granularity, start))
+
+    last_id = 0
+    processed = 0
+    while True:
+        rows = conn.execute('''
+            SELECT id, ip, timestamp, success, packet_loss, latencies, latencies_packed
+            FROM ping_results WHERE id > ? ORDER BY id LIMIT ?
+        ''', (last_id, chunk_size)).fetchall()
+        if not rows:
+            break
+        acc = RollupAccumulator()
+        for row in rows:
+            latencies, lost = decode_row(row[1:])
+            acc.add(row[1], row[2], row[3] == 1, latencies, lost)
+        for totals in (acc.rollups, acc.histogram):
+            for key in [key for key in totals if key[2] < rebuild_from[key[0]]]:
+                del totals[key]
+        with conn:
+            for sql, params in acc.statements():
+                conn.executemany(sql, params)
+        last_id = rows[-1][0]
+        processed += len(rows)
+        logger.info(f"已回填 {processed} 条原始记录")
+    return processed
+
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按内容寻址的路由路径存储和路径变化记录
+
+每条不同的跳序列只在 routes 表中保存一次，route_id 是跳序列（跳数和 IP）的哈希；
+traceroute_results 的每一行只引用 route_id，本次运行各跳的往返时间另存为
+hop_rtts（与 latencies_packed 相同的 float32 编码）。路径稳定时每次运行只多写
+一行很小的记录。系统 traceroute 每跳发送多个探测（-q N）时，每个探测的回复地址
+（等价路径上可能不同）和往返时间按 encode_hop_probes 的格式保存在 hop_probes 中。
+
+各跳的地理位置随路径保存。查询失败（例如超时）的跳数记在 unresolved 中，之后的运行
+查询成功的跳更多时用新的地理位置更新该路径，一次临时的查询失败不会永久留在路径上。
+
+目标的路径与上一次完整追踪的路径不同时，在 route_changes 中记录一次变化，
+"路径什么时候变了" 可以直接按索引查询，不必逐条解析比较 JSON。比较时没有回复的跳（"*"）
+与任何地址都相同：偶尔不回复的路由器会产生不同的 route_id，但不算路径变化。
+"""
+
+import hashlib
+import json
+import logging
+import math
+import struct
+
+import latency_codec
+
+logger = logging.getLogger("traceroute_monitor")
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS routes (
+        route_id TEXT PRIMARY KEY,   -- 跳序列的哈希
+        hops_json TEXT NOT NULL,     -- 跳列表（跳数、IP、地理位置）
+        hop_count INTEGER NOT NULL,
+        first_seen TEXT NOT NULL,
+        unresolved INTEGER           -- 地理位置查询失败的跳数
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS route_changes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        target_ip TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        old_route_id TEXT,           -- 变化前的路径，首次记录时为空
+        new_route_id TEXT NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_route_changes_target ON route_changes (target_ip, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_route_changes_timestamp ON route_changes (timestamp)',
+]
+
+# 已有的路径只在新的地理位置查询失败更少时更新（旧版本写入的路径 unresolved 为空，更新一次）
+ROUTE_UPSERT_CLAUSE = '''
+ON CONFLICT (route_id) DO UPDATE SET hops_json = excluded.hops_json, unresolved = excluded.unresolved
+WHERE excluded.unresolved < COALESCE(routes.unresolved, routes.hop_count + 1)
+'''
+
+ROUTE_INSERT_SQL = '''
+INSERT INTO routes (route_id, hops_json, hop_count, first_seen, unresolved)
+VALUES (?, ?, ?, ?, ?)
+''' + ROUTE_UPSERT_CLAUSE
+
+ROUTE_CHANGE_INSERT_SQL = '''
+INSERT INTO route_changes (target_ip, timestamp, old_route_id, new_route_id)
+VALUES (?, ?, ?, ?)
+'''
+
+
+def init_route_tables(conn):
+    """创建路径表并为 traceroute_results 补充新增的列"""
+    for statement in SCHEMA:
+        conn.execute(statement)
+    if 'unresolved' not in {row[1] for row in conn.execute('PRAGMA table_info(routes)')}:
+        conn.execute('ALTER TABLE routes ADD COLUMN unresolved INTEGER')
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(traceroute_results)')}
+    if 'route_id' not in columns:
+        conn.execute('ALTER TABLE traceroute_results ADD COLUMN route_id TEXT')
+    if 'hop_rtts' not in columns:
+        conn.execute('ALTER TABLE traceroute_results ADD COLUMN hop_rtts BLOB')
+    if 'hop_probes' not in columns:
+        conn.execute('ALTER TABLE traceroute_results ADD COLUMN hop_probes BLOB')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_traceroute_route ON traceroute_results (target_ip, route_id)')
+
+
+def route_key(hops):
+    """跳序列的哈希，只取决于跳数和 IP"""
+    path = [[hop["hop"], hop["ip"]] for hop in hops]
+    return hashlib.sha1(json.dumps(path, separators=(',', ':')).encode('utf-8')).hexdigest()[:16]
+
+
+def route_hops(hops):
+    """routes 表中保存的跳列表（不含每次运行都不同的往返时间）"""
+    return [{"hop": hop["hop"], "ip": hop["ip"], "location": hop.get("location")} for hop in hops]
+
+
+def hop_path(hops):
+    """用于比较路径的 [(跳数, IP), ...]"""
+    return [(hop["hop"], hop["ip"]) for hop in hops]
+
+
+def same_path(old, new):
+    """两条路径的跳数相同，且双方都有回复的每一跳地址相同（"*" 与任何地址都相同）"""
+    if old is None or len(old) != len(new):
+        return False
+    return all(
+        old_hop == new_hop and (old_ip == new_ip or "*" in (old_ip, new_ip))
+        for (old_hop, old_ip), (new_hop, new_ip) in zip(old, new)
+    )
+
+
+def unresolved_hops(hops):
+    """地理位置查询失败的跳数（traceroute_monitor 为这些跳设置 location_failed）"""
+    return sum(1 for hop in hops if hop.get("location_failed"))
+
+
+def encode_hop_rtts(hops):
+    """各跳的往返时间编码为 BLOB，没有往返时间的跳记为丢失；都没有时返回 None"""
+    rtts = [hop.get("rtt") for hop in hops]
+    if all(rtt is None for rtt in rtts):
+        return None
+    return latency_codec.encode_samples(rtts)
+
+
+def encode_hop_probes(hops):
+    """各跳每个探测的 (回复地址, 往返时间) 编码为 BLOB，跳中没有 probes 时返回 None
+
+    格式（小端）：uint16 其他地址数、每个地址为 uint8 长度 + UTF-8 文本；然后每跳一个
+    uint8 探测数，每个探测为 uint16 地址编号（0 无回复，1 该跳的代表地址，k >= 2 为
+    第 k-2 个其他地址）+ float32 往返时间（毫秒，没有时为 NaN）。
+    """
+    if not any(hop.get("probes") for hop in hops):
+        return None
+    others = {}
+    body = bytearray()
+    for hop in hops:
+        probes = hop.get("probes") or []
+        body += struct.pack("<B", len(probes))
+        for address, rtt in probes:
+            if address is None:
+                code = 0
+            elif address == hop["ip"]:
+                code = 1
+            else:
+                code = others.setdefault(address, len(others) + 2)
+            body += struct.pack("<Hf", code, math.nan if rtt is None else rtt)
+    header = bytearray(struct.pack("<H", len(others)))
+    for address in others:
+        encoded = address.encode("utf-8")
+        header += struct.pack("<B", len(encoded)) + encoded
+    return bytes(header + body)
+
+
+def decode_hop_probes(blob, hops):
+    """按 hops（路径中的跳列表）解码 hop_probes，返回每跳的 [(回复地址, 往返时间), ...]"""
+    (count,), offset = struct.unpack_from("<H", blob), 2
+    others = []
+    for _ in range(count):
+        length = blob[offset]
+        others.append(blob[offset + 1:offset + 1 + length].decode("utf-8"))
+        offset += 1 + length
+    decoded = []
+    for hop in hops:
+        probes = []
+        for _ in range(blob[offset]):
+            code, rtt = struct.unpack_from("<Hf", blob, offset + 1 + len(probes) * 6)
+            address = None if code == 0 else hop["ip"] if code == 1 else others[code - 2]
+            probes.append((address, None if math.isnan(rtt) else round(rtt, 3)))
+        offset += 1 + len(probes) * 6
+        decoded.append(probes)
+    return decoded
+
+
+def latest_routes(conn, target_ips):
+    """各目标本机最近一次完整追踪（没有错误）的 (route_id, 路径)，路径见 hop_path
+
+    从其他采集点合并来的行（source_id 不为空，见 vantage_sync.py）走的是另一条路径，不参与比较，
+    否则每次同步后本机的下一次追踪都会被记为路径变化。
+    """
+    latest = {}
+    for target_ip in target_ips:
+        row = conn.execute('''
+            SELECT t.route_id, r.hops_json FROM traceroute_results t
+            LEFT JOIN routes r ON r.route_id = t.route_id
+            WHERE t.target_ip = ? AND t.route_id IS NOT NULL AND t.error IS NULL AND t.source_id IS NULL
+            ORDER BY t.id DESC LIMIT 1
+        ''', (target_ip,)).fetchone()
+        if row is not None:
+            latest[target_ip] = (row[0], hop_path(json.loads(row[1])) if row[1] else None)
+    return latest
+
+
+def route_statements(results, timestamp, previous):
+    """为一批 traceroute 结果生成写入语句
+
+    results 中每项为 (target_ip, hops, error)，previous 为 latest_routes 的结果。
+    返回 (各结果的 (route_id, hop_rtts, hop_probes) 列表, [(sql, rows), ...])。只有没有错误的完整追踪
+    才参与路径变化判断，超时得到的部分路径仍会保存但不会被记为路径变化；只有 "*" 不同的
+    路径（见 same_path）也不记为变化。
+    """
+    refs = []
+    route_rows = {}
+    change_rows = []
+    current = dict(previous)
+    for target_ip, hops, error in results:
+        if not hops:
+            refs.append((None, None, None))
+            continue
+        route_id = route_key(hops)
+        unresolved = unresolved_hops(hops)
+        if route_id not in route_rows or unresolved < route_rows[route_id][4]:
+            stored = route_hops(hops)
+            route_rows[route_id] = (route_id, json.dumps(stored, ensure_ascii=False), len(stored), timestamp, unresolved)
+        refs.append((route_id, encode_hop_rtts(hops), encode_hop_probes(hops)))
+        old_route_id, old_path = current.get(target_ip, (None, None))
+        path = hop_path(hops)
+        if error is None and old_route_id != route_id and not same_path(old_path, path):
+            change_rows.append((target_ip, timestamp, old_route_id, route_id))
+            current[target_ip] = (route_id, path)
+    return refs, [
+        (ROUTE_INSERT_SQL, list(route_rows.values())),
+        (ROUTE_CHANGE_INSERT_SQL, change_rows),
+    ]
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+常驻模式使用的间隔调度器
+
+每个任务有自己的执行间隔，按下一次执行时间保存在最小堆中。任务的首次执行
+时间按键的哈希值在间隔内错开，避免所有目标在同一时刻集中探测。
+
+AdaptivePolicy 根据每轮探测的丢包和抖动调整目标的间隔和探测包数，并把所有
+目标合计的发包速率限制在预算之内。
+"""
+
+import heapq
+import itertools
+import zlib
+
+
+def spread_offset(key, interval):
+    """根据键计算稳定的相位偏移（0 到 interval 之间）"""
+    return (zlib.crc32(str(key).encode('utf-8')) / 2 ** 32) * interval
+
+
+class IntervalScheduler:
+    """按固定间隔重复执行的任务调度器（时间单位：秒，使用单调时钟）"""
+
+    def __init__(self):
+        self._heap = []
+        # 任务键 -> (间隔, 版本号)，版本号用于识别堆中已失效的条目
+        self._jobs = {}
+        # 相同执行时间时保持插入顺序
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def add(self, key, interval, start):
+        """添加任务，首次在 start 时刻执行"""
+        if interval <= 0:
+            raise ValueError(f"任务 {key} 的间隔必须大于0")
+        version = next(self._counter)
+        self._jobs[key] = (interval, version)
+        heapq.heappush(self._heap, (start, version, key))
+
+    def remove(self, key):
+        """移除任务，堆中残留的条目会在弹出时被丢弃"""
+        self._jobs.pop(key, None)
+
+    def interval(self, key):
+        job = self._jobs.get(key)
+        return job[0] if job else None
+
+    def set_interval(self, key, interval):
+        """修改任务的间隔，已安排的下一次执行时间不变，之后按新间隔递推"""
+        if interval <= 0:
+            raise ValueError(f"任务 {key} 的间隔必须大于0")
+        job = self._jobs.get(key)
+        if job is not None:
+            self._jobs[key] = (interval, job[1])
+
+    def _is_stale(self, entry):
+        job = self._jobs.get(entry[2])
+        return job is None or job[1] != entry[1]
+
+    def pop_due(self, now):
+        """弹出所有已到期的任务并安排下一次执行，返回到期任务的键列表"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._is_stale(entry):
+                continue
+            run_at, version, key = entry
+            interval = self._jobs[key][0]
+            due.append(key)
+            # 以计划时间为基准递推，避免累计漂移；落后太多时直接对齐到当前时间
+            next_run = run_at + interval
+            if next_run <= now:
+                next_run = now + interval
+            heapq.heappush(self._heap, (next_run, version, key))
+        return due
+
+    def seconds_until_next(self, now):
+        """距离下一个任务到期的秒数，没有任务时返回 None"""
+        while self._heap and self._is_stale(self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - now)
+
+
+# 自适应探测的级别：稳定目标降低采样，异常目标提高采样
+LEVEL_QUIET = "quiet"
+LEVEL_NORMAL = "normal"
+LEVEL_ALERT = "alert"
+
+
+class AdaptivePolicy:
+    """根据最近的丢包和抖动调整每个目标的探测间隔和每轮探测包数
+
+    levels 为 级别 -> (间隔倍数, 探测包数倍数)。出现丢包或抖动超过阈值时立即进入
+    alert 级别；连续 recovery_rounds 轮正常后回到 normal，再连续 quiet_rounds 轮
+    正常后进入 quiet。所有目标合计的平均发包速率不超过 pps_budget，超出时优先
+    拉长非 alert 目标的间隔。
+    """
+
+    def __init__(self, levels, loss_threshold, jitter_threshold,
+                 recovery_rounds, quiet_rounds, pps_budget, min_count=1):
+        self.levels = levels
+        self.loss_threshold = loss_threshold
+        self.jitter_threshold = jitter_threshold
+        self.recovery_rounds = recovery_rounds
+        self.quiet_rounds = quiet_rounds
+        self.pps_budget = pps_budget
+        self.min_count = min_count
+        # 键 -> {"base": (间隔, 包数), "min_interval": 最短间隔, "level": 级别, "clean": 连续正常轮数}
+        self._targets = {}
+        # 键 -> 当前生效的 (间隔, 包数)
+        self.plan = {}
+
+    def add(self, key, interval, count, min_interval=0.0):
+        """登记目标的基础间隔和包数，返回新的调度计划"""
+        return self.update(added=[(key, interval, count, min_interval)])
+
+    def remove(self, key):
+        return self.update(removed=[key])
+
+    def update(self, added=(), removed=()):
+        """批量删除和登记目标，只重新计算一次调度计划并返回
+
+        added 为 (键, 基础间隔, 包数, 最短间隔) 的列表。每次计算计划要遍历所有目标，
+        逐个 add 加载 n 个目标需要 O(n²) 的时间。
+        """
+        for key in removed:
+            self._targets.pop(key, None)
+            self.plan.pop(key, None)
+        for key, interval, count, min_interval in added:
+            self._targets[key] = {
+                "base": (interval, count),
+                "min_interval": min_interval,
+                "level": LEVEL_NORMAL,
+                "clean": 0,
+            }
+        return self._replan()
+
+    def level(self, key):
+        return self._targets[key]["level"]
+
+    def observe(self, key, loss_ratio, jitter):
+        """记录一轮探测结果；级别变化时返回新的调度计划，否则返回 None"""
+        state = self._targets.get(key)
+        if state is None:
+            return None
+        previous = state["level"]
+        if loss_ratio >= self.loss_threshold or (jitter is not None and jitter >= self.jitter_threshold):
+            state["level"] = LEVEL_ALERT
+            state["clean"] = 0
+        else:
+            state["clean"] += 1
+            if state["level"] == LEVEL_ALERT and state["clean"] >= self.recovery_rounds:
+                state["level"] = LEVEL_NORMAL
+                state["clean"] = 0
+            elif state["level"] == LEVEL_NORMAL and state["clean"] >= self.quiet_rounds:
+                state["level"] = LEVEL_QUIET
+        if state["level"] == previous:
+            return None
+        return self._replan()
+
+    def _desired(self, state):
+        base_interval, base_count = state["base"]
+        interval_factor, count_factor = self.levels[state["level"]]
+        # 降低采样时不少于 min_count 个包，但不会超过目标本身配置的包数
+        count = max(min(self.min_count, base_count), int(round(base_count * count_factor)))
+        interval = max(base_interval * interval_factor, state["min_interval"])
+        return interval, count
+
+    def _replan(self):
+        """计算所有目标的 (间隔, 包数)，并按发包预算拉长间隔"""
+        desired = {key: self._desired(state) for key, state in self._targets.items()}
+        alert = {key for key, state in self._targets.items() if state["level"] == LEVEL_ALERT}
+        alert_pps = sum(count / interval for key, (interval, count) in desired.items() if key in alert)
+        other_pps = sum(count / interval for key, (interval, count) in desired.items() if key not in alert)
+
+        alert_stretch = other_stretch = 1.0
+        if self.pps_budget and alert_pps + other_pps > self.pps_budget:
+            if alert_pps < self.pps_budget:
+                # alert 目标保持加密采样，其余目标分摊剩余的预算
+                other_stretch = other_pps / (self.pps_budget - alert_pps)
+            else:
+                # alert 目标本身已超出预算：所有目标按同一比例拉长
+                alert_stretch = other_stretch = (alert_pps + other_pps) / self.pps_budget
+
+        self.plan = {
+            key: (interval * (alert_stretch if key in alert else other_stretch), count)
+            for key, (interval, count) in desired.items()
+        }
+        return self.plan
+
+    def total_pps(self):
+        """当前计划的平均发包速率（包/秒）"""
+        return sum(count / interval for interval, count in self.plan.values())
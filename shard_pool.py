@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多进程分片探测
+
+目标按 IP 的一致性哈希分配给固定数量的工作进程，同一目标始终由同一个进程探测，
+每个进程有自己的探测循环（ICMP 套接字、事件循环和系统 ping 线程池）。主进程把一轮
+到期的目标按分片拆开分发，各进程完成探测和输出解析后把结果通过一个共享的
+multiprocessing 队列送回主进程，由主进程中唯一的写入线程（db_writer）写库。
+
+工作进程的日志经队列交给主进程的日志处理器输出，避免多个进程同时轮转同一个日志文件。
+每个工作进程有自己的结果管道，结束一个进程不会影响其他进程送回结果。
+工作进程意外退出，或者一个分片的执行时间超过分发时给出的上限（进程卡住）时，该进程
+尚未完成的分片以 ShardError 失败，卡住的进程被结束，下一次分发前自动重启。
+
+主进程有写入线程等多个线程，fork 出的子进程会继承其他线程持有的锁，工作进程只用
+forkserver 或 spawn 方式启动。
+"""
+
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.connection
+import signal
+import threading
+import time
+
+logger = logging.getLogger("ping_monitor")
+
+# 每个工作进程在哈希环上的虚拟节点数，越多分配越均匀
+RING_REPLICAS = 100
+# 结果收集线程检查工作进程是否存活的间隔（秒）
+WORKER_CHECK_INTERVAL = 1.0
+# 关闭时等待工作进程退出的时间（秒）
+WORKER_JOIN_TIMEOUT = 10
+# 工作进程的启动方式，按顺序选择当前平台支持的第一种（不使用 fork）
+START_METHODS = ("forkserver", "spawn")
+# 队列关闭标记
+_STOP = None
+
+
+class ShardError(Exception):
+    """分片在工作进程中探测失败或工作进程意外退出"""
+
+
+def ring_hash(key):
+    """稳定的 64 位哈希（与进程和运行次数无关，不能用内置 hash）"""
+    return int.from_bytes(hashlib.md5(str(key).encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """一致性哈希环：工作进程数改变时只有约 1/N 的目标改变归属"""
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        points = sorted((ring_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        if not points:
+            raise ValueError("哈希环中没有节点")
+        self._points = [point for point, _node in points]
+        self._owners = [node for _point, node in points]
+
+    def node_for(self, key):
+        """键所属的节点：环上顺时针方向的第一个虚拟节点"""
+        index = bisect.bisect(self._points, ring_hash(key))
+        return self._owners[index % len(self._owners)]
+
+    def split(self, keys):
+        """按所属节点拆分 -> {节点: [键, ...]}，各分片内保持原有顺序"""
+        shards = {}
+        for key in keys:
+            shards.setdefault(self.node_for(key), []).append(key)
+        return shards
+
+
+def start_context():
+    """工作进程使用的 multiprocessing 上下文"""
+    available = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(next(method for method in START_METHODS if method in available))
+
+
+def _worker_main(index, probe_func, tasks, results, log_queue, log_level, initializer, initargs):
+    """工作进程：循环取出分片任务执行 probe_func，把结果写入本进程的结果管道"""
+    # Ctrl+C 由主进程处理，主进程关闭时通过关闭标记结束工作进程
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_logger = logging.getLogger("ping_monitor")
+    worker_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    worker_logger.setLevel(log_level)
+    worker_logger.propagate = False
+    if initializer is not None:
+        initializer(*initargs)
+
+    while True:
+        task = tasks.get()
+        if task is _STOP:
+            break
+        task_id, args = task
+        try:
+            results.send((task_id, probe_func(*args), None))
+        except Exception as e:
+            results.send((task_id, None, f"{type(e).__name__}: {str(e)}"))
+    results.close()
+
+
+class ShardPool:
+    """按一致性哈希把目标分给固定数量的工作进程探测
+
+    probe_func(ips, *args) 在工作进程中执行，返回可序列化的结果列表；它和 initializer
+    必须是模块级函数，以便在 forkserver / spawn 方式启动的进程中导入。
+    """
+
+    def __init__(self, workers, probe_func, initializer=None, initargs=(), replicas=RING_REPLICAS):
+        self.workers = workers
+        self.probe_func = probe_func
+        self.initializer = initializer
+        self.initargs = initargs
+        self.ring = HashRing(range(workers), replicas)
+        self._context = start_context()
+        self._log_queue = self._context.Queue()
+        self._tasks = [None] * workers
+        self._readers = [None] * workers
+        self._processes = [None] * workers
+        # 任务编号 -> (Future, 工作进程编号, 执行时间上限)
+        self._pending = {}
+        # 各工作进程按分发顺序排队的任务编号，队首是正在执行的任务
+        self._assigned = [collections.deque() for _ in range(workers)]
+        # 各工作进程开始执行队首任务的时间（单调时钟），空闲时为 None
+        self._started = [None] * workers
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._collector = None
+        self._log_listener = None
+        self._closed = False
+        self._stopping = threading.Event()
+
+    def start(self):
+        """启动日志转发、全部工作进程和结果收集线程，返回自身"""
+        self._log_listener = logging.handlers.QueueListener(
+            self._log_queue, *logger.handlers, respect_handler_level=True
+        )
+        self._log_listener.start()
+        with self._lock:
+            for index in range(self.workers):
+                self._spawn(index)
+        self._collector = threading.Thread(target=self._collect, name="shard-results", daemon=True)
+        self._collector.start()
+        return self
+
+    def _spawn(self, index):
+        """启动（或重启）第 index 个工作进程，调用方需持有 _lock"""
+        # 重启时使用新的任务队列和结果管道，已经判定失败的分片不会再被执行
+        self._tasks[index] = self._context.Queue()
+        reader, writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker_main,
+            name=f"probe-shard-{index}",
+            args=(index, self.probe_func, self._tasks[index], writer, self._log_queue,
+                  logger.getEffectiveLevel(), self.initializer, self.initargs),
+            daemon=True,
+        )
+        process.start()
+        # 关闭主进程中的写端，工作进程退出后读端才能收到 EOF
+        writer.close()
+        self._readers[index] = reader
+        self._processes[index] = process
+
+    def _fail_worker(self, index, message):
+        """让第 index 个工作进程尚未完成的分片以 ShardError 失败并丢弃该进程，调用方需持有 _lock
+
+        返回被丢弃的进程对象（可能为 None），下一次分发前重启。
+        """
+        process = self._processes[index]
+        self._processes[index] = None
+        if self._readers[index] is not None:
+            self._readers[index].close()
+            self._readers[index] = None
+        for task_id in self._assigned[index]:
+            future, _owner, _limit = self._pending.pop(task_id)
+            future.set_exception(ShardError(message))
+        self._assigned[index].clear()
+        self._started[index] = None
+        return process
+
+    def _fail_dead_workers(self):
+        """让已退出的工作进程尚未完成的分片失败，调用方需持有 _lock，返回退出的进程编号"""
+        dead = [index for index, process in enumerate(self._processes)
+                if process is not None and not process.is_alive()]
+        for index in dead:
+            exitcode = self._processes[index].exitcode
+            self._fail_worker(index, f"分片 {index} 的工作进程意外退出（退出码 {exitcode}）")
+        return dead
+
+    def _expire_overdue(self, now):
+        """结束正在执行的分片超过执行时间上限的工作进程，调用方需持有 _lock，返回 [(编号, 进程, 上限)]"""
+        expired = []
+        for index, started in enumerate(self._started):
+            if started is None:
+                continue
+            limit = self._pending[self._assigned[index][0]][2]
+            if limit is not None and now - started > limit:
+                process = self._fail_worker(index, f"分片 {index} 超过 {limit:.0f} 秒未完成，工作进程已被结束")
+                expired.append((index, process, limit))
+        return expired
+
+    def _receive(self, index, reader):
+        """读取第 index 个工作进程送回的一个结果，交给对应的 Future"""
+        try:
+            task_id, results, error = reader.recv()
+        except (EOFError, OSError):
+            # 工作进程已退出（写端关闭），关闭时是正常退出
+            with self._lock:
+                if self._readers[index] is not reader:
+                    return
+                if self._closed:
+                    reader.close()
+                    self._readers[index] = None
+                else:
+                    self._fail_worker(index, f"分片 {index} 的工作进程意外退出")
+                    logger.error(f"分片探测进程 {index} 意外退出，将在下一轮分发前重启")
+            return
+        with self._lock:
+            future, _owner, _limit = self._pending.pop(task_id, (None, None, None))
+            if future is not None:
+                self._assigned[index].remove(task_id)
+                # 工作进程按顺序执行，送回结果后立即开始下一个任务
+                self._started[index] = time.monotonic() if self._assigned[index] else None
+        if future is None:
+            return
+        if error is None:
+            future.set_result(results)
+        else:
+            future.set_exception(ShardError(f"分片 {index} 探测失败: {error}"))
+
+    def _collect(self):
+        """结果收集线程：把工作进程送回的结果交给对应的 Future，结束卡住的工作进程
+
+        重启的工作进程的结果管道在下一次等待时才加入，最多延迟 WORKER_CHECK_INTERVAL 秒。
+        """
+        while True:
+            stopping = self._stopping.is_set()
+            with self._lock:
+                readers = {reader: index for index, reader in enumerate(self._readers) if reader is not None}
+            if readers:
+                ready = multiprocessing.connection.wait(list(readers), 0 if stopping else WORKER_CHECK_INTERVAL)
+            else:
+                ready = []
+                if not stopping:
+                    self._stopping.wait(WORKER_CHECK_INTERVAL)
+            for reader in ready:
+                self._receive(readers[reader], reader)
+            if stopping and not ready:
+                # 关闭时已送回的结果全部读完后退出
+                return
+            if self._closed:
+                continue
+            with self._lock:
+                for index in self._fail_dead_workers():
+                    logger.error(f"分片探测进程 {index} 意外退出，将在下一轮分发前重启")
+                expired = self._expire_overdue(time.monotonic())
+            for index, process, limit in expired:
+                logger.error(f"分片探测进程 {index} 执行一个分片超过 {limit:.0f} 秒，已结束，将在下一轮分发前重启")
+                if process is not None:
+                    self._terminate(process)
+
+    @staticmethod
+    def _terminate(process):
+        process.terminate()
+        process.join(WORKER_JOIN_TIMEOUT)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def submit(self, ips, *args, time_limit=None):
+        """按分片把目标分发给工作进程，返回各分片的 Future 列表，Future 的结果是该分片的结果列表
+
+        time_limit 为每个分片从工作进程开始执行起的最长时间（秒），超过时该分片和同一进程上
+        排队的分片以 ShardError 失败，工作进程被结束。
+        """
+        if self._closed:
+            raise ShardError("分片探测进程已关闭")
+        futures = []
+        with self._lock:
+            self._fail_dead_workers()
+            for index, shard in sorted(self.ring.split(ips).items()):
+                if self._processes[index] is None:
+                    self._spawn(index)
+                future = concurrent.futures.Future()
+                task_id = next(self._ids)
+                self._pending[task_id] = (future, index, time_limit)
+                if not self._assigned[index]:
+                    self._started[index] = time.monotonic()
+                self._assigned[index].append(task_id)
+                self._tasks[index].put((task_id, (shard,) + args))
+                futures.append(future)
+        return futures
+
+    def close(self):
+        """等待工作进程完成已分发的分片后退出，停止结果收集和日志转发"""
+        if self._closed:
+            return
+        self._closed = True
+        with self._lock:
+            for index, process in enumerate(self._processes):
+                if process is not None:
+                    self._tasks[index].put(_STOP)
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(WORKER_JOIN_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"分片探测进程 {process.name} 未能按时退出，强制结束")
+                process.terminate()
+                process.join()
+        self._stopping.set()
+        if self._collector is not None:
+            self._collector.join()
+        with self._lock:
+            for future, _index, _limit in self._pending.values():
+                future.set_exception(ShardError("分片探测进程已关闭"))
+            self._pending.clear()
+            for reader in self._readers:
+                if reader is not None:
+                    reader.close()
+        if self._log_listener is not None:
+            self._log_listener.stop()
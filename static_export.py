@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+供网页直接读取的静态数据文件
+
+- 按天把 ping_data.db 切分为小的 SQLite 分片（shards/ping_YYYY-MM-DD.db），并生成
+  shards/manifest.json 描述每个分片。网页只下载所选日期范围内的分片，页面加载
+  时间和浏览器内存只取决于所选范围，而不是数据保留的总时长。主库中原始结果被清理
+  （超过原始数据保留期）的日期，分片中也删除原始结果，只保留预聚合表和路径表，
+  直到预聚合数据过期后再删除整个分片。
+- latest.json：每个目标的最新一次测试结果，首页的摘要卡片无需加载数据库即可显示。
+- summary.json：报表页概览和在线率所需的汇总数字。
+- targets.json：网页显示的目标列表（IP 和地区），带内容哈希作为版本号。目标
+  配置变化时只重写这个小文件，ping_monitor.js 本身不再被修改，可以长期缓存。
+
+这些文件只包含本机探测的结果（与预聚合表、路径变化记录一致）。收集端从其他采集点
+合并来的行（source_id 不为空）只保存在 ping_data.db 中，各采集点的同一个 IP 共用
+一个 ip 值，混在一起会让网页的图表和最新状态交替显示不同采集点的结果。
+
+所有文件都先写入临时文件再重命名，读取者不会看到写了一半的文件。
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import logging
+
+logger = logging.getLogger("ping_monitor")
+
+# 最新状态和汇总快照文件
+LATEST_FILE = "latest.json"
+SUMMARY_FILE = "summary.json"
+# 网页使用的目标列表
+TARGETS_FILE = "targets.json"
+TARGETS_VERSION = 1
+# 汇总快照的统计窗口（天），与报表页概览一致
+SUMMARY_WINDOW_DAYS = 7
+# 分片目录和清单文件名
+SHARD_DIR = "shards"
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 2
+# 按行追加的表：表名 -> 时间列
+APPEND_TABLES = {
+    "ping_results": "timestamp",
+    "traceroute_results": "timestamp",
+    "route_changes": "timestamp",
+}
+# 原始结果表，主库清理后分片中也只保留其他表
+RAW_TABLES = ("ping_results", "traceroute_results")
+# 被分片中的行引用、需要一并复制的表：表名 -> (引用它的表, 引用列)
+# 被引用的行在主库中可能被更新（路径的地理位置后来查询成功），每次导出都重新复制
+REFERENCED_TABLES = {
+    "routes": ("traceroute_results", "route_id"),
+}
+# 按主键复制被引用行时每条查询的参数个数
+REFERENCE_CHUNK_SIZE = 500
+# 每次整天替换的预聚合表：表名 -> 时间列
+REPLACE_TABLES = {
+    "ping_rollups": "period_start",
+    "ping_rollup_histogram": "period_start",
+}
+
+
+def write_file_atomic(path, data):
+    """先写入同目录下的临时文件再重命名，保证读取者看到的总是完整文件"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp 创建的文件只有属主可读，网页服务器需要能读取
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_json_atomic(path, data):
+    """原子地写入 JSON 文件"""
+    write_file_atomic(path, json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8'))
+
+
+def file_hash(path):
+    """文件内容的短哈希，用于浏览器缓存失效"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def load_manifest(shard_dir):
+    """读取分片清单，不存在或损坏时返回空清单"""
+    path = os.path.join(shard_dir, MANIFEST_FILE)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {"version": MANIFEST_VERSION, "high_water": {}, "shards": []}
+
+
+def _existing_tables(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def _columns(conn, table):
+    return [(row[1], row[2]) for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def _local_filter(conn, table):
+    """只选本机结果的附加条件：从其他采集点合并来的行 source_id 不为空，旧数据库没有该列"""
+    if "source_id" in {name for name, _type in _columns(conn, table)}:
+        return " AND source_id IS NULL"
+    return ""
+
+
+def _ensure_table(src, dst, table):
+    """在分片中创建与主库相同的表和索引，主库新增的列同步添加到已有分片"""
+    if table not in _existing_tables(dst):
+        for (sql,) in src.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL ORDER BY type DESC", (table,)
+        ):
+            dst.execute(sql)
+        return
+    dst_columns = {name for name, _type in _columns(dst, table)}
+    for name, col_type in _columns(src, table):
+        if name not in dst_columns:
+            dst.execute(f'ALTER TABLE {table} ADD COLUMN {name} {col_type}')
+
+
+def _day_range(day):
+    start = datetime.datetime.strptime(day, "%Y-%m-%d")
+    end = start + datetime.timedelta(days=1)
+    return start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def write_shard(src, shard_dir, day):
+    """更新某一天的分片，返回清单条目
+
+    在已有分片的副本上只追加新行（预聚合表整天替换，并重新复制分片中引用的路径），
+    再原子地替换原文件。
+    """
+    path = os.path.join(shard_dir, f"ping_{day}.db")
+    tmp_path = path + ".tmp"
+    if os.path.exists(path):
+        shutil.copyfile(path, tmp_path)
+    elif os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    start, end = _day_range(day)
+    src_tables = _existing_tables(src)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        with dst:
+            for table, time_column in APPEND_TABLES.items():
+                if table not in src_tables:
+                    continue
+                _ensure_table(src, dst, table)
+                names = [name for name, _type in _columns(src, table)]
+                local = _local_filter(src, table)
+                if local:
+                    # 旧版本导出的分片可能包含合并来的行
+                    dst.execute(f'DELETE FROM {table} WHERE source_id IS NOT NULL')
+                last_id = dst.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+                rows = src.execute(
+                    f'SELECT {", ".join(names)} FROM {table} '
+                    f'WHERE {time_column} >= ? AND {time_column} < ? AND id > ?{local}',
+                    (start, end, last_id)
+                )
+                placeholders = ", ".join("?" * len(names))
+                dst.executemany(f'INSERT OR IGNORE INTO {table} ({", ".join(names)}) VALUES ({placeholders})', rows)
+
+            for table, time_column in REPLACE_TABLES.items():
+                if table not in src_tables:
+                    continue
+                _ensure_table(src, dst, table)
+                names = [name for name, _type in _columns(src, table)]
+                dst.execute(f'DELETE FROM {table} WHERE {time_column} >= ? AND {time_column} < ?', (start, end))
+                rows = src.execute(
+                    f'SELECT {", ".join(names)} FROM {table} WHERE {time_column} >= ? AND {time_column} < ?',
+                    (start, end)
+                )
+                placeholders = ", ".join("?" * len(names))
+                dst.executemany(f'INSERT INTO {table} ({", ".join(names)}) VALUES ({placeholders})', rows)
+
+            for table, (ref_table, column) in REFERENCED_TABLES.items():
+                if table not in src_tables or ref_table not in _existing_tables(dst):
+                    continue
+                _ensure_table(src, dst, table)
+                names = [name for name, _type in _columns(src, table)]
+                placeholders = ", ".join("?" * len(names))
+                referenced = [row[0] for row in dst.execute(
+                    f'SELECT DISTINCT {column} FROM {ref_table} WHERE {column} IS NOT NULL'
+                )]
+                for i in range(0, len(referenced), REFERENCE_CHUNK_SIZE):
+                    chunk = referenced[i:i + REFERENCE_CHUNK_SIZE]
+                    rows = src.execute(
+                        f'SELECT {", ".join(names)} FROM {table} WHERE {column} IN ({", ".join("?" * len(chunk))})',
+                        chunk
+                    )
+                    dst.executemany(f'INSERT OR REPLACE INTO {table} ({", ".join(names)}) VALUES ({placeholders})', rows)
+
+        row_counts = _row_counts(dst)
+    finally:
+        dst.close()
+
+    os.replace(tmp_path, path)
+    return _shard_entry(path, day, row_counts)
+
+
+def _row_counts(dst):
+    present = _existing_tables(dst)
+    return {
+        table: dst.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        for table in APPEND_TABLES if table in present
+    }
+
+
+def _shard_entry(path, day, row_counts):
+    return {
+        "date": day,
+        "file": os.path.basename(path),
+        "bytes": os.path.getsize(path),
+        "hash": file_hash(path),
+        "rows": row_counts,
+    }
+
+
+def strip_raw_rows(shard_dir, entry):
+    """删除分片中的原始结果和只被它们引用的路径，保留预聚合表和路径变化记录，返回新的清单条目"""
+    path = os.path.join(shard_dir, entry["file"])
+    tmp_path = path + ".tmp"
+    shutil.copyfile(path, tmp_path)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        with dst:
+            present = _existing_tables(dst)
+            for table in RAW_TABLES:
+                if table in present:
+                    dst.execute(f'DELETE FROM {table}')
+            if "routes" in present:
+                referenced = ""
+                if "route_changes" in present:
+                    referenced = (' WHERE route_id NOT IN (SELECT new_route_id FROM route_changes '
+                                  'UNION SELECT old_route_id FROM route_changes WHERE old_route_id IS NOT NULL)')
+                dst.execute(f'DELETE FROM routes{referenced}')
+        dst.execute('VACUUM')
+        row_counts = _row_counts(dst)
+    finally:
+        dst.close()
+
+    os.replace(tmp_path, path)
+    return _shard_entry(path, entry["date"], row_counts)
+
+
+def changed_days(src, high_water):
+    """根据各表的最大 id 找出有新数据的日期，返回 (日期集合, 新的最大 id)"""
+    days = set()
+    new_high_water = {}
+    src_tables = _existing_tables(src)
+    for table, time_column in APPEND_TABLES.items():
+        if table not in src_tables:
+            continue
+        last_id = high_water.get(table, 0)
+        max_id = src.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+        new_high_water[table] = max_id
+        if max_id < last_id:
+            # 数据库被恢复或重建，从头导出
+            last_id = 0
+        if max_id > last_id:
+            days.update(row[0] for row in src.execute(
+                f'SELECT DISTINCT substr({time_column}, 1, 10) FROM {table} WHERE id > ?{_local_filter(src, table)}',
+                (last_id,)
+            ))
+    return days, new_high_water
+
+
+def oldest_day(src, tables=RAW_TABLES):
+    """主库中 tables 里最早的本机数据日期，没有数据时返回 None"""
+    src_tables = _existing_tables(src)
+    days = [
+        src.execute(
+            f'SELECT MIN({APPEND_TABLES[table]}) FROM {table} '
+            f'WHERE {APPEND_TABLES[table]} IS NOT NULL{_local_filter(src, table)}'
+        ).fetchone()[0]
+        for table in tables if table in src_tables
+    ]
+    days = [d[:10] for d in days if d]
+    return min(days) if days else None
+
+
+def oldest_rollup_day(src):
+    """预聚合表和路径变化记录中最早的日期，没有数据时返回 None
+
+    它们的保留期比原始数据长（见 retention.py），原始数据被清理后分片仍保留到它们过期。
+    """
+    days = [oldest_day(src, ("route_changes",))]
+    if "ping_rollups" in _existing_tables(src):
+        # 按天粒度查询可以使用 (granularity, period_start) 索引，小时粒度的时间段不会更早
+        days.append(src.execute(
+            "SELECT MIN(period_start) FROM ping_rollups WHERE granularity = 'day'"
+        ).fetchone()[0])
+    days = [d[:10] for d in days if d]
+    return min(days) if days else None
+
+
+def export_shards(db_file, shard_dir=SHARD_DIR):
+    """把有新数据的日期导出为分片、删除已过期的分片并更新清单，返回更新的分片数"""
+    manifest = load_manifest(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+
+    src = sqlite3.connect(db_file, timeout=30)
+    try:
+        days, high_water = changed_days(src, manifest.get("high_water", {}))
+        shards = {entry["date"]: entry for entry in manifest.get("shards", [])}
+        for day in sorted(days):
+            shards[day] = write_shard(src, shard_dir, day)
+
+        # 主库中已被清理的日期：原始结果过期的分片只保留预聚合表和路径表，全部数据过期的分片删除
+        first_raw_day = oldest_day(src)
+        first_days = [d for d in (first_raw_day, oldest_rollup_day(src)) if d]
+        first_day = min(first_days) if first_days else None
+        for day in sorted(shards):
+            entry = shards[day]
+            if first_day is None or day < first_day:
+                del shards[day]
+                try:
+                    os.remove(os.path.join(shard_dir, entry["file"]))
+                except OSError:
+                    pass
+            elif (first_raw_day is None or day < first_raw_day) and any(
+                    entry["rows"].get(table) for table in RAW_TABLES):
+                shards[day] = strip_raw_rows(shard_dir, entry)
+    finally:
+        src.close()
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "generated_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "high_water": high_water,
+        "shards": [shards[day] for day in sorted(shards)],
+    }
+    write_json_atomic(os.path.join(shard_dir, MANIFEST_FILE), manifest)
+    return len(days)
+
+
+def _now_str():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def export_latest(db_file, ips, path=LATEST_FILE, ping_count=None):
+    """导出每个目标最新一次的测试结果到 latest.json"""
+    conn = sqlite3.connect(db_file, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        columns = "ip, region, timestamp, success, avg_latency, min_latency, max_latency, packet_loss, error"
+        # 每轮探测包数（自适应调度），旧数据库没有这一列
+        if "probe_count" in {row[1] for row in conn.execute('PRAGMA table_info(ping_results)')}:
+            columns += ", probe_count"
+        local = _local_filter(conn, "ping_results")
+        results = []
+        for ip in ips:
+            # 按 ip 索引查找 id 最大的一行，不需要扫描全表；只取本机的结果
+            row = conn.execute(f'''
+                SELECT {columns}
+                FROM ping_results WHERE ip = ?{local} ORDER BY id DESC LIMIT 1
+            ''', (ip,)).fetchone()
+            if row is not None:
+                results.append(dict(row))
+    finally:
+        conn.close()
+    write_json_atomic(path, {
+        "generated_at": _now_str(),
+        "ping_count": ping_count,
+        "results": results,
+    })
+    return len(results)
+
+
+def _window_stats(conn, start, end):
+    """计算与报表页概览相同口径的统计值
+
+    原始数据只保留最近几天，优先使用按小时的预聚合表（上一周期可能已超出原始数据的保留期）。
+    """
+    if "ping_rollups" in _existing_tables(conn):
+        row = conn.execute('''
+            SELECT
+                SUM(latency_sum) / SUM(latency_count),
+                (SUM(test_count) - SUM(success_count)) * 100.0 / SUM(test_count),
+                AVG(CASE WHEN latency_count > 0 THEN (latency_max - latency_min) / (latency_sum / latency_count) END),
+                COALESCE(SUM(test_count), 0)
+            FROM ping_rollups
+            WHERE granularity = 'hour' AND period_start >= ? AND period_start < ?
+        ''', (start[:13] + ":00:00", end[:13] + ":00:00")).fetchone()
+        return {
+            "avg_latency": row[0],
+            "packet_loss": row[1],
+            "stability": row[2],
+            "test_count": row[3],
+        }
+    row = conn.execute(f'''
+        SELECT
+            AVG(avg_latency),
+            AVG(CASE WHEN success = 0 THEN 1 ELSE 0 END) * 100,
+            AVG((max_latency - min_latency) / avg_latency),
+            COUNT(*)
+        FROM ping_results
+        WHERE timestamp >= ? AND timestamp < ? AND avg_latency IS NOT NULL AND avg_latency > 0{_local_filter(conn, "ping_results")}
+    ''', (start, end)).fetchone()
+    return {
+        "avg_latency": row[0],
+        "packet_loss": row[1],
+        "stability": row[2],
+        "test_count": row[3],
+    }
+
+
+def _uptime(conn, start):
+    """按 IP 统计在线率，优先使用按小时的预聚合表"""
+    tables = _existing_tables(conn)
+    if "ping_rollups" in tables:
+        rows = conn.execute('''
+            SELECT ip, SUM(success_count), SUM(test_count) FROM ping_rollups
+            WHERE granularity = 'hour' AND period_start >= ?
+            GROUP BY ip
+        ''', (start[:13] + ":00:00",))
+    else:
+        rows = conn.execute(f'''
+            SELECT ip, SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END), COUNT(*) FROM ping_results
+            WHERE timestamp >= ?{_local_filter(conn, "ping_results")}
+            GROUP BY ip
+        ''', (start,))
+    return [{"ip": ip, "success_count": ok, "total_count": total} for ip, ok, total in rows]
+
+
+def export_targets(targets, path=TARGETS_FILE):
+    """导出网页使用的目标列表，内容没有变化时不重写文件；返回内容哈希"""
+    items = [{"ip": target["ip"], "region": target["region"]} for target in targets]
+    content = json.dumps(items, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    digest = hashlib.sha1(content.encode('utf-8')).hexdigest()[:12]
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            if json.load(f).get("hash") == digest:
+                return digest
+    except (OSError, ValueError, AttributeError):
+        pass
+    write_json_atomic(path, {
+        "version": TARGETS_VERSION,
+        "hash": digest,
+        "generated_at": _now_str(),
+        "targets": items,
+    })
+    return digest
+
+
+def export_summary(db_file, path=SUMMARY_FILE):
+    """导出报表页概览（本周期与上一周期对比）和在线率到 summary.json"""
+    now = datetime.datetime.now()
+    window = datetime.timedelta(days=SUMMARY_WINDOW_DAYS)
+    fmt = "%Y-%m-%d %H:%M:%S"
+    current_start = (now - window).strftime(fmt)
+    previous_start = (now - 2 * window).strftime(fmt)
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        summary = {
+            "generated_at": now.strftime(fmt),
+            "window_days": SUMMARY_WINDOW_DAYS,
+            "current": _window_stats(conn, current_start, "9999"),
+            "previous": _window_stats(conn, previous_start, current_start),
+            "uptime": _uptime(conn, current_start),
+        }
+    finally:
+        conn.close()
+    write_json_atomic(path, summary)
+    return summary
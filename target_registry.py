@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+监控目标注册表
+
+ip_config.json 中的目标加载后按 IP 建立字典索引，按分组和标签建立集合索引，
+查询地区、增删改目标都是 O(1)，不再逐个扫描列表。加载时校验并规范化
+IPv4/IPv6 地址（例如 IPv6 统一为压缩的小写形式），重复或无效的条目会被跳过。
+
+每个目标是一个字典：
+    {"ip": "...", "region": "...", "interval": 秒, "count": 包数, "timeout": 秒,
+     "group": "...", "tags": [...]}
+除 ip 和 region 外都是可选的，未设置时使用程序中的默认值。
+
+常驻进程可以周期性调用 reload_if_changed()，配置文件的修改时间或大小变化后
+自动重新加载，无需重启。本进程保存的修改不会被当作外部变化。
+
+批量导入时先用 diff() 得到与当前目标的差异（新增、修改、删除、无效条目），
+可以只显示差异而不修改，确认后用 apply() 一次性应用并只写一次配置文件。
+"""
+
+import csv
+import io
+import ipaddress
+import json
+import os
+import threading
+import logging
+
+from static_export import write_file_atomic
+
+# 目标的可选数值设置：字段 -> 类型
+NUMERIC_SETTINGS = {"interval": float, "count": int, "timeout": float}
+# 导入导出 CSV 的列，tags 列中多个标签用分号分隔
+CSV_FIELDS = ["ip", "region", "interval", "count", "timeout", "group", "tags"]
+TAG_SEPARATOR = ";"
+
+
+def normalize_ip(text):
+    """校验 IP 地址并返回规范形式，无效时抛出 ValueError"""
+    if not isinstance(text, str):
+        raise ValueError(f"IP 地址必须是字符串: {text!r}")
+    value = text.strip()
+    # 允许 URL 中常见的带方括号的 IPv6 写法，例如 [2001:db8::1]
+    if value.startswith("[") and value.endswith("]"):
+        value = value[1:-1]
+    try:
+        return str(ipaddress.ip_address(value))
+    except ValueError:
+        raise ValueError(f"无效的 IP 地址: {text}")
+
+
+def validate_target(item):
+    """校验单个目标并返回规范化后的新字典，无效时抛出 ValueError"""
+    if not isinstance(item, dict) or "ip" not in item:
+        raise ValueError(f"目标缺少 ip 字段: {item!r}")
+    target = {"ip": normalize_ip(item["ip"]), "region": str(item.get("region") or "未知地区").strip()}
+    for field, kind in NUMERIC_SETTINGS.items():
+        if item.get(field) is None:
+            continue
+        try:
+            value = kind(item[field])
+        except (TypeError, ValueError):
+            raise ValueError(f"IP {target['ip']} 的 {field} 配置无效: {item[field]!r}")
+        if value <= 0:
+            raise ValueError(f"IP {target['ip']} 的 {field} 必须大于0")
+        target[field] = value
+    if item.get("group"):
+        target["group"] = str(item["group"]).strip()
+    tags = item.get("tags")
+    if tags:
+        if isinstance(tags, str):
+            tags = [tags]
+        target["tags"] = sorted({str(tag).strip() for tag in tags if str(tag).strip()})
+    return target
+
+
+def _csv_row_to_item(row):
+    item = {key.strip().lower(): (value or "").strip() for key, value in row.items() if key}
+    item = {key: value for key, value in item.items() if value}
+    if "tags" in item:
+        item["tags"] = [tag for tag in item["tags"].split(TAG_SEPARATOR) if tag.strip()]
+    return item
+
+
+def parse_targets(text, fmt):
+    """解析批量导入的内容，返回目标字典列表（尚未校验）
+
+    fmt 为 "json" 或 "csv"。JSON 可以是目标列表，也可以是 targets.json 那样带
+    targets 字段的对象。CSV 的第一行是列名（见 CSV_FIELDS）；第一行就是 IP 时
+    按 "ip,region" 两列处理。
+    """
+    if fmt == "json":
+        data = json.loads(text)
+        if isinstance(data, dict):
+            data = data.get("targets")
+        if not isinstance(data, list):
+            raise ValueError("JSON 内容必须是目标列表")
+        return data
+    if fmt != "csv":
+        raise ValueError(f"不支持的格式: {fmt}")
+    lines = [line for line in text.splitlines() if line.strip() and not line.lstrip().startswith("#")]
+    if not lines:
+        return []
+    first = next(csv.reader([lines[0]]))
+    try:
+        normalize_ip(first[0])
+        fieldnames = ["ip", "region"]
+    except ValueError:
+        fieldnames = None
+    return [_csv_row_to_item(row) for row in csv.DictReader(lines, fieldnames=fieldnames)]
+
+
+def read_targets_file(path):
+    """按扩展名读取 .json 或 .csv 目标文件"""
+    fmt = "csv" if path.lower().endswith(".csv") else "json"
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        return parse_targets(f.read(), fmt)
+
+
+def format_targets(targets, fmt):
+    """把目标列表格式化为 JSON 或 CSV 文本"""
+    if fmt == "json":
+        return json.dumps(list(targets), ensure_ascii=False, indent=4) + "\n"
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=CSV_FIELDS, lineterminator="\n")
+    writer.writeheader()
+    for target in targets:
+        row = dict(target)
+        if "tags" in row:
+            row["tags"] = TAG_SEPARATOR.join(row["tags"])
+        writer.writerow(row)
+    return buf.getvalue()
+
+
+class TargetRegistry:
+    """带索引的监控目标集合，对应一个 JSON 配置文件"""
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger("ping_monitor")
+        # ip -> 目标，保持配置文件中的顺序
+        self._by_ip = {}
+        # 分组 / 标签 -> IP 集合
+        self._by_group = {}
+        self._by_tag = {}
+        # 上次加载或保存时配置文件的 (修改时间, 大小)
+        self._signature = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._by_ip)
+
+    def __contains__(self, ip):
+        return self.get(ip) is not None
+
+    def __iter__(self):
+        return iter(self.targets())
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _index(self, target):
+        # 已存在的 IP 原地替换，保持其在配置文件中的位置
+        self._by_ip[target["ip"]] = target
+        if "group" in target:
+            self._by_group.setdefault(target["group"], set()).add(target["ip"])
+        for tag in target.get("tags", ()):
+            self._by_tag.setdefault(tag, set()).add(target["ip"])
+
+    def _unindex(self, target, keep_ip=False):
+        if not keep_ip:
+            self._by_ip.pop(target["ip"], None)
+        for index, keys in ((self._by_group, [target.get("group")]), (self._by_tag, target.get("tags", ()))):
+            for key in keys:
+                members = index.get(key)
+                if members is not None:
+                    members.discard(target["ip"])
+                    if not members:
+                        del index[key]
+
+    def replace(self, items):
+        """用一组目标替换注册表内容，返回 (有效目标数, 跳过的条目说明列表)"""
+        # 先在新的注册表中建好索引再整体替换，其他线程不会看到加载到一半的内容
+        staged = TargetRegistry(self.path, self.logger)
+        skipped = []
+        for item in items:
+            try:
+                target = validate_target(item)
+            except ValueError as e:
+                skipped.append(str(e))
+                continue
+            if target["ip"] in staged._by_ip:
+                skipped.append(f"IP {target['ip']} 重复，已忽略后出现的条目")
+                continue
+            staged._index(target)
+        with self._lock:
+            self._by_ip, self._by_group, self._by_tag = staged._by_ip, staged._by_group, staged._by_tag
+        return len(staged._by_ip), skipped
+
+    def load(self):
+        """从配置文件加载目标，文件不存在时抛出 FileNotFoundError"""
+        with self._lock:
+            signature = self._file_signature()
+            with open(self.path, 'r', encoding='utf-8') as f:
+                items = json.load(f)
+            if not isinstance(items, list):
+                raise ValueError(f"{self.path} 的内容必须是目标列表")
+            count, skipped = self.replace(items)
+            self._signature = signature
+        for message in skipped:
+            self.logger.warning(f"{self.path}: {message}")
+        return count
+
+    def reload_if_changed(self):
+        """配置文件在外部被修改后重新加载，返回是否重新加载；加载失败时保留原有目标"""
+        signature = self._file_signature()
+        if signature is None or signature == self._signature:
+            return False
+        try:
+            self.load()
+        except Exception as e:
+            # 文件可能正被编辑器写到一半，下次检查时再试
+            self.logger.error(f"重新加载 {self.path} 失败: {str(e)}")
+            self._signature = signature
+            return False
+        self.logger.info(f"检测到 {self.path} 已修改，重新加载 {len(self)} 个目标")
+        return True
+
+    def save(self):
+        """原子地写回配置文件"""
+        with self._lock:
+            data = json.dumps(list(self._by_ip.values()), ensure_ascii=False, indent=4)
+            write_file_atomic(self.path, data.encode('utf-8'))
+            self._signature = self._file_signature()
+
+    def get(self, ip):
+        """按 IP 查找目标（IP 可以是任意合法写法），不存在时返回 None"""
+        target = self._by_ip.get(ip)
+        if target is None:
+            try:
+                target = self._by_ip.get(normalize_ip(ip))
+            except ValueError:
+                return None
+        return target
+
+    def region(self, ip, default="未知地区"):
+        target = self.get(ip)
+        return target["region"] if target else default
+
+    def setting(self, ip, field, default=None):
+        """目标的单项设置，未设置时返回 default"""
+        target = self.get(ip)
+        if target is None:
+            return default
+        return target.get(field, default)
+
+    def ips(self):
+        return list(self._by_ip)
+
+    def targets(self):
+        return list(self._by_ip.values())
+
+    def groups(self):
+        return sorted(self._by_group)
+
+    def by_group(self, group):
+        """分组内的 IP，保持配置文件中的顺序"""
+        members = self._by_group.get(group, ())
+        return [ip for ip in self._by_ip if ip in members]
+
+    def by_tag(self, tag):
+        members = self._by_tag.get(tag, ())
+        return [ip for ip in self._by_ip if ip in members]
+
+    def add(self, item):
+        """添加目标，IP 已存在时抛出 KeyError，返回规范化后的目标"""
+        target = validate_target(item)
+        with self._lock:
+            if target["ip"] in self._by_ip:
+                raise KeyError(target["ip"])
+            self._index(target)
+        return target
+
+    def update(self, ip, **fields):
+        """修改目标的字段（值为 None 表示删除该可选设置），返回 (修改前, 修改后)"""
+        with self._lock:
+            old = self.get(ip)
+            if old is None:
+                raise KeyError(ip)
+            merged = dict(old)
+            for field, value in fields.items():
+                if value is None:
+                    merged.pop(field, None)
+                else:
+                    merged[field] = value
+            target = validate_target(merged)
+            if target["ip"] != old["ip"]:
+                raise ValueError("不能通过 update 修改目标的 IP")
+            self._unindex(old, keep_ip=True)
+            self._index(target)
+        return old, target
+
+    def diff(self, items, replace=False):
+        """计算导入一组目标后的差异，不修改注册表
+
+        导入条目中出现且不为空的字段覆盖已有目标的同名字段，未出现或为空的字段保持不变。
+        replace 为 True 时，不在导入条目中的已有目标会被删除。返回字典：
+            added: [新目标], updated: [(修改前, 修改后)], removed: [被删除的目标],
+            unchanged: 未变化的目标数, invalid: [无效条目说明], duplicates: 重复条目数
+        """
+        result = {"added": [], "updated": [], "removed": [], "unchanged": 0, "invalid": [], "duplicates": 0}
+        seen = {}
+        for item in items:
+            try:
+                target = validate_target(item)
+            except ValueError as e:
+                result["invalid"].append(str(e))
+                continue
+            ip = target["ip"]
+            if ip in seen:
+                # 同一 IP 出现多次时，后出现的字段覆盖先出现的
+                result["duplicates"] += 1
+            merged = dict(seen.get(ip) or self._by_ip.get(ip) or {})
+            # 空的字段（例如 "region": ""）与未出现的字段相同，不覆盖已有的值
+            merged.update({
+                key: value for key, value in item.items()
+                if key != "ip" and key in target and not (value is None or str(value).strip() == "")
+            })
+            merged["ip"] = ip
+            seen[ip] = validate_target(merged)
+
+        for ip, target in seen.items():
+            old = self._by_ip.get(ip)
+            if old is None:
+                result["added"].append(target)
+            elif old != target:
+                result["updated"].append((old, target))
+            else:
+                result["unchanged"] += 1
+        if replace:
+            result["removed"] = [target for ip, target in self._by_ip.items() if ip not in seen]
+        return result
+
+    def apply(self, diff):
+        """应用 diff() 得到的差异（只修改内存中的注册表，需要再调用 save()）"""
+        with self._lock:
+            for target in diff["removed"]:
+                self._unindex(target)
+            for old, target in diff["updated"]:
+                self._unindex(old, keep_ip=True)
+                self._index(target)
+            for target in diff["added"]:
+                self._index(target)
+
+    def remove(self, ip):
+        """删除目标并返回它，不存在时抛出 KeyError"""
+        with self._lock:
+            target = self.get(ip)
+            if target is None:
+                raise KeyError(ip)
+            self._unindex(target)
+        return target
@@ -4,17 +4,29 @@
 import subprocess
 import os
 import platform
-import re
 import time
 import argparse
 import json
 import logging
-import requests
 import concurrent.futures
 import sqlite3
 import datetime
+import queue
+import threading
 from logging.handlers import RotatingFileHandler
 
+import db_writer
+import geo_cache
+import geo_service
+import ip_range_db
+import retention
+import routes
+import static_export
+import target_registry
+import traceroute_parser
+import traceroute_probe
+import vantage_sync
+
 # --- 配置区 ---
 # IP 配置文件，与 ping_monitor.py 共享
 IP_CONFIG_FILE = "ip_config.json"
@@ -24,22 +36,32 @@ LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
 LOG_LEVEL = logging.INFO
 MAX_LOG_SIZE = 5 * 1024 * 1024  # 5MB
 BACKUP_COUNT = 3
-# IP 地理位置查询 API (限制: 45次/分钟)
-IP_GEOLOCATION_API_URL = "http://ip-api.com/json/{ip}?fields=status,message,country,regionName,city,query"
+# 地理位置查询方式: "api" 使用在线 API，"offline" 使用本地 IP 段数据库（无网络请求、无限速）
+GEO_BACKEND = "api"
+# 离线 IP 段数据库（CSV：起始IP,结束IP,国家,省份,城市），索引缓存在同名 .idx 文件中
+GEO_OFFLINE_DB = "ip_ranges.csv"
+# 是否使用地理位置缓存（缓存时间见 geo_cache.py）
+GEO_CACHE_ENABLED = True
+# Traceroute 引擎: "builtin" 为进程内并行 TTL 引擎（需要原始套接字权限，不可用时自动回退），
+# "subprocess" 为系统 traceroute/tracert 命令
+TRACE_ENGINE = "builtin"
+# 内置引擎的最大跳数和等待回复的时间（秒）
+TRACE_MAX_HOPS = 30
+TRACE_PROBE_TIMEOUT = 2.0
 # 并发执行 Traceroute 的最大线程数
 MAX_WORKERS = 5
 # Traceroute 超时设置 (秒) - 注意：这可能不适用于所有 traceroute 实现
 TRACEROUTE_TIMEOUT = 30
-# IP 地址正则表达式 (IPv4)
-IPV4_REGEX = re.compile(r'\b(?:\d{1,3}\.){3}\d{1,3}\b')
-# 简化版 IPv6 正则表达式 (可能无法覆盖所有边缘情况，但适用于常见格式)
-IPV6_REGEX = re.compile(r'([a-fA-F0-9:]+:+[a-fA-F0-9:]+)') # 匹配包含 '::' 的地址
-# 备用/更复杂的 IPv6 正则式 (如果上面的不够用)
-# IPV6_REGEX = re.compile(r'(([0-9a-fA-F]{1,4}:){7,7}[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,7}:|([0-9a-fA-F]{1,4}:){1,6}:[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,5}(:[0-9a-fA-F]{1,4}){1,2}|([0-9a-fA-F]{1,4}:){1,4}(:[0-9a-fA-F]{1,4}){1,3}|([0-9a-fA-F]{1,4}:){1,3}(:[0-9a-fA-F]{1,4}){1,4}|([0-9a-fA-F]{1,4}:){1,2}(:[0-9a-fA-F]{1,4}){1,5}|[0-9a-fA-F]{1,4}:((:[0-9a-fA-F]{1,4}){1,6})|:((:[0-9a-fA-F]{1,4}){1,7}|:)|fe80:(:[0-9a-fA-F]{0,4}){0,4}%[0-9a-zA-Z]{1,}|::(ffff(:0{1,4}){0,1}:){0,1}((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])|([0-9a-fA-F]{1,4}:){1,4}:((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9]))')
+# 系统 traceroute 每跳的探测次数（-q），多次探测时解析结果中保留每次的回复地址和往返时间
+TRACEROUTE_PROBES_PER_HOP = 1
 # 数据库文件路径 (与 ping_monitor.py 共享)
 DB_FILE = "ping_data.db"
-# 数据保留天数
-DATA_RETENTION_DAYS = 30
+# 本机的采集点编号（与 ping_monitor 共用数据库中保存的编号），初始化数据库表时读取
+VANTAGE_ID = None
+# 原始 Traceroute 结果的保留天数
+DATA_RETENTION_DAYS = retention.RAW_RETENTION_DAYS
+# 路径变化记录的保留天数
+ROLLUP_RETENTION_DAYS = retention.ROLLUP_RETENTION_DAYS
 
 # --- 日志配置 ---
 def setup_logger():
@@ -77,6 +99,10 @@ logger = setup_logger()
 
 # --- 全局变量 ---
 TARGET_IPS = [] # 将从配置文件加载
+_geo_cache = None # 地理位置缓存，首次查询时创建
+_range_db = None # 离线 IP 段数据库，首次查询时加载
+_geo_service = None # 共享的地理位置查询服务，首次查询时创建
+_geo_service_lock = threading.Lock()
 
 # --- 函数定义 ---
 
@@ -89,10 +115,10 @@ def load_ip_config():
     global TARGET_IPS
     if os.path.exists(IP_CONFIG_FILE):
         try:
-            with open(IP_CONFIG_FILE, 'r', encoding='utf-8') as f:
-                ips_data = json.load(f)
-            # 提取 IP 地址
-            TARGET_IPS = [item["ip"] for item in ips_data]
+            # 与 ping_monitor 共用同一套校验和规范化规则
+            registry = target_registry.TargetRegistry(IP_CONFIG_FILE, logger)
+            registry.load()
+            TARGET_IPS = registry.ips()
             logger.info(f"成功从 {IP_CONFIG_FILE} 加载 {len(TARGET_IPS)} 个目标 IP")
             return True
         except Exception as e:
@@ -102,8 +128,8 @@ def load_ip_config():
         logger.warning(f"IP配置文件 {IP_CONFIG_FILE} 未找到，无目标 IP 可追踪。")
         return False
 
-def get_ip_geolocation(ip):
-    """查询IP地址的地理位置信息"""
+def private_ip_location(ip):
+    """私有地址和回环地址的固定位置，其他地址返回 None"""
     # 跳过私有IP地址和回环地址
     if ip.startswith(('10.', '172.', '192.168.', '127.')):
          # 粗略判断，未覆盖所有私有地址范围
@@ -117,122 +143,117 @@ def get_ip_geolocation(ip):
              return {"status": "success", "country": "Private", "regionName": "RFC1918", "city": "Local Network", "query": ip}
         elif ip.startswith('127.'):
              return {"status": "success", "country": "Local", "regionName": "Loopback", "city": "localhost", "query": ip}
+    return None
+
+def submit_geolocation(ip):
+    """提交地理位置查询，返回得到结果字典的 Future"""
+    result = private_ip_location(ip)
+    if result is None and GEO_BACKEND == "offline":
+        result = lookup_offline_geolocation(ip)
+    if result is not None:
+        future = concurrent.futures.Future()
+        future.set_result(result)
+        return future
+    # 在线查询统一交给共享服务：合并重复 IP、批量请求并按配额限速
+    return get_geo_service().submit(ip)
 
-
-    api_url = IP_GEOLOCATION_API_URL.format(ip=ip)
+def get_ip_geolocation(ip):
+    """查询IP地址的地理位置信息"""
+    return submit_geolocation(ip).result()
+
+def close_geolocation():
+    """停止地理位置查询服务、关闭缓存并等待缓存写入完成"""
+    global _geo_service, _geo_cache
+    if _geo_service is not None:
+        _geo_service.close()
+        _geo_service.log_stats()
+        _geo_service = None
+    if _geo_cache is not None:
+        _geo_cache.log_stats()
+        _geo_cache.close()
+        _geo_cache = None
+    db_writer.close_writer(DB_FILE)
+
+def get_geo_cache():
+    """获取共享的地理位置缓存，禁用时返回 None"""
+    global _geo_cache
+    if GEO_CACHE_ENABLED and _geo_cache is None:
+        _geo_cache = geo_cache.GeoCache(DB_FILE)
+    return _geo_cache
+
+def get_geo_service():
+    """获取进程内共享的地理位置查询服务"""
+    global _geo_service
+    with _geo_service_lock:
+        if _geo_service is None:
+            _geo_service = geo_service.GeoLookupService(cache=get_geo_cache())
+        return _geo_service
+
+def get_range_db():
+    """获取离线 IP 段数据库（首次调用时加载或构建索引）"""
+    global _range_db
+    if _range_db is None:
+        _range_db = ip_range_db.open_range_db(GEO_OFFLINE_DB)
+    return _range_db
+
+def lookup_offline_geolocation(ip):
+    """在本地 IP 段数据库中查询地理位置"""
     try:
-        # 设置超时
-        response = requests.get(api_url, timeout=5)
-        response.raise_for_status() # 如果状态码不是 2xx，则抛出异常
-        data = response.json()
-        
-        if data.get("status") == "success":
-            # 简化地名，去除 "Province" 或 "Region" 等词语
-            region = data.get('regionName', '').replace(' Province', '').replace(' Region', '')
-            city = data.get('city', '')
-            country = data.get('country', '')
-            
-            location_parts = [part for part in [country, region, city] if part]
-            location_str = " - ".join(location_parts) if location_parts else "未知地点"
-            
-            return {"status": "success", "location": location_str, "query": data.get("query")}
-        else:
-            logger.warning(f"IP {ip} 地理位置查询失败: {data.get('message', '未知错误')}")
-            return {"status": "fail", "message": data.get("message"), "query": ip, "location": "查询失败"}
-            
-    except requests.exceptions.Timeout:
-        logger.warning(f"IP {ip} 地理位置查询超时")
-        return {"status": "fail", "message": "查询超时", "query": ip, "location": "查询超时"}
-    except requests.exceptions.RequestException as e:
-        logger.error(f"IP {ip} 地理位置查询请求错误: {str(e)}")
+        location = get_range_db().lookup(ip)
+    except Exception as e:
+        logger.error(f"IP {ip} 离线地理位置查询失败: {str(e)}")
         return {"status": "fail", "message": str(e), "query": ip, "location": "查询错误"}
-    except json.JSONDecodeError:
-        logger.error(f"无法解析 IP {ip} 地理位置查询的响应: {response.text}")
-        return {"status": "fail", "message": "响应解析失败", "query": ip, "location": "解析失败"}
+    if location is None:
+        return {"status": "fail", "message": "不在离线数据库中", "query": ip, "location": "未知地点"}
+    return {"status": "success", "location": location, "query": ip}
+
+def iter_traceroute_hops(lines, os_type):
+    """逐行解析traceroute/tracert的输出，每完成一跳就产出该跳 (支持 IPv4 和 IPv6)
+
+    lines 可以是任意行迭代器（例如仍在运行的进程的输出）；一跳在下一跳开始或输出结束时产出，
+    调用方可以在整个命令结束前就开始处理已发现的跳。解析规则见 traceroute_parser。
+    """
+    return traceroute_parser.iter_hops(lines, os_type)
 
 def parse_traceroute_output(output, os_type):
-    """解析traceroute/tracert命令的输出，提取IP地址 (支持 IPv4 和 IPv6)"""
-    hops = []
-    lines = output.strip().splitlines()
-    
-    # 跳过标题行
-    start_line = 0
-    if os_type == "windows":
-        # Windows tracert 通常有几行标题
-        for i, line in enumerate(lines):
-            if re.match(r'\s*\d+\s+', line): # 找到第一个以数字开头的行（跳数）
-                start_line = i
-                break
-    elif os_type == "linux":
-        # Linux traceroute 通常第一行是标题
-        if lines and "traceroute to" in lines[0]:
-            start_line = 1
-            
-    current_hop_num = 0
-    processed_ips_in_hop = set() # 防止同一跳处理多次相同的IP
-
-    for line in lines[start_line:]:
-        line = line.strip()
-        if not line:
-            continue
-
-        hop_num_match = re.match(r'^\s*(\d+)', line)
-        if hop_num_match:
-            current_hop_num = int(hop_num_match.group(1))
-            processed_ips_in_hop = set() # 新的一跳，重置已处理IP集合
-
-        # 查找行中的所有 IPv4 和 IPv6 地址
-        # 优先查找 IPv6
-        ips_found = IPV6_REGEX.findall(line)
-        if not ips_found:
-            # 如果没找到 IPv6，再查找 IPv4
-            ips_found = IPV4_REGEX.findall(line)
-
-        if "*" in line and not ips_found:
-            # 超时或请求无法到达
-            if current_hop_num > 0 and not any(h['hop'] == current_hop_num for h in hops):
-                hops.append({"hop": current_hop_num, "ip": "*", "location": "请求超时"})
-            continue
-
-        # 通常一行只关心一个IP，取找到的最后一个作为代表
-        ip_to_process = ips_found[-1] if ips_found else None
-
-        if ip_to_process:
-             # 确保这个 IP 属于当前跳且未被处理过
-            if current_hop_num > 0 and ip_to_process not in processed_ips_in_hop:
-                 # 检查是否已经为这一跳添加了条目，如果是，更新IP（有时一行会有多个IP，通常取最后一个）
-                 existing_hop_index = next((i for i, h in enumerate(hops) if h['hop'] == current_hop_num), -1)
-                 if existing_hop_index != -1:
-                     # 如果现有条目是超时 "*", 则替换它
-                     if hops[existing_hop_index]["ip"] == "*":
-                         hops[existing_hop_index]["ip"] = ip_to_process
-                     # 否则，可能一行解析出多个IP，我们可能需要更复杂的逻辑，暂时只记录第一个有效IP
-                     # 或者根据操作系统行为判断，通常windows tracert一行一个IP，linux可能一个IP或域名+IP
-                 else:
-                    hops.append({"hop": current_hop_num, "ip": ip_to_process, "location": "查询中..."})
-                 processed_ips_in_hop.add(ip_to_process) # 标记为已处理
-
-
-    # 过滤掉没有有效IP的初始条目（例如标题行误匹配）
-    hops = [h for h in hops if h['hop'] > 0]
-    
-    # 去重（可能由于解析逻辑不完美导致重复跳数和IP）
-    unique_hops = []
-    seen_hops = set()
-    for hop in hops:
-        hop_tuple = (hop['hop'], hop['ip'])
-        if hop_tuple not in seen_hops:
-            unique_hops.append(hop)
-            seen_hops.add(hop_tuple)
+    """解析traceroute/tracert命令的完整输出，提取IP地址和各次探测的往返时间 (支持 IPv4 和 IPv6)"""
+    return traceroute_parser.parse(output, os_type)
 
-    return unique_hops
+def _pump_lines(stream, line_queue):
+    """读取线程：把进程输出逐行放入队列，结束时放入 None"""
+    try:
+        for line in stream:
+            line_queue.put(line)
+    except (OSError, ValueError):
+        # 进程被终止后管道可能已关闭
+        pass
+    finally:
+        line_queue.put(None)
+
+def _read_lines_until(line_queue, deadline, state):
+    """从队列中逐行取出输出，到达截止时间时停止并在 state 中标记超时"""
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            state["timed_out"] = True
+            return
+        try:
+            line = line_queue.get(timeout=remaining)
+        except queue.Empty:
+            state["timed_out"] = True
+            return
+        if line is None:
+            return
+        state["lines"] += 1
+        yield line
 
 # --- 数据库相关函数 ---
 
 def init_traceroute_database():
     """初始化 Traceroute 结果的数据库表"""
+    global VANTAGE_ID
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = db_writer.configure_connection(sqlite3.connect(DB_FILE))
         cursor = conn.cursor()
         
         # 创建 traceroute 结果表
@@ -250,6 +271,18 @@ def init_traceroute_database():
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_traceroute_target_ip ON traceroute_results (target_ip)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_traceroute_timestamp ON traceroute_results (timestamp)')
         
+        # 创建按内容寻址的路径表和路径变化表
+        routes.init_route_tables(conn)
+        
+        # 数据保留使用的整数时间戳列
+        retention.init_epoch_column(conn, "traceroute_results")
+        
+        # 采集点编号和合并去重用的列
+        VANTAGE_ID = vantage_sync.init_sync_schema(conn, "traceroute_results")
+        
+        # 创建地理位置缓存表
+        geo_cache.init_geo_cache_table(conn)
+        
         conn.commit()
         conn.close()
         logger.info("Traceroute 数据库表初始化成功")
@@ -258,57 +291,83 @@ def init_traceroute_database():
         logger.error(f"Traceroute 数据库表初始化失败: {str(e)}")
         return False
 
-def save_traceroute_to_db(result):
-    """将 Traceroute 结果保存到数据库"""
+# traceroute_results 插入语句
+TRACEROUTE_INSERT_SQL = '''
+INSERT INTO traceroute_results (target_ip, timestamp, hops_json, error, route_id, hop_rtts, hop_probes, vantage_id, epoch)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def traceroute_result_to_row(result, timestamp, route_ref=(None, None, None)):
+    """将 Traceroute 结果转换为 traceroute_results 表的一行
+
+    有 route_id 时跳列表保存在 routes 表中，本行不再重复保存 hops_json。
+    """
+    route_id, hop_rtts, hop_probes = route_ref
+    hops = result.get('hops')
+    # 没有路径引用时（例如旧代码写入的方式），将 hops 列表转换为 JSON 字符串
+    hops_json = json.dumps(hops, ensure_ascii=False) if hops and route_id is None else None
+    return (result['target'], timestamp, hops_json, result.get('error'), route_id, hop_rtts, hop_probes, VANTAGE_ID,
+            retention.epoch_seconds(timestamp))
+
+def save_traceroute_results_to_db(results):
+    """将本次运行的所有 Traceroute 结果、新路径和路径变化在一个事务中写入数据库"""
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        target_ip = result['target']
-        hops = result.get('hops')
-        error = result.get('error')
-        
-        # 将 hops 列表转换为 JSON 字符串
-        hops_json = json.dumps(hops, ensure_ascii=False) if hops else None
-        
-        cursor.execute('''
-        INSERT INTO traceroute_results (target_ip, timestamp, hops_json, error)
-        VALUES (?, ?, ?, ?)
-        ''', (target_ip, timestamp, hops_json, error))
-        
-        conn.commit()
-        conn.close()
-        logger.debug(f"成功保存 {target_ip} 的 Traceroute 结果到数据库")
+        conn = sqlite3.connect(DB_FILE, timeout=db_writer.BUSY_TIMEOUT)
+        try:
+            previous = routes.latest_routes(conn, {r['target'] for r in results})
+        finally:
+            conn.close()
+
+        refs, route_stmts = routes.route_statements(
+            [(r['target'], r.get('hops'), r.get('error')) for r in results], timestamp, previous
+        )
+        rows = [traceroute_result_to_row(r, timestamp, ref) for r, ref in zip(results, refs)]
+        count = db_writer.get_writer(DB_FILE).write_group([(TRACEROUTE_INSERT_SQL, rows)] + route_stmts)
+
+        _route_sql, change_rows = route_stmts[1]
+        for target_ip, _timestamp, old_route_id, new_route_id in change_rows:
+            if old_route_id is not None:
+                logger.info(f"到 {target_ip} 的路由发生变化: {old_route_id} -> {new_route_id}")
+        logger.debug(f"成功保存 {len(rows)} 条 Traceroute 结果到数据库（含路径表共写入 {count} 行）")
         return True
     except Exception as e:
-        logger.error(f"保存 Traceroute 结果到数据库失败 ({target_ip}): {str(e)}")
+        logger.error(f"保存 Traceroute 结果到数据库失败: {str(e)}")
         return False
 
+def save_traceroute_to_db(result):
+    """将单条 Traceroute 结果保存到数据库"""
+    return save_traceroute_results_to_db([result])
+
 def cleanup_old_traceroute_data(days=DATA_RETENTION_DAYS):
-    """清理指定天数前的 Traceroute 数据"""
+    """清理指定天数前的 Traceroute 数据、ROLLUP_RETENTION_DAYS 天前的路径变化记录和过期的地理位置缓存
+
+    按 epoch 索引分块删除并增量回收空闲页（见 retention.py），不再整库 VACUUM。
+    """
     if days <= 0:
         logger.info("数据清理天数设置为0或负数，跳过清理。")
         return True
         
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # 计算截止日期
-        cutoff_date = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
-        
-        # 删除旧数据
-        cursor.execute("DELETE FROM traceroute_results WHERE timestamp < ?", (cutoff_date,))
-        deleted_count = cursor.rowcount
-        
-        conn.commit()
+        deleted, freed_pages = retention.purge_expired(
+            DB_FILE, ("traceroute_results", "route_changes"), days, ROLLUP_RETENTION_DAYS
+        )
+        deleted_count = deleted.get("traceroute_results", 0)
         
-        # 执行 VACUUM 优化数据库文件大小 (可选，但推荐)
-        logger.info(f"开始优化数据库文件...")
-        conn.execute("VACUUM")
-        conn.close()
+        # 删除过期的地理位置缓存
+        conn = sqlite3.connect(DB_FILE, timeout=db_writer.BUSY_TIMEOUT)
+        try:
+            expired_geo = geo_cache.purge_expired(conn)
+            conn.commit()
+        finally:
+            conn.close()
+        if expired_geo > 0:
+            logger.info(f"清理 {expired_geo} 条过期的地理位置缓存")
         
+        if deleted.get("route_changes"):
+            logger.info(f"清理 {deleted['route_changes']} 条 {ROLLUP_RETENTION_DAYS} 天前的路径变化记录")
+        if freed_pages:
+            logger.info(f"回收了 {freed_pages} 个空闲页")
         if deleted_count > 0:
             logger.info(f"成功清理 {deleted_count} 条 {days} 天前的 Traceroute 数据")
         else:
@@ -320,6 +379,51 @@ def cleanup_old_traceroute_data(days=DATA_RETENTION_DAYS):
 
 # --- 主要逻辑函数 ---
 
+def submit_hop_locations(hops, future_to_hops):
+    """为各跳提交地理位置查询，结果 Future -> 对应的跳 记录在 future_to_hops 中"""
+    for hop in hops:
+        if hop["ip"] != "*":
+            # 所有 traceroute 共用一个查询服务，由它负责合并、批量和限速；
+            # 同一 IP 的查询会得到同一个 Future，因此按 Future 记录对应的所有跳
+            future_to_hops.setdefault(submit_geolocation(hop["ip"]), []).append(hop)
+
+def wait_hop_locations(future_to_hops):
+    """等待地理位置查询完成，并把结果写入各跳的 location"""
+    for future in concurrent.futures.as_completed(future_to_hops):
+        for hop_entry in future_to_hops[future]:
+            try:
+                geo_result = future.result()
+                if geo_result and geo_result["status"] == "success":
+                    hop_entry["location"] = geo_result.get("location", "未知地点")
+                else:
+                     # 保留原始的"查询失败"或"超时"等信息
+                     hop_entry["location"] = geo_result.get("location", "查询出错")
+                     hop_entry["location_failed"] = True
+            except Exception as exc:
+                logger.error(f'查询IP {hop_entry["ip"]} 地理位置时产生异常: {exc}')
+                hop_entry["location"] = "查询异常" # 更新地理位置为错误信息
+                hop_entry["location_failed"] = True
+
+def trace_routes_builtin(target_ips):
+    """使用进程内引擎并行追踪所有目标，返回 (结果列表, 需要改用系统命令的目标列表)"""
+    try:
+        traced, unsupported = traceroute_probe.trace_targets(
+            target_ips, max_hops=TRACE_MAX_HOPS, timeout=TRACE_PROBE_TIMEOUT
+        )
+    except traceroute_probe.ICMPUnavailable as e:
+        logger.warning(f"无法使用内置 traceroute 引擎，改用系统命令: {str(e)}")
+        return [], list(target_ips)
+
+    results = []
+    future_to_hops = {}
+    for target_ip, hops in traced.items():
+        submit_hop_locations(hops, future_to_hops)
+        results.append({"target": target_ip, "hops": hops, "error": None if hops else "没有收到任何回复"})
+    wait_hop_locations(future_to_hops)
+    for result in results:
+        logger.info(f"完成追踪到 {result['target']} 的路由，共 {len(result['hops'])} 跳。")
+    return results, unsupported
+
 def trace_route(target_ip):
     """执行traceroute/tracert命令并解析结果 (支持 IPv6)"""
     logger.info(f"开始追踪到 {target_ip} 的路由...")
@@ -335,7 +439,7 @@ def trace_route(target_ip):
         command.append(target_ip)
     elif os_type == "linux" or os_type == "darwin": # darwin is MacOS
         # Linux/Mac 使用 traceroute
-        command = ["traceroute", "-n", "-w", "2", "-q", "1"]
+        command = ["traceroute", "-n", "-w", "2", "-q", str(TRACEROUTE_PROBES_PER_HOP)]
         if use_ipv6:
             command.append("-6")
         command.append(target_ip)
@@ -348,79 +452,65 @@ def trace_route(target_ip):
         command.append(target_ip)
 
     try:
-        # 使用 Popen 以便更好地处理可能的长时运行和输出流
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='ignore')
-        
-        try:
-            # 设置超时等待进程结束
-            stdout, stderr = process.communicate(timeout=TRACEROUTE_TIMEOUT)
-        except subprocess.TimeoutExpired:
+        # 使用 Popen 逐行读取输出，每解析出一跳就开始查询它的地理位置
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='ignore', bufsize=1)
+        line_queue = queue.Queue()
+        stderr_lines = []
+        threading.Thread(target=_pump_lines, args=(process.stdout, line_queue), daemon=True).start()
+        stderr_thread = threading.Thread(target=lambda: stderr_lines.extend(process.stderr), daemon=True)
+        stderr_thread.start()
+
+        parse_os = os_type if os_type in ("windows", "darwin") else "linux"
+        state = {"timed_out": False, "lines": 0}
+        deadline = time.monotonic() + TRACEROUTE_TIMEOUT
+        future_to_hops = {}
+
+        def add_hops(hop_iter):
+            for hop in hop_iter:
+                hops.append(hop)
+                submit_hop_locations([hop], future_to_hops)
+
+        add_hops(iter_traceroute_hops(_read_lines_until(line_queue, deadline, state), parse_os))
+
+        error = None
+        if state["timed_out"]:
+            # 超时后终止进程，但保留已经发现的跳
             process.kill()
-            stdout, stderr = process.communicate()
-            logger.warning(f"Traceroute 到 {target_ip} 超时 ({TRACEROUTE_TIMEOUT} 秒)")
-            return {"target": target_ip, "hops": [], "error": "Traceroute 执行超时"}
+            logger.warning(f"Traceroute 到 {target_ip} 超时 ({TRACEROUTE_TIMEOUT} 秒)，保留已发现的 {len(hops)} 跳")
+            error = "Traceroute 执行超时"
+        process.wait()
+        stderr_thread.join(timeout=1)
+        stderr = "".join(stderr_lines)
 
-        if process.returncode != 0 and stderr:
+        if not state["timed_out"] and process.returncode != 0 and stderr:
             # 有些 traceroute 实现（如 MTR 伪装的）会将正常输出打印到 stderr
             # 我们主要关心是否有输出可以解析
-            if not stdout and stderr:
+            if not state["lines"]:
                  logger.warning(f"Traceroute 到 {target_ip} 命令执行可能有误 (返回码 {process.returncode}), 但 stderr 包含输出，尝试解析 stderr:\n{stderr}")
-                 output = stderr
-            elif stderr:
-                 logger.warning(f"Traceroute 到 {target_ip} 命令执行可能有误 (返回码 {process.returncode})，stderr:\n{stderr}")
-                 output = stdout # 仍然尝试解析 stdout
+                 add_hops(iter_traceroute_hops(stderr.strip().splitlines(), parse_os))
             else:
-                 logger.error(f"Traceroute 到 {target_ip} 命令执行失败，返回码: {process.returncode}")
-                 return {"target": target_ip, "hops": [], "error": f"Traceroute 命令执行失败 (code: {process.returncode})"}
-        else:
-             output = stdout
+                 logger.warning(f"Traceroute 到 {target_ip} 命令执行可能有误 (返回码 {process.returncode})，stderr:\n{stderr}")
 
-        if not output:
+        if not state["timed_out"] and not state["lines"] and not stderr:
              logger.warning(f"Traceroute 到 {target_ip} 没有输出。")
              return {"target": target_ip, "hops": [], "error": "Traceroute 没有输出"}
 
-        # 解析输出
-        hops = parse_traceroute_output(output, "windows" if os_type == "windows" else "linux")
-        
-        # 查询每个 hop IP 的地理位置
-        # 使用线程池加速查询，但注意 API 限速
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            future_to_hop = {executor.submit(get_ip_geolocation, hop["ip"]): hop for hop in hops if hop["ip"] != "*"}
-            
-            for future in concurrent.futures.as_completed(future_to_hop):
-                hop_entry = future_to_hop[future]
-                try:
-                    geo_result = future.result()
-                    if geo_result and geo_result["status"] == "success":
-                        hop_entry["location"] = geo_result.get("location", "未知地点")
-                    else:
-                         # 保留原始的"查询失败"或"超时"等信息
-                         hop_entry["location"] = geo_result.get("location", "查询出错")
-                except Exception as exc:
-                    logger.error(f'查询IP {hop_entry["ip"]} 地理位置时产生异常: {exc}')
-                    hop_entry["location"] = "查询异常" # 更新地理位置为错误信息
+        # 等待各跳的地理位置查询完成（大部分在追踪过程中已经完成）
+        wait_hop_locations(future_to_hops)
 
         logger.info(f"完成追踪到 {target_ip} 的路由，共 {len(hops)} 跳。")
-        # 构建成功结果字典
-        result_data = {"target": target_ip, "hops": hops, "error": None}
-        
-        # 保存到数据库
-        save_traceroute_to_db(result_data)
-        
-        return result_data # 返回结果供打印
+        # 构建结果字典（由 main 在本轮结束后统一写入数据库），超时时 hops 为已发现的部分路径
+        return {"target": target_ip, "hops": hops, "error": error}
 
     except FileNotFoundError:
         error_msg = "traceroute/tracert 命令未找到"
         logger.error(f"找不到 traceroute/tracert 命令。请确保它已安装并在系统 PATH 中。")
-        result_data = {"target": target_ip, "hops": [], "error": error_msg}
-        save_traceroute_to_db(result_data) # 保存错误信息到数据库
-        return result_data
+        # 错误信息同样会由 main 写入数据库
+        return {"target": target_ip, "hops": [], "error": error_msg}
     except Exception as e:
         error_msg = f"意外错误: {str(e)}"
         logger.error(f"执行 traceroute 到 {target_ip} 时发生意外错误: {str(e)}")
-        result_data = {"target": target_ip, "hops": [], "error": error_msg}
-        save_traceroute_to_db(result_data) # 保存错误信息到数据库
-        return result_data
+        return {"target": target_ip, "hops": [], "error": error_msg}
 
 def print_results(results):
     """格式化并打印 Traceroute 结果"""
@@ -435,9 +525,11 @@ def print_results(results):
 
         if error:
             print(f"错误: {error}")
+            if hops:
+                print("以下为出错前已发现的节点:")
         elif not hops:
             print("未能获取到路由信息。")
-        else:
+        if hops:
             print(f"{'跳数':<5} {'IP 地址':<45} {'地区':<40}")
             print("-" * 60)
             for hop in hops:
@@ -451,11 +543,28 @@ def print_results(results):
 
 def main():
     """主函数"""
+    global GEO_BACKEND, GEO_OFFLINE_DB
     parser = argparse.ArgumentParser(description='Traceroute 监控工具，记录到目标IP的路由路径及地区信息，并将结果存入数据库。')
     parser.add_argument('--target', type=str, help='指定要追踪的单个目标 IP 地址。如果指定，将忽略配置文件。')
     parser.add_argument('--cleanup-days', type=int, default=DATA_RETENTION_DAYS, help=f'清理多少天前的旧数据 (默认: {DATA_RETENTION_DAYS} 天), 设置为 0 则不清理')
+    parser.add_argument('--engine', choices=['builtin', 'subprocess'], default=TRACE_ENGINE,
+                        help=f'traceroute 引擎: builtin 为进程内并行引擎，subprocess 为系统命令 (默认: {TRACE_ENGINE})')
+    parser.add_argument('--geo-backend', choices=['api', 'offline'], default=GEO_BACKEND,
+                        help=f'地理位置查询方式: api 为在线 API，offline 为本地 IP 段数据库 (默认: {GEO_BACKEND})')
+    parser.add_argument('--geo-db', type=str, default=GEO_OFFLINE_DB,
+                        help=f'离线 IP 段数据库 CSV 文件 (默认: {GEO_OFFLINE_DB})')
     
     args = parser.parse_args()
+    GEO_BACKEND = args.geo_backend
+    GEO_OFFLINE_DB = args.geo_db
+    
+    if GEO_BACKEND == "offline":
+        # 在开始追踪前加载索引，数据库缺失时尽早退出
+        try:
+            get_range_db()
+        except Exception as e:
+            logger.error(f"无法加载离线地理位置数据库 {GEO_OFFLINE_DB}: {str(e)}")
+            return
 
     # 初始化数据库表
     if not init_traceroute_database():
@@ -486,23 +595,39 @@ def main():
     logger.info(f"将对以下 {len(ips_to_trace)} 个 IP 执行 Traceroute: {', '.join(ips_to_trace)}")
     
     all_results = []
+    remaining_ips = list(ips_to_trace)
+    if args.engine == "builtin":
+        # 所有目标的所有 TTL 一次性并行探测，无法使用原始套接字的目标改用系统命令
+        all_results, remaining_ips = trace_routes_builtin(ips_to_trace)
+
     # 使用线程池并行执行 traceroute
-    with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(ips_to_trace))) as executor:
-        future_to_ip = {executor.submit(trace_route, ip): ip for ip in ips_to_trace}
+    if remaining_ips:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(remaining_ips))) as executor:
+            future_to_ip = {executor.submit(trace_route, ip): ip for ip in remaining_ips}
         
-        for future in concurrent.futures.as_completed(future_to_ip):
-            ip = future_to_ip[future]
-            try:
-                result = future.result()
-                all_results.append(result)
-            except Exception as exc:
-                logger.error(f'Traceroute 任务针对 IP {ip} 产生异常: {exc}')
-                all_results.append({"target": ip, "hops": [], "error": f"任务执行异常: {exc}"})
+            for future in concurrent.futures.as_completed(future_to_ip):
+                ip = future_to_ip[future]
+                try:
+                    result = future.result()
+                    all_results.append(result)
+                except Exception as exc:
+                    logger.error(f'Traceroute 任务针对 IP {ip} 产生异常: {exc}')
+                    all_results.append({"target": ip, "hops": [], "error": f"任务执行异常: {exc}"})
 
     # 对结果按原始 IP 列表顺序排序（如果需要）
     # all_results.sort(key=lambda r: ips_to_trace.index(r['target']))
 
-    # 打印结果 (注意：保存数据库的操作已经在 trace_route 函数内部完成)
+    # 所有结果在一个事务中写入数据库
+    save_traceroute_results_to_db(all_results)
+    close_geolocation()
+
+    # 更新网页使用的数据分片
+    try:
+        static_export.export_shards(DB_FILE, static_export.SHARD_DIR)
+    except Exception as e:
+        logger.error(f"导出数据分片失败: {str(e)}")
+
+    # 打印结果
     print_results(all_results)
     
     logger.info("所有 Traceroute 任务完成。")
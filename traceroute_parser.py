@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+系统 traceroute / tracert 命令输出的解析
+
+所有平台共用一个按空白切分的词法：每行切分为词后逐词归类为跳数（行首的整数）、
+往返时间（数值后跟 "ms" / "毫秒"，或 "<1"）、超时 "*"、地址（可带括号或方括号）
+和其他文本（主机名、不可达标记 "!H"、采集时间等，忽略）。切分和归类只用字符串
+方法，不需要对每行运行正则；地址按完整语法校验，校验结果缓存（同一批路由器的地址
+在各次输出中反复出现）。
+
+平台之间只有两点不同：
+- linux:   traceroute -n [-q N]，地址写在它的往返时间之前；同一跳不同探测的回复地址
+           不同时写在同一行
+- darwin:  与 linux 相同，但回复地址改变时另起一行（行首是空白而不是跳数），续行并入所属的跳
+- windows: tracert -d，地址在行末，对本行所有探测有效；"<1 ms" 和中文 "毫秒" 均可识别
+
+地址按完整的 IPv4（每段 0~255）和 IPv6 语法严格匹配，"12:34" 这样的时间不会被当成
+地址。各跳保存在以跳数为键的表中，同一跳分在多行时直接合并。
+
+解析结果与内置引擎（traceroute_probe）的跳列表格式相同，另外在 "probes" 中
+按顺序保留每次探测的 (回复地址, 往返时间)，没有回复时两者都为 None。跳的 "rtt"
+取代表地址（第一个回复的地址）各次探测中最小的往返时间。
+"""
+
+import re
+
+_OCTET = r'(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)'
+_IPV4 = rf'{_OCTET}(?:\.{_OCTET}){{3}}'
+_H = r'[0-9A-Fa-f]{1,4}'
+_IPV6 = (
+    rf'(?:(?:{_H}:){{7}}{_H}'
+    rf'|(?:{_H}:){{1,7}}:'
+    rf'|(?:{_H}:){{1,6}}:{_H}'
+    rf'|(?:{_H}:){{1,5}}(?::{_H}){{1,2}}'
+    rf'|(?:{_H}:){{1,4}}(?::{_H}){{1,3}}'
+    rf'|(?:{_H}:){{1,3}}(?::{_H}){{1,4}}'
+    rf'|(?:{_H}:){{1,2}}(?::{_H}){{1,5}}'
+    rf'|{_H}:(?::{_H}){{1,6}}'
+    rf'|:(?:(?::{_H}){{1,7}}|:)'
+    rf'|(?:{_H}:){{6}}{_IPV4}'
+    rf'|(?:{_H}:){{1,5}}:{_IPV4}'
+    rf'|::(?:{_H}:){{0,5}}{_IPV4})'
+    r'(?:%\w+)?'
+)
+# 完整的地址（用 fullmatch 校验）
+IPV4_ADDRESS = re.compile(_IPV4)
+IPV6_ADDRESS = re.compile(_IPV6)
+# 地址校验结果的缓存条目数，足够容纳一轮追踪（约 1000 个目标 × 16 跳）的所有路由器地址
+ADDRESS_CACHE_SIZE = 16384
+
+# tracert 把不足 1 毫秒的往返时间显示为 "<1 ms"，按 0.5 毫秒记录
+WINDOWS_SUB_MS_RTT = 0.5
+# 没有回复的探测
+LOST = (None, None)
+
+# 平台名 -> (地址是否写在行末, 是否有续行)
+PLATFORMS = {
+    "linux": (False, False),
+    "darwin": (False, True),
+    "windows": (True, False),
+}
+# 其他写法的平台名
+PLATFORM_ALIASES = {"macos": "darwin", "mac": "darwin"}
+
+
+# 地址校验结果的缓存：词 -> 地址或 None，超过 ADDRESS_CACHE_SIZE 条时清空
+_address_cache = {}
+
+
+def parse_address(token):
+    """token 是合法的 IPv4/IPv6 地址时返回它本身，否则返回 None"""
+    address = _address_cache.get(token, False)
+    if address is not False:
+        return address
+    if ':' in token:
+        address = token if IPV6_ADDRESS.fullmatch(token) else None
+    else:
+        address = token if IPV4_ADDRESS.fullmatch(token) else None
+    if len(_address_cache) >= ADDRESS_CACHE_SIZE:
+        # 缓存未命中的代价很小，整体清空比按最近使用淘汰更快
+        _address_cache.clear()
+    _address_cache[token] = address
+    return address
+
+
+def new_hop(hop_num, probes, address=None, rtt=None):
+    """构造一跳；address 为代表地址（第一个回复的地址），rtt 为它的最小往返时间"""
+    if address is None:
+        return {"hop": hop_num, "ip": "*", "location": "请求超时", "probes": probes}
+    hop = {"hop": hop_num, "ip": address, "location": "查询中...", "probes": probes}
+    if rtt is not None:
+        hop["rtt"] = rtt
+    return hop
+
+
+def hop_from_probes(hop_num, probes):
+    """由任意探测序列构造一跳（同一跳可能有多个回复地址）"""
+    for address, _rtt in probes:
+        if address is not None:
+            break
+    else:
+        return new_hop(hop_num, probes)
+    rtts = [rtt for responder, rtt in probes if responder == address and rtt is not None]
+    return new_hop(hop_num, probes, address, min(rtts) if rtts else None)
+
+
+def scan_probes(words, address_last, responder=None):
+    """把一行中跳数之后的词归类为探测，返回 (各次探测, 最后的回复地址, 代表地址, 最小往返时间)
+
+    往返时间已与单位连写（见 normalize）。address_last 为假时（linux/darwin）地址写在
+    它的往返时间之前，之后的往返时间都属于这个地址；为真时（windows）行末的地址对本行
+    所有探测有效，没有地址时按超时处理。代表地址和最小往返时间与 hop_from_probes 的
+    结果相同，在切分的同时计算，单行的跳不需要再遍历一次探测。
+    """
+    probes = []
+    append = probes.append
+    trailing = first = best = None
+    for word in words:
+        if word[-1] == "s":
+            try:
+                value = float(word[:-2])
+            except ValueError:
+                if word[0] != "<":
+                    continue
+                value = WINDOWS_SUB_MS_RTT
+            append((responder, value))
+            trailing = None
+            if responder is not None:
+                if first is None:
+                    first, best = responder, value
+                elif value < best and responder == first:
+                    best = value
+        elif word == "*":
+            append(LOST)
+        elif ':' in word or word.count('.') > 1:
+            address = parse_address(word[1:-1] if word[0] in "([" else word)
+            if address is not None:
+                responder = trailing = address
+    if address_last:
+        # tracert: 行末的地址属于本行所有收到回复的探测
+        rtts = [rtt for _address, rtt in probes if rtt is not None]
+        if trailing is None or not rtts:
+            probes = [LOST] * len(probes)
+        else:
+            probes = [(trailing, rtt) if rtt is not None else LOST for _address, rtt in probes]
+            first, best = trailing, min(rtts)
+    if trailing is not None and not probes:
+        # 只有地址没有往返时间（例如被截断的行或不可达提示）
+        probes.append((trailing, None))
+        first = trailing
+    return probes, responder, first, best
+
+
+def normalize(text):
+    """往返时间与单位连写为一个词（"0.5 ms"、"<1 毫秒" -> "0.5ms"、"<1ms"），可以是一行或整个输出"""
+    if "毫秒" in text:
+        text = text.replace("毫秒", "ms")
+    return text.replace(" ms", "ms")
+
+
+def platform(os_type):
+    """按平台名取得 (地址是否写在行末, 是否有续行)，未知平台按 linux 处理"""
+    os_type = (os_type or "linux").lower()
+    return PLATFORMS.get(PLATFORM_ALIASES.get(os_type, os_type), PLATFORMS["linux"])
+
+
+def iter_hops(lines, os_type):
+    """逐行解析输出，每完成一跳就产出该跳
+
+    lines 可以是仍在运行的进程的输出；一跳在更大的跳数出现或输出结束时产出。
+    """
+    return scan_hops(map(normalize, lines), os_type)
+
+
+def scan_hops(lines, os_type):
+    """解析已经过 normalize 的各行，每完成一跳就产出该跳"""
+    address_last, continuation = platform(os_type)
+    # 跳数 -> 已解析的跳，同一跳分在多行时合并到表中的条目
+    table = {}
+    # 尚未产出的跳和它的跳数
+    pending = None
+    pending_num = 0
+    responder = None
+
+    for line in lines:
+        words = line.split()
+        if not words:
+            continue
+        if not words[0].isdecimal():
+            if continuation and pending is not None and line[0] in " \t":
+                # darwin 的续行：该跳另一个回复地址
+                probes, responder, _address, _rtt = scan_probes(words, address_last, responder)
+                if probes:
+                    pending.update(hop_from_probes(pending_num, pending["probes"] + probes))
+            continue
+        hop_num = int(words[0])
+        if hop_num <= 0:
+            # Windows tracert 等的标题行
+            continue
+        if hop_num != pending_num:
+            responder = None
+        probes, responder, address, rtt = scan_probes(words[1:], address_last, responder)
+
+        existing = table.get(hop_num)
+        if existing is not None:
+            if existing is pending:
+                pending.update(hop_from_probes(hop_num, pending["probes"] + probes))
+            # 已经产出的跳再次出现时忽略
+            continue
+        if pending is not None:
+            if hop_num < pending_num:
+                continue
+            yield pending
+        pending = table[hop_num] = new_hop(hop_num, probes, address, rtt)
+        pending_num = hop_num
+
+    if pending is not None:
+        yield pending
+
+
+def parse(output, os_type):
+    """解析一次完整的输出，返回跳列表（整个输出只需 normalize 一次）"""
+    return list(scan_hops(normalize(output).splitlines(), os_type))
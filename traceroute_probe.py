@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+进程内并行 TTL 的 traceroute 引擎
+
+系统 traceroute 按 TTL 逐跳探测，遇到不回复的跳要等满超时时间。这里在一个
+事件循环中，每个地址族只用一个原始 ICMP 套接字，一次性为所有目标的所有 TTL
+发出 ICMP 回显请求，再按 (标识符, 序列号) 把 TTL 超时/目的不可达/回显回复
+匹配回对应的目标和 TTL。整次追踪只需一个超时周期。探测包按 SEND_RATE 分批发出，
+避免瞬间的突发触发路由器的 ICMP 限速而丢掉中间跳；发送缓冲区已满时探测包排队，
+等套接字可写后重试。
+
+探测报文采用 Paris traceroute 的做法：负载的第一个 16 位字取序列号的反码，
+使同一目标所有探测包的 ICMP 校验和保持不变，按流哈希的负载均衡设备会把它们
+送上同一条路径，得到的路径不会在多条等价路径之间混杂。
+"""
+
+import asyncio
+import collections
+import errno
+import os
+import socket
+import struct
+import sys
+import time
+import logging
+
+from icmp_probe import (
+    ICMP_ECHO_REPLY, ICMP_ECHO_REQUEST, ICMPV6_ECHO_REPLY, ICMPV6_ECHO_REQUEST,
+    PAYLOAD_SIZE, RECV_BUFFER_SIZE, SEND_RETRY_DELAY, ICMPUnavailable, checksum,
+)
+
+logger = logging.getLogger("traceroute_monitor")
+
+# ICMP 差错报文类型
+ICMP_DEST_UNREACH = 3
+ICMP_TIME_EXCEEDED = 11
+ICMPV6_DEST_UNREACH = 1
+ICMPV6_TIME_EXCEEDED = 3
+
+# 默认最大跳数和等待回复的时间（秒），与系统 traceroute 的默认值一致
+DEFAULT_MAX_HOPS = 30
+DEFAULT_TIMEOUT = 2.0
+
+# 探测包的发送速率上限（每秒），所有目标的所有 TTL 同时发出会触发路由器的 ICMP 限速
+SEND_RATE = 2000
+# 每批连续发送的探测包数，批与批之间按 SEND_RATE 等待
+SEND_BATCH_SIZE = 50
+
+# IPV6_UNICAST_HOPS 在部分 Python 版本中没有导出
+IPV6_UNICAST_HOPS = getattr(socket, "IPV6_UNICAST_HOPS", 16)
+
+
+def build_probe(family, ident, seq):
+    """构造校验和与序列号无关的回显请求（Paris traceroute）"""
+    # 序列号与其反码之和恒为 0xFFFF，其余字段不变，因此校验和对所有探测包都相同
+    payload = struct.pack("!H", ~seq & 0xFFFF).ljust(PAYLOAD_SIZE, b'\x00')
+    if family == socket.AF_INET6:
+        # ICMPv6 的校验和由内核计算（包含伪首部，对同一目标同样保持不变）
+        return struct.pack("!BBHHH", ICMPV6_ECHO_REQUEST, 0, 0, ident, seq) + payload
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    csum = checksum(header + payload)
+    return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, csum, ident, seq) + payload
+
+
+def parse_reply(family, data):
+    """解析收到的 ICMP 报文，返回 (标识符, 序列号, 是否为终点)，无关报文返回 None
+
+    TTL 超时和目的不可达报文中带有原始请求的 IP 首部和 ICMP 首部前 8 字节，
+    从中取出原始请求的标识符和序列号。
+    """
+    if family == socket.AF_INET:
+        # IPv4 原始套接字收到的数据包含 IP 首部
+        if len(data) < 20:
+            return None
+        data = data[(data[0] & 0x0F) * 4:]
+        echo_reply, errors, request, inner_header = ICMP_ECHO_REPLY, (ICMP_TIME_EXCEEDED, ICMP_DEST_UNREACH), ICMP_ECHO_REQUEST, None
+    else:
+        echo_reply, errors, request, inner_header = ICMPV6_ECHO_REPLY, (ICMPV6_TIME_EXCEEDED, ICMPV6_DEST_UNREACH), ICMPV6_ECHO_REQUEST, 40
+    if len(data) < 8:
+        return None
+
+    icmp_type = data[0]
+    if icmp_type == echo_reply:
+        _type, _code, _csum, ident, seq = struct.unpack("!BBHHH", data[:8])
+        return ident, seq, True
+    if icmp_type not in errors:
+        return None
+
+    inner = data[8:]
+    if inner_header is None:
+        if len(inner) < 20:
+            return None
+        inner_header = (inner[0] & 0x0F) * 4
+    original = inner[inner_header:inner_header + 8]
+    if len(original) < 8 or original[0] != request:
+        return None
+    _type, _code, _csum, ident, seq = struct.unpack("!BBHHH", original)
+    # 目的不可达（无论来自目标还是中间路由器）表示探测包无法再前进，追踪到此为止
+    return ident, seq, icmp_type in (ICMP_DEST_UNREACH, ICMPV6_DEST_UNREACH)
+
+
+def open_raw_socket(family):
+    """打开原始 ICMP 套接字（设置每个探测包的 TTL 并接收差错报文需要原始套接字）"""
+    proto = socket.IPPROTO_ICMPV6 if family == socket.AF_INET6 else socket.IPPROTO_ICMP
+    try:
+        sock = socket.socket(family, socket.SOCK_RAW, proto)
+    except OSError as e:
+        raise ICMPUnavailable(str(e))
+    sock.setblocking(False)
+    return sock
+
+
+class _TraceChannel:
+    """单个地址族的原始套接字，负责发送各 TTL 的探测包和匹配回复"""
+
+    def __init__(self, family, engine, loop):
+        self.family = family
+        self.engine = engine
+        self.loop = loop
+        self.sock = open_raw_socket(family)
+        self.ident = (os.getpid() ^ id(self)) & 0xFFFF
+        self._next_seq = 0
+        # 序列号 -> (目标, TTL, 发送时间)
+        self.pending = {}
+        # 发送缓冲区已满时排队等待重试的探测包
+        self.backlog = collections.deque()
+        self._retry = None
+
+    def send(self, target, sockaddr, ttl):
+        seq = self._next_seq
+        self._next_seq = (self._next_seq + 1) & 0xFFFF
+        self.backlog.append((seq, target, ttl, build_probe(self.family, self.ident, seq), sockaddr))
+        if len(self.backlog) == 1:
+            self.flush()
+
+    def flush(self):
+        """按顺序发送排队的探测包，发送缓冲区已满时等待可写（或稍后）再继续"""
+        self._retry = None
+        self.loop.remove_writer(self.sock.fileno())
+        while self.backlog:
+            seq, target, ttl, packet, sockaddr = self.backlog[0]
+            if self.family == socket.AF_INET6:
+                self.sock.setsockopt(socket.IPPROTO_IPV6, IPV6_UNICAST_HOPS, ttl)
+            else:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+            sent = time.perf_counter()
+            try:
+                self.sock.sendto(packet, sockaddr)
+            except (BlockingIOError, InterruptedError):
+                self.loop.add_writer(self.sock.fileno(), self.flush)
+                return
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    self._retry = self.loop.call_later(SEND_RETRY_DELAY, self.flush)
+                    return
+                logger.debug(f"向 {target} 发送 TTL={ttl} 的探测包失败: {str(e)}")
+            else:
+                self.pending[seq] = (target, ttl, sent)
+            self.backlog.popleft()
+
+    def abandon(self):
+        """停止重试，返回仍未发出的探测包数"""
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+        self.loop.remove_writer(self.sock.fileno())
+        unsent = len(self.backlog)
+        self.backlog.clear()
+        return unsent
+
+    def on_readable(self):
+        """事件循环回调：读取套接字中所有待处理的报文"""
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(RECV_BUFFER_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.debug(f"读取 ICMP 报文失败: {str(e)}")
+                return
+            received = time.perf_counter()
+            parsed = parse_reply(self.family, data)
+            if parsed is None:
+                continue
+            ident, seq, reached = parsed
+            if ident != self.ident:
+                continue
+            entry = self.pending.pop(seq, None)
+            if entry is None:
+                continue
+            target, ttl, sent = entry
+            self.engine.record(target, ttl, addr[0], (received - sent) * 1000.0, reached)
+
+    def close(self):
+        self.sock.close()
+
+
+class TracerouteEngine:
+    """在单个事件循环中并行追踪一组目标的所有 TTL"""
+
+    def __init__(self, max_hops=DEFAULT_MAX_HOPS, timeout=DEFAULT_TIMEOUT):
+        self.max_hops = max_hops
+        self.timeout = timeout
+        self.channels = {}
+        # 目标 -> {TTL: (回复地址, 延迟毫秒)}
+        self.replies = {}
+        # 目标 -> 到达目标（或目的不可达）的最小 TTL
+        self.reached = {}
+        self._done = None
+
+    def record(self, target, ttl, addr, rtt_ms, reached):
+        replies = self.replies.get(target)
+        if replies is None or ttl in replies:
+            return
+        replies[ttl] = (addr, rtt_ms)
+        if reached or addr == target:
+            self.reached[target] = min(ttl, self.reached.get(target, ttl))
+        if self._done is not None and self._all_complete():
+            self._done.set()
+
+    def _all_complete(self):
+        """所有目标都已到达，且到达之前的每一跳都已回复"""
+        for target, replies in self.replies.items():
+            reached = self.reached.get(target)
+            if reached is None or any(ttl not in replies for ttl in range(1, reached)):
+                return False
+        return True
+
+    def _channel(self, family, loop):
+        if family not in self.channels:
+            try:
+                self.channels[family] = _TraceChannel(family, self, loop)
+            except (ICMPUnavailable, OSError) as e:
+                name = "IPv6" if family == socket.AF_INET6 else "IPv4"
+                logger.warning(f"无法创建 {name} 原始 ICMP 套接字: {str(e)}")
+                self.channels[family] = None
+        return self.channels[family]
+
+    def build_hops(self, target):
+        """把收到的回复整理为 traceroute_results 使用的 hops 列表"""
+        replies = self.replies[target]
+        last = self.reached.get(target)
+        if last is None:
+            # 没有到达目标：保留到最后一个有回复的跳
+            last = max(replies) if replies else 0
+        hops = []
+        for ttl in range(1, last + 1):
+            if ttl in replies:
+                addr, rtt = replies[ttl]
+                hops.append({"hop": ttl, "ip": addr, "location": "查询中...", "rtt": round(rtt, 3)})
+            else:
+                hops.append({"hop": ttl, "ip": "*", "location": "请求超时"})
+        return hops
+
+    async def run(self, targets):
+        """追踪所有目标，返回 (目标 -> hops 列表, 无法使用本引擎的目标列表)"""
+        loop = asyncio.get_running_loop()
+        self._done = asyncio.Event()
+        plan = []
+        unsupported = []
+        for target in targets:
+            try:
+                infos = await loop.getaddrinfo(target, None, type=socket.SOCK_RAW)
+            except OSError as e:
+                logger.warning(f"无法解析 {target}: {str(e)}")
+                unsupported.append(target)
+                continue
+            family, _type, _proto, _canon, sockaddr = infos[0]
+            channel = self._channel(family, loop)
+            if channel is None:
+                unsupported.append(target)
+                continue
+            plan.append((target, channel, sockaddr))
+            self.replies[target] = {}
+
+        if not plan:
+            return {}, unsupported
+
+        active = [c for c in self.channels.values() if c is not None]
+        for channel in active:
+            loop.add_reader(channel.sock.fileno(), channel.on_readable)
+        try:
+            # 先按 TTL 再按目标发送，同一路由器收到的相邻探测包来自不同目标；每 SEND_BATCH_SIZE
+            # 个探测包之后按 SEND_RATE 等待
+            start = loop.time()
+            probes = ((ttl, target, channel, sockaddr)
+                      for ttl in range(1, self.max_hops + 1) for target, channel, sockaddr in plan)
+            for index, (ttl, target, channel, sockaddr) in enumerate(probes, 1):
+                channel.send(target, sockaddr, ttl)
+                if index % SEND_BATCH_SIZE == 0:
+                    await asyncio.sleep(max(0.0, start + index / SEND_RATE - loop.time()))
+                    if self._done.is_set():
+                        break
+            try:
+                await asyncio.wait_for(self._done.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            unsent = 0
+            for channel in active:
+                unsent += channel.abandon()
+                loop.remove_reader(channel.sock.fileno())
+                channel.close()
+            self.channels.clear()
+        if unsent:
+            logger.warning(f"{unsent} 个 traceroute 探测包因发送缓冲区持续已满未能发出，对应的跳记为超时")
+
+        return {target: self.build_hops(target) for target, _channel, _sockaddr in plan}, unsupported
+
+
+def trace_targets(targets, max_hops=DEFAULT_MAX_HOPS, timeout=DEFAULT_TIMEOUT):
+    """同步入口：并行追踪所有目标，返回 (目标 -> hops 列表, 需要回退到系统 traceroute 的目标列表)
+
+    当前平台不支持或无法创建原始套接字时抛出 ICMPUnavailable。
+    """
+    if sys.platform == "win32":
+        raise ICMPUnavailable("当前平台不支持进程内 traceroute 引擎")
+    engine = TracerouteEngine(max_hops=max_hops, timeout=timeout)
+    results, unsupported = asyncio.run(engine.run(list(targets)))
+    if unsupported and not results:
+        raise ICMPUnavailable("无法创建原始 ICMP 套接字")
+    return results, unsupported
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多个采集点（vantage point）之间的增量同步
+
+每台探测主机有自己的 ping_data.db 和采集点编号（保存在库中的 sync_meta 表里，默认
+为主机名）。本机写入的结果行 vantage_id 为本机编号、source_id 为空；从其他采集点
+合并来的行记录来源的编号和它在来源库中的 id，(vantage_id, source_id) 上的唯一索引
+使重复合并同一行不会产生重复数据。
+
+同步协议只用标准库的 HTTP 和 JSON（gzip 压缩），每次只传输上次同步之后的新行：
+- GET  /sync/high-water?vantage=ID  收集端已合并的该采集点各表的最大来源 id（高水位）
+- POST /sync/batch                  推送一批行，收集端用 INSERT OR IGNORE 合并
+- GET  /sync/rows?table=T&after=N   拉取本机 id 大于 N 的一批行
+
+推送（push）时代理端先向收集端查询高水位，再从高水位之后分批发送；拉取（pull）时
+收集端按自己记录的高水位向代理端请求。高水位始终以收集端已写入的数据为准，传输
+中断后重新同步即可从断点继续。traceroute 结果引用的路径（routes 表）随批次一起发送。
+"""
+
+import base64
+import gzip
+import hmac
+import http.server
+import ipaddress
+import json
+import logging
+import re
+import socket
+import sqlite3
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import db_writer
+import routes
+
+logger = logging.getLogger("ping_monitor")
+
+# 参与同步的结果表
+SYNC_TABLES = ("ping_results", "traceroute_results")
+# 每批传输的最大行数
+SYNC_BATCH_SIZE = 5000
+# HTTP 请求超时（秒）
+SYNC_TIMEOUT = 30
+# 协议版本，收发双方不一致时拒绝合并
+PROTOCOL_VERSION = 1
+# 共享令牌的请求头
+TOKEN_HEADER = "X-Sync-Token"
+# 同步服务的默认监听地址（只接受本机连接）；监听其他地址时必须设置令牌
+DEFAULT_HOST = "127.0.0.1"
+# 请求体大小上限（字节，解压前）
+MAX_BODY_SIZE = 64 * 1024 * 1024
+# 同步列：本机行 source_id 为空，合并来的行记录来源编号和来源库中的 id
+SYNC_COLUMNS = [('vantage_id', 'TEXT'), ('source_id', 'INTEGER')]
+# 由接收方重新生成、不随批次传输的列
+LOCAL_COLUMNS = ('id', 'vantage_id', 'source_id')
+# 采集点编号：字母、数字、"-"、"_"、"."，最长 64 个字符
+VANTAGE_ID_PATTERN = re.compile(r'[\w.-]{1,64}')
+
+META_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sync_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+)
+'''
+
+
+class SyncError(Exception):
+    """同步请求失败或批次无效"""
+
+
+def validate_vantage_id(vantage_id):
+    """检查采集点编号，返回去掉首尾空白的编号，无效时抛出 ValueError"""
+    vantage_id = str(vantage_id or "").strip()
+    if not VANTAGE_ID_PATTERN.fullmatch(vantage_id):
+        raise ValueError(f"无效的采集点编号: {vantage_id!r}（只能包含字母、数字、'-'、'_'、'.'，最长 64 个字符）")
+    return vantage_id
+
+
+def default_vantage_id():
+    """默认的采集点编号：主机名中不允许的字符替换为 "-" """
+    return re.sub(r'[^\w.-]', '-', socket.gethostname())[:64] or "local"
+
+
+def read_vantage_id(conn):
+    """库中保存的本机采集点编号，没有时返回 None"""
+    try:
+        row = conn.execute("SELECT value FROM sync_meta WHERE key = 'vantage_id'").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+def init_sync_schema(conn, table, vantage_id=None):
+    """为结果表补充同步列和去重索引，返回本机的采集点编号
+
+    vantage_id 不为空时保存为本机编号；否则使用库中已保存的编号，第一次使用主机名。
+    """
+    conn.execute(META_SCHEMA)
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    for column, col_type in SYNC_COLUMNS:
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {col_type}')
+    # 本机行的 source_id 为空，不受唯一约束
+    conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_source ON {table} (vantage_id, source_id)')
+
+    saved = read_vantage_id(conn)
+    vantage_id = validate_vantage_id(vantage_id) if vantage_id else (saved or default_vantage_id())
+    if vantage_id != saved:
+        conn.execute("INSERT OR REPLACE INTO sync_meta (key, value) VALUES ('vantage_id', ?)", (vantage_id,))
+        if saved:
+            logger.info(f"采集点编号已从 {saved} 改为 {vantage_id}")
+    return vantage_id
+
+
+def existing_tables(conn):
+    """库中存在的同步表"""
+    names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    return [table for table in SYNC_TABLES if table in names]
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def high_water(conn, table, vantage_id):
+    """已合并的某采集点在该表中的最大来源 id，没有时为 0"""
+    row = conn.execute(f'SELECT MAX(source_id) FROM {table} WHERE vantage_id = ?', (vantage_id,)).fetchone()
+    return row[0] or 0
+
+
+def encode_value(value):
+    """BLOB 列在 JSON 中编码为 {"b64": ...}"""
+    if isinstance(value, bytes):
+        return {"b64": base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value["b64"])
+    return value
+
+
+def read_batch(conn, table, after, limit=SYNC_BATCH_SIZE, vantage_id=None):
+    """读取本机写入的、id 大于 after 的一批行
+
+    返回的批次包含列名（第一列是本机 id）、行、这批行的最大 id（high_water），
+    traceroute 结果还包含引用的路径。
+    """
+    columns = [name for name in table_columns(conn, table) if name not in LOCAL_COLUMNS]
+    rows = conn.execute(
+        f'SELECT id, {", ".join(columns)} FROM {table} WHERE id > ? AND source_id IS NULL ORDER BY id LIMIT ?',
+        (after, limit)
+    ).fetchall()
+    batch = {
+        "version": PROTOCOL_VERSION,
+        "vantage": vantage_id or read_vantage_id(conn),
+        "table": table,
+        "columns": ["id"] + columns,
+        "rows": [[encode_value(value) for value in row] for row in rows],
+        "high_water": rows[-1][0] if rows else after,
+    }
+    if table == "traceroute_results" and "route_id" in columns:
+        index = columns.index("route_id") + 1
+        route_ids = sorted({row[index] for row in rows if row[index]})
+        route_columns = table_columns(conn, "routes")
+        route_rows = []
+        for start in range(0, len(route_ids), 500):
+            chunk = route_ids[start:start + 500]
+            route_rows.extend(conn.execute(
+                f'SELECT {", ".join(route_columns)} FROM routes WHERE route_id IN ({", ".join("?" * len(chunk))})',
+                chunk
+            ))
+        batch["routes"] = {"columns": route_columns, "rows": [list(row) for row in route_rows]}
+    return batch
+
+
+def merge_statements(conn, batch, local_vantage_id):
+    """把一批行转换为合并语句 [(sql, rows), ...]，第一条是结果表的 INSERT OR IGNORE
+
+    只合并本库中也存在的列；批次无效时抛出 SyncError。
+    """
+    if batch.get("version") != PROTOCOL_VERSION:
+        raise SyncError(f"协议版本不一致: {batch.get('version')}（本机为 {PROTOCOL_VERSION}）")
+    table = batch.get("table")
+    if table not in existing_tables(conn):
+        raise SyncError(f"本库中没有表 {table}")
+    try:
+        vantage_id = validate_vantage_id(batch.get("vantage"))
+    except ValueError as e:
+        raise SyncError(str(e))
+    if vantage_id == local_vantage_id:
+        raise SyncError(f"批次来自本机的采集点编号 {vantage_id}，各采集点的编号必须不同")
+
+    columns = batch["columns"]
+    if not columns or columns[0] != "id":
+        raise SyncError("批次的第一列必须是来源 id")
+    known = set(table_columns(conn, table)) - set(LOCAL_COLUMNS)
+    keep = [i for i, name in enumerate(columns) if name in known]
+    names = ["vantage_id", "source_id"] + [columns[i] for i in keep]
+    rows = [
+        [vantage_id, row[0]] + [decode_value(row[i]) for i in keep]
+        for row in batch["rows"]
+    ]
+    statements = [(
+        f'INSERT OR IGNORE INTO {table} ({", ".join(names)}) VALUES ({", ".join("?" * len(names))})',
+        rows
+    )]
+
+    route_batch = batch.get("routes")
+    if route_batch and route_batch["rows"]:
+        route_names = [name for name in route_batch["columns"] if name in set(table_columns(conn, "routes"))]
+        indexes = [route_batch["columns"].index(name) for name in route_names]
+        sql = f'INSERT INTO routes ({", ".join(route_names)}) VALUES ({", ".join("?" * len(route_names))})'
+        # 来源库中的路径后来查询到了更多跳的地理位置时更新本库中的副本
+        sql += routes.ROUTE_UPSERT_CLAUSE if "unresolved" in route_names else ' ON CONFLICT (route_id) DO NOTHING'
+        statements.append((sql, [[row[i] for i in indexes] for row in route_batch["rows"]]))
+    return statements
+
+
+def merge_batch(db_file, batch):
+    """通过共享写入线程合并一批行，返回 (本机编号, 合并后该采集点在该表中的高水位)"""
+    conn = sqlite3.connect(db_file, timeout=db_writer.BUSY_TIMEOUT)
+    try:
+        local_vantage_id = read_vantage_id(conn)
+        statements = merge_statements(conn, batch, local_vantage_id)
+        db_writer.get_writer(db_file).write_group(statements)
+        return local_vantage_id, high_water(conn, batch["table"], batch["vantage"])
+    finally:
+        conn.close()
+
+
+# --- HTTP 服务 ---
+
+class _SyncHandler(http.server.BaseHTTPRequestHandler):
+    db_file = None
+    token = None
+
+    def _authorized(self):
+        if not self.token:
+            return True
+        if hmac.compare_digest(self.headers.get(TOKEN_HEADER, ""), self.token):
+            return True
+        self._send_json(403, {"error": "令牌无效"})
+        return False
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        compress = "gzip" in self.headers.get("Accept-Encoding", "")
+        if compress:
+            body = gzip.compress(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            conn = sqlite3.connect(self.db_file, timeout=db_writer.BUSY_TIMEOUT)
+            try:
+                if url.path == "/sync/high-water":
+                    vantage_id = query.get("vantage")
+                    tables = {table: high_water(conn, table, vantage_id) for table in existing_tables(conn)} if vantage_id else {}
+                    self._send_json(200, {"vantage": read_vantage_id(conn), "tables": tables})
+                elif url.path == "/sync/rows":
+                    table = query.get("table")
+                    if table not in existing_tables(conn):
+                        self._send_json(404, {"error": f"本库中没有表 {table}"})
+                        return
+                    limit = min(int(query.get("limit", SYNC_BATCH_SIZE)), SYNC_BATCH_SIZE)
+                    self._send_json(200, read_batch(conn, table, int(query.get("after", 0)), limit))
+                else:
+                    self._send_json(404, {"error": "未知的路径"})
+            finally:
+                conn.close()
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            logger.error(f"处理同步请求 {self.path} 失败: {str(e)}")
+            self._send_json(500, {"error": str(e)})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if urllib.parse.urlsplit(self.path).path != "/sync/batch":
+            self._send_json(404, {"error": "未知的路径"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length > MAX_BODY_SIZE:
+                self._send_json(413, {"error": "批次过大"})
+                return
+            body = self.rfile.read(length)
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            batch = json.loads(body)
+            local_vantage_id, mark = merge_batch(self.db_file, batch)
+        except (SyncError, ValueError, KeyError, TypeError, OSError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            logger.error(f"合并同步批次失败: {str(e)}")
+            self._send_json(500, {"error": str(e)})
+            return
+        logger.info(f"已合并采集点 {batch['vantage']} 的 {len(batch['rows'])} 行 {batch['table']}")
+        self._send_json(200, {"vantage": local_vantage_id, "received": len(batch["rows"]), "high_water": mark})
+
+    def log_message(self, format, *args):
+        logger.debug(f"同步请求 {self.address_string()}: {format % args}")
+
+
+def is_loopback(host):
+    """host 是否只接受本机连接（空字符串表示所有地址）"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def start_server(db_file, port, host=DEFAULT_HOST, token=None):
+    """在后台线程中启动同步 HTTP 服务（既接收推送，也供收集端拉取），返回服务对象
+
+    任何能访问端口的人都可以写入或读取全部结果，监听非本机地址且没有令牌时抛出 SyncError。
+    """
+    if not token and not is_loopback(host):
+        raise SyncError(f"同步服务监听 {host or '所有地址'} 时必须设置共享令牌（--sync-token）")
+    handler = type("SyncHandler", (_SyncHandler,), {"db_file": db_file, "token": token})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="sync-http", daemon=True)
+    thread.start()
+    logger.info(f"同步服务已启动: http://{host or '0.0.0.0'}:{server.server_address[1]}/sync/")
+    return server
+
+
+# --- 客户端 ---
+
+def request_json(url, payload=None, token=None, timeout=SYNC_TIMEOUT):
+    """发送 GET（payload 为空时）或 gzip 压缩的 JSON POST 请求，返回解析后的响应"""
+    headers = {"Accept-Encoding": "gzip"}
+    body = None
+    if payload is not None:
+        body = gzip.compress(json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        headers["Content-Type"] = "application/json; charset=utf-8"
+        headers["Content-Encoding"] = "gzip"
+    if token:
+        headers[TOKEN_HEADER] = token
+    request = urllib.request.Request(url, data=body, headers=headers, method="GET" if body is None else "POST")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            data = response.read()
+            if response.headers.get("Content-Encoding") == "gzip":
+                data = gzip.decompress(data)
+    except urllib.error.HTTPError as e:
+        data = e.read()
+        if e.headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        try:
+            message = json.loads(data).get("error", "")
+        except ValueError:
+            message = data[:200].decode('utf-8', 'replace')
+        raise SyncError(f"{url} 返回 {e.code}: {message}")
+    except (urllib.error.URLError, OSError) as e:
+        raise SyncError(f"无法连接 {url}: {str(e)}")
+    return json.loads(data)
+
+
+def push(db_file, collector_url, token=None, batch_size=SYNC_BATCH_SIZE):
+    """把本机的新行推送到收集端，返回 {表: 推送的行数}"""
+    collector_url = collector_url.rstrip('/')
+    conn = sqlite3.connect(db_file, timeout=db_writer.BUSY_TIMEOUT)
+    try:
+        vantage_id = read_vantage_id(conn)
+        if vantage_id is None:
+            raise SyncError(f"{db_file} 还没有采集点编号，请先运行一次探测")
+        state = request_json(
+            f"{collector_url}/sync/high-water?vantage={urllib.parse.quote(vantage_id)}", token=token
+        )
+        shipped = {}
+        for table in existing_tables(conn):
+            after = state["tables"].get(table)
+            if after is None:
+                logger.warning(f"收集端没有表 {table}，跳过")
+                continue
+            shipped[table] = 0
+            while True:
+                batch = read_batch(conn, table, after, batch_size, vantage_id)
+                if not batch["rows"]:
+                    break
+                reply = request_json(f"{collector_url}/sync/batch", batch, token)
+                shipped[table] += len(batch["rows"])
+                after = batch["high_water"]
+                if reply["high_water"] < after:
+                    raise SyncError(f"收集端的高水位 {reply['high_water']} 落后于已推送的 {after}")
+                if len(batch["rows"]) < batch_size:
+                    break
+        return shipped
+    finally:
+        conn.close()
+
+
+def pull(db_file, agent_url, token=None, batch_size=SYNC_BATCH_SIZE):
+    """从代理端拉取它的新行并合并到本库，返回 (代理端编号, {表: 合并的行数})"""
+    agent_url = agent_url.rstrip('/')
+    state = request_json(f"{agent_url}/sync/high-water", token=token)
+    vantage_id = state.get("vantage")
+    if vantage_id is None:
+        raise SyncError(f"{agent_url} 还没有采集点编号")
+    conn = sqlite3.connect(db_file, timeout=db_writer.BUSY_TIMEOUT)
+    try:
+        local_vantage_id = read_vantage_id(conn)
+        writer = db_writer.get_writer(db_file)
+        merged = {}
+        for table in existing_tables(conn):
+            after = high_water(conn, table, vantage_id)
+            merged[table] = 0
+            while True:
+                try:
+                    batch = request_json(
+                        f"{agent_url}/sync/rows?table={table}&after={after}&limit={batch_size}", token=token
+                    )
+                except SyncError as e:
+                    # 代理端没有这张表（例如没有运行 traceroute）
+                    logger.warning(f"从 {agent_url} 拉取 {table} 失败: {str(e)}")
+                    break
+                if not batch["rows"]:
+                    break
+                writer.write_group(merge_statements(conn, batch, local_vantage_id))
+                merged[table] += len(batch["rows"])
+                after = batch["high_water"]
+                if len(batch["rows"]) < batch_size:
+                    break
+        return vantage_id, merged
+    finally:
+        conn.close()